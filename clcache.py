@@ -6,26 +6,91 @@
 # full text of which is available in the accompanying LICENSE file at the
 # root directory of this project.
 #
+from array import array
 from collections import defaultdict, namedtuple
-from ctypes import windll, wintypes
+from concurrent.futures import ThreadPoolExecutor
 from shutil import copyfile, rmtree
+import bisect
 import cProfile
 import codecs
 import contextlib
 import errno
+import functools
 import hashlib
 import json
+import mmap
 import multiprocessing
 import os
 import re
 import signal
+import struct
 import subprocess
 import sys
+import threading
+import time
+import zlib
 from tempfile import TemporaryFile
 
+if sys.platform == 'win32':
+    from ctypes import Structure, byref, c_void_p, windll, wintypes
+    import msvcrt
+
 VERSION = "3.3.1-dev"
 
-HashAlgorithm = hashlib.md5
+# Hash algorithms which can be selected via the CLCACHE_HASH_ALGORITHM
+# environment variable. The name of the algorithm is part of all cache keys,
+# so entries created using different algorithms never alias.
+HASH_ALGORITHMS = {
+    'md5': hashlib.md5,
+    'sha1': hashlib.sha1,
+}
+if hasattr(hashlib, 'blake2b'):
+    HASH_ALGORITHMS['blake2b'] = functools.partial(hashlib.blake2b, digest_size=16)
+    HASH_ALGORITHMS['blake2s'] = functools.partial(hashlib.blake2s, digest_size=16)
+DEFAULT_HASH_ALGORITHM = 'md5'
+
+# Lists of files are hashed concurrently using a pool of threads, unless there
+# are less than PARALLEL_HASHING_THRESHOLD files. Most of the time is spent
+# waiting for I/O, so the default pool size exceeds the number of CPUs.
+PARALLEL_HASHING_THRESHOLD = 16
+MAX_DEFAULT_HASHING_THREADS = 16
+
+# Thread pools for hashing files by their number of threads, see
+# hashingExecutor()
+HASHING_EXECUTORS = {}
+HASHING_EXECUTORS_LOCK = threading.Lock()
+
+# Files are hashed in chunks of this size, such that large files are never read
+# into memory as a whole. Files of at least HASH_MMAP_THRESHOLD bytes are
+# mapped into memory instead, one window of HASH_MMAP_WINDOW_SIZE bytes (a
+# multiple of the allocation granularity) at a time.
+HASH_CHUNK_SIZE = 128 * 1024
+HASH_MMAP_THRESHOLD = 16 * 1024 * 1024
+HASH_MMAP_WINDOW_SIZE = 16 * 1024 * 1024
+
+# Compression methods for object files stored in the cache which can be
+# selected via the CLCACHE_COMPRESS environment variable (and the level via
+# CLCACHE_COMPRESSLEVEL). Compressed blobs carry the name of the method as
+# their extension, so the setting can be changed at any time.
+CompressionMethod = namedtuple('CompressionMethod', ['newCompressor', 'newDecompressor', 'defaultLevel', 'error'])
+COMPRESSION_METHODS = {
+    'zlib': CompressionMethod(zlib.compressobj, zlib.decompressobj, zlib.Z_DEFAULT_COMPRESSION, zlib.error),
+}
+try:
+    import lzma # pylint: disable=wrong-import-position
+    COMPRESSION_METHODS['lzma'] = CompressionMethod(
+        lambda level: lzma.LZMACompressor(preset=level), lzma.LZMADecompressor, lzma.PRESET_DEFAULT, lzma.LZMAError)
+except ImportError:
+    pass
+
+# File locks are taken using flock() on POSIX systems. Reflinks (copy-on-write
+# clones of a file, e.g. on btrfs and XFS) are created using the FICLONE ioctl,
+# which is available on Linux only.
+try:
+    import fcntl # pylint: disable=wrong-import-position
+except ImportError:
+    fcntl = None
+FICLONE = 0x40049409
 
 # try to use os.scandir or scandir.scandir
 # fall back to os.listdir if not found
@@ -42,7 +107,7 @@ except ImportError:
         LIST = os.listdir
 
 # The codec that is used by clcache to store compiler STDOUR and STDERR in
-# output.txt and stderr.txt.
+# cache entries.
 # This codec is up to us and only used for clcache internal storage.
 # For possible values see https://docs.python.org/2/library/codecs.html
 CACHE_COMPILER_OUTPUT_STORAGE_CODEC = 'utf-8'
@@ -50,8 +115,9 @@ CACHE_COMPILER_OUTPUT_STORAGE_CODEC = 'utf-8'
 # The cl default codec
 CL_DEFAULT_CODEC = 'mbcs'
 
-# Manifest file will have at most this number of hash lists in it. Need to avoi
-# manifests grow too large.
+# Manifest file will have at most this number of hash lists in it by default
+# (see the MaximumManifestEntries setting). Need to avoid manifests grow too
+# large.
 MAX_MANIFEST_HASHES = 100
 
 # String, by which BASE_DIR will be replaced in paths, stored in manifests.
@@ -61,12 +127,103 @@ BASEDIR_REPLACEMENT = '?'
 
 # ManifestEntry: an entry in a manifest file
 # `includeFiles`: list of paths to include files, which this source file uses
+# `includeHashes`: list of hashes of the contents of each of the includeFiles
 # `includesContentsHash`: hash of the contents of the includeFiles
 # `objectHash`: hash of the object in cache
-ManifestEntry = namedtuple('ManifestEntry', ['includeFiles', 'includesContentHash', 'objectHash'])
+ManifestEntry = namedtuple('ManifestEntry', ['includeFiles', 'includeHashes', 'includesContentHash', 'objectHash'])
+
+# Include files of manifest entries are verified in batches of this size; the
+# files of a batch are hashed concurrently, the verification stops after the
+# first batch containing a mismatch.
+INCLUDE_VERIFICATION_BATCH_SIZE = 64
+
+# Maximum time between attempts to acquire a file lock or a compile lease
+LOCK_POLL_INTERVAL = 0.05
+
+# Files and cache entries are published by renaming them into place. On
+# Windows, this fails while a reader has the destination open, in which case
+# the rename is retried REPLACE_FILE_ATTEMPTS times, waiting
+# REPLACE_FILE_RETRY_DELAY seconds in between.
+REPLACE_FILE_ATTEMPTS = 20
+REPLACE_FILE_RETRY_DELAY = 0.01
+
+# Cache hits via manifest entries are recorded in an access journal per
+# manifest section instead of rewriting the manifest. The journal is folded
+# into the manifests whenever the section is written or cleaned, or once it
+# exceeds MAX_ACCESS_JOURNAL_SIZE bytes.
+MAX_ACCESS_JOURNAL_SIZE = 1024 * 1024
+
+# The sizes and last use times of manifests and cache entries are recorded in
+# a ledger per cache section, so that cleaning the cache does not need to stat
+# every file. Cache hits are recorded in a separate file, which is compacted
+# into the ledger when cleaning the cache, or once it exceeds
+# MAX_LEDGER_USES_SIZE bytes.
+MAX_LEDGER_USES_SIZE = 1024 * 1024
+
+# Changes to the statistics are added to one of STATISTICS_SHARDS shard files
+# (chosen by process id), so that concurrent clcache invocations do not all
+# wait for the lock of a single statistics file.
+STATISTICS_SHARDS = 16
+
+# Sections of the cache are locked by the first SECTION_LOCK_PREFIX_LENGTH
+# characters of their keys, whatever the shard layout of the directories (see
+# the ShardDepth and ShardWidth settings), so that locking all sections takes
+# at most 256 locks per repository.
+SECTION_LOCK_PREFIX_LENGTH = 2
+
+# Policies for choosing the cache entries to evict when cleaning the cache,
+# selected by the EvictionPolicy setting: either the least recently used
+# entries, or the ones saving the least compile time per byte of cache
+# (GreedyDual-Size-Frequency).
+EVICTION_POLICY_LRU = 'LRU'
+EVICTION_POLICY_GDSF = 'GDSF'
+EVICTION_POLICIES = [EVICTION_POLICY_LRU, EVICTION_POLICY_GDSF]
+
+# ManifestEntryUsage: bookkeeping about the usage of a manifest entry
+# `hits`: number of cache hits via the entry
+# `lastUsed`: manifest clock value when the entry was added or hit most recently
+ManifestEntryUsage = namedtuple('ManifestEntryUsage', ['hits', 'lastUsed'])
+
+# LedgerEntry: a file recorded in the ledger of a cache section
+# `lastUsed`: time when the file was written or used most recently
+# `uses`: number of times the file was used
+# `fields`: list of strings, e.g. the size of the file
+LedgerEntry = namedtuple('LedgerEntry', ['lastUsed', 'uses', 'fields'])
+
+# RecordedCacheEntry: a cache entry as recorded in the ledger of its section
+# `blobName`, `blobSize`: the blob storing the object file (None and 0 if there
+# is no object file)
+# `objectSize`: size of the (uncompressed) object file
+# `compileDuration`: seconds it took to compile the object file
+RecordedCacheEntry = namedtuple(
+    'RecordedCacheEntry', ['lastUsed', 'uses', 'blobName', 'blobSize', 'objectSize', 'compileDuration'])
 
 CompilerArtifacts = namedtuple('CompilerArtifacts', ['objectFilePath', 'stdout', 'stderr'])
 
+# LockTiming: time spent on a cache lock
+# `acquisitions`: number of times the lock was acquired
+# `timeouts`: number of times acquiring the lock timed out
+# `waitTime`: seconds spent waiting for the lock, including timeouts
+# `holdTime`: seconds the lock was held
+LockTiming = namedtuple('LockTiming', ['acquisitions', 'timeouts', 'waitTime', 'holdTime'])
+
+# Number of locks listed by the lock report, by descending wait time
+LOCK_REPORT_ENTRIES = 20
+
+def addLockTimings(timing, otherTiming):
+    if timing is None:
+        return otherTiming
+    return LockTiming(*[a + b for a, b in zip(timing, otherTiming)])
+
+
+def objectCacheTimeoutMs():
+    return int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
+
+
+def compileLeaseExpiryMs():
+    return int(os.environ.get('CLCACHE_COMPILE_LEASE_EXPIRY_MS', 30 * 1000))
+
+
 def printBinary(stream, rawData):
     stream.buffer.write(rawData)
 
@@ -123,67 +280,505 @@ class LogicException(Exception):
 
 
 class Manifest(object):
-    def __init__(self, entries=None):
+    def __init__(self, entries=None, usages=None, clock=0):
         if entries is None:
             entries = []
+        if usages is None:
+            usages = [ManifestEntryUsage(0, clock)] * len(entries)
+        assert len(usages) == len(entries)
         self._entries = entries.copy()
+        self._usages = usages.copy()
+        # Advances whenever an entry is added or hit
+        self._clock = clock
 
     def entries(self):
         return self._entries
 
-    def addEntry(self, entry):
-        """Adds entry at the top of the entries"""
+    def usages(self):
+        return self._usages
+
+    def clock(self):
+        return self._clock
+
+    def addEntry(self, entry, maxEntries=MAX_MANIFEST_HASHES):
+        """Adds entry at the top of the entries, evicts entries exceeding maxEntries"""
+        self._clock += 1
         self._entries.insert(0, entry)
+        self._usages.insert(0, ManifestEntryUsage(0, self._clock))
+        while len(self._entries) > max(maxEntries, 1):
+            self._evictEntry()
 
     def touchEntry(self, entryIndex):
-        """Moves entry in entryIndex position to the top of entries()"""
+        """Moves entry in entryIndex position to the top of entries() and counts a hit for it"""
+        self._clock += 1
         self._entries.insert(0, self._entries.pop(entryIndex))
+        self._usages.insert(0, ManifestEntryUsage(self._usages.pop(entryIndex).hits + 1, self._clock))
+
+    def _evictEntry(self):
+        # Evict the entry with the lowest number of hits per time since it was
+        # used last: frequently hit entries (e.g. for branches which are
+        # switched to regularly) survive, but lose their advantage if they are
+        # not used anymore. The entry added last is never evicted.
+        def hitRate(entryIndex):
+            usage = self._usages[entryIndex]
+            return (usage.hits + 1) / (self._clock - usage.lastUsed + 1)
+
+        victim = min(range(1, len(self._entries)), key=lambda i: (hitRate(i), -i))
+        del self._entries[victim]
+        del self._usages[victim]
+
+
+class ManifestDecisionTree(object):
+    """Decision tree for finding the manifest entry matching the current
+    contents of the include files.
+
+    Every node of the tree tests the hash of an include file for which the
+    remaining candidate entries store different hashes. A lookup continues with
+    the entries which agree with the current hash of that file (or which don't
+    use the file at all), so it follows a single path and hashes every include
+    file at most once. Since a lookup follows one path only, just the nodes on
+    that path are ever built.
+    """
+    def __init__(self, entries):
+        self._entries = entries
+        # Maps include file paths to the indices of the entries using them,
+        # grouped by the hash of the include file
+        self._entriesByInclude = defaultdict(lambda: defaultdict(set))
+        for entryIndex, entry in enumerate(entries):
+            for path, includeHash in zip(entry.includeFiles, entry.includeHashes):
+                self._entriesByInclude[path][includeHash].add(entryIndex)
+
+        # Include files with the same hash in all entries using them cannot
+        # tell any entries apart. Test the most ambiguous files first.
+        self._decisionPaths = sorted(
+            (path for path, entriesByHash in self._entriesByInclude.items() if len(entriesByHash) > 1),
+            key=lambda path: (-len(self._entriesByInclude[path]), path))
+
+    def findEntry(self, knownHashes, fileHashIndex=None):
+        """Returns the index of the most recent matching entry, or None"""
+        candidates = set(range(len(self._entries)))
+        for path in self._decisionPaths:
+            entriesByHash = self._entriesByInclude[path]
+            if sum(1 for entryIndices in entriesByHash.values() if not entryIndices.isdisjoint(candidates)) < 2:
+                continue
+
+            currentHash = getIncludeFileHash(path, knownHashes, fileHashIndex)
+            for includeHash, entryIndices in entriesByHash.items():
+                if includeHash != currentHash:
+                    candidates -= entryIndices
+            if not candidates:
+                return None
+
+        # The remaining candidates agree on all tested include files; check
+        # the rest of their include files.
+        for entryIndex in sorted(candidates):
+            if verifyManifestEntry(self._entries[entryIndex], knownHashes, fileHashIndex):
+                return entryIndex
+        return None
+
+
+class ShardLayout(object):
+    """Distributes the files of a repository over section directories named
+    by the first characters of their keys: `depth` levels of directories with
+    names of `width` characters, e.g. 'ab/cd/abcdef...' for depth 2 and width
+    2. The default layout is a single level of 256 directories."""
+    MAX_WIDTH = 4
+
+    def __init__(self, depth=1, width=2):
+        if depth < 1 or not 1 <= width <= ShardLayout.MAX_WIDTH or depth * width < SECTION_LOCK_PREFIX_LENGTH:
+            raise LogicException("Unsupported shard layout: depth {}, width {}".format(depth, width))
+        self.depth = depth
+        self.width = width
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def __ne__(self, other):
+        return not self == other
+
+    def sectionDir(self, rootDir, key):
+        return os.path.join(rootDir, *[key[level * self.width:(level + 1) * self.width] for level in range(self.depth)])
+
+    def sectionDirs(self, rootDir):
+        sectionDirs = [rootDir] if os.path.isdir(rootDir) else []
+        for _ in range(self.depth):
+            sectionDirs = [path for parentDir in sectionDirs for path in childDirectories(parentDir)
+                           if len(os.path.basename(path)) == self.width]
+        return sectionDirs
+
+    @staticmethod
+    def isSectionDirName(name):
+        return len(name) <= ShardLayout.MAX_WIDTH
+
+    @staticmethod
+    def lockDir(rootDir, sectionDir):
+        """Returns the path which the lock of the given section is named after"""
+        prefix = os.path.relpath(sectionDir, rootDir).replace(os.sep, '')
+        return os.path.join(rootDir, prefix[:SECTION_LOCK_PREFIX_LENGTH])
+
+    @staticmethod
+    def locateSectionDir(rootDir, layouts, key, fileName):
+        """Returns the directory of the section storing the given file in the
+        current (i.e. first) layout, unless the file is still stored in the
+        section of a previous layout while resharding the cache."""
+        sectionDir = layouts[0].sectionDir(rootDir, key)
+        if len(layouts) == 1 or os.path.exists(os.path.join(sectionDir, fileName)):
+            return sectionDir
+        for layout in layouts[1:]:
+            previousSectionDir = layout.sectionDir(rootDir, key)
+            if os.path.exists(os.path.join(previousSectionDir, fileName)):
+                return previousSectionDir
+        return sectionDir
+
+    @staticmethod
+    def allSectionDirs(rootDir, layouts):
+        sectionDirs = []
+        seen = set()
+        for layout in layouts:
+            for path in layout.sectionDirs(rootDir):
+                if path not in seen:
+                    seen.add(path)
+                    sectionDirs.append(path)
+        return sectionDirs
+
+
+class SectionLedger(object):
+    """Records the files of a cache section along with their last use times,
+    as lines of text appended to the ledger file:
+
+      + <name> <time> <uses> <fields...>    file was written
+      * <name> <time>                file was used (i.e. a cache hit)
+      - <name>                       file was removed
+
+    Writes and removals are recorded while holding the lock of the section.
+    Uses are recorded without it, in a separate file, so that a line torn by
+    concurrent appends loses a use at worst."""
+    LEDGER_FILE_NAME = "index.ledger"
+
+    def __init__(self, sectionDir):
+        self.ledgerPath = os.path.join(sectionDir, SectionLedger.LEDGER_FILE_NAME)
+        self.usesPath = self.ledgerPath + '.uses'
+        self.foldingPath = self.usesPath + '.folding'
+
+    @staticmethod
+    def isLedgerFile(fileName):
+        return fileName.startswith(SectionLedger.LEDGER_FILE_NAME)
+
+    def exists(self):
+        return os.path.exists(self.ledgerPath)
+
+    def recordWrite(self, name, fields, lastUsed=None, uses=0):
+        lastUsed = time.time() if lastUsed is None else lastUsed
+        self._append(self.ledgerPath, '+ {} {:.6f} {} {}\n'.format(name, lastUsed, uses, ' '.join(fields)))
+
+    def recordRemoval(self, name):
+        self._append(self.ledgerPath, '- {}\n'.format(name))
+
+    def recordUse(self, name):
+        """Returns the size of the file recording the uses"""
+        return self._append(self.usesPath, '* {} {:.6f}\n'.format(name, time.time()))
+
+    @staticmethod
+    def _append(path, line):
+        try:
+            with open(path, 'a') as f:
+                f.write(line)
+                return f.tell()
+        except OSError:
+            # The ledger is rebuilt if it gets lost, don't fail the build
+            return 0
+
+    def entries(self):
+        """Returns a dict mapping the names of all recorded files to LedgerEntry values"""
+        entries = {}
+        for path in [self.ledgerPath, self.foldingPath, self.usesPath]:
+            try:
+                with open(path, 'r') as f:
+                    lines = f.read().splitlines()
+            except OSError:
+                continue
+            for line in lines:
+                fields = line.split()
+                try:
+                    if len(fields) >= 4 and fields[0] == '+':
+                        # Rewriting a file keeps the uses recorded so far
+                        uses = int(fields[3]) + (entries[fields[1]].uses if fields[1] in entries else 0)
+                        entries[fields[1]] = LedgerEntry(float(fields[2]), uses, fields[4:])
+                    elif len(fields) == 3 and fields[0] == '*' and fields[1] in entries:
+                        entry = entries[fields[1]]
+                        entries[fields[1]] = entry._replace(
+                            lastUsed=max(entry.lastUsed, float(fields[2])), uses=entry.uses + 1)
+                    elif len(fields) == 2 and fields[0] == '-':
+                        entries.pop(fields[1], None)
+                except ValueError:
+                    # Skip lines torn by a concurrent append
+                    pass
+        return entries
+
+    def compact(self, entries=None):
+        """Rewrites the ledger to record just the given entries (by default,
+        the currently recorded ones), requires the lock."""
+        # Move the recorded uses out of the way first, so that concurrent
+        # cache hits record their uses in a new file.
+        try:
+            replaceFile(self.usesPath, self.foldingPath)
+        except OSError:
+            pass
+        if entries is None:
+            entries = self.entries()
+        writeFileAtomically(self.ledgerPath, ''.join(
+            '+ {} {:.6f} {} {}\n'.format(name, entry.lastUsed, entry.uses, ' '.join(entry.fields))
+            for name, entry in sorted(entries.items())).encode('utf-8'))
+        removeFileIfExists(self.foldingPath)
+
+    def discard(self):
+        """Removes the ledger of a section which does not store any files, requires the lock."""
+        for path in [self.ledgerPath, self.usesPath, self.foldingPath]:
+            removeFileIfExists(path)
 
 
 class ManifestSection(object):
-    def __init__(self, manifestSectionDir):
+    # Manifest files are stored in a compact binary format. All integers are
+    # unsigned 32 bit values in little endian byte order.
+    #
+    #   magic, file format version, number of entries, manifest clock
+    #   size and contents of the path table
+    #   size and contents of the hash table
+    #   for each entry:
+    #     number of include files, hash table indices of includesContentHash
+    #     and objectHash, number of hits, last use, path table indices of the
+    #     include files, hash table indices of the include file hashes
+    #
+    # The tables hold all distinct include paths and hashes of a manifest,
+    # separated by newlines. Entries of a manifest tend to share most of their
+    # include files, so every path and hash is stored just once.
+    MANIFEST_FILE_MAGIC = b'CLCM'
+    _HEADER = struct.Struct('<4sIII')
+    _TABLE_SIZE = struct.Struct('<I')
+    _ENTRY_HEADER = struct.Struct('<IIIII')
+
+    def __init__(self, manifestSectionDir, lockDir=None):
         self.manifestSectionDir = manifestSectionDir
-        self.lock = CacheLock.forPath(self.manifestSectionDir)
+        self.lockDir = lockDir or manifestSectionDir
+        self.lock = CacheLock.forSection(self.lockDir)
+        self.sharedLock = CacheLock.forSection(self.lockDir, shared=True)
+        self.ledger = SectionLedger(self.manifestSectionDir)
 
     def manifestPath(self, manifestHash):
-        return os.path.join(self.manifestSectionDir, manifestHash + ".json")
-
-    def manifestFiles(self):
-        return filesBeneath(self.manifestSectionDir)
+        return os.path.join(self.manifestSectionDir, manifestHash + ".manifest")
+
+    def accessJournalPath(self):
+        return os.path.join(self.manifestSectionDir, "access.journal")
+
+    def staleFiles(self):
+        """Returns the paths of everything but manifests and the access journal
+        in the section, i.e. manifests of older clcache versions, temporary
+        files and access journals left by interrupted clcache invocations (but
+        not the section directories of a nested shard layout)"""
+        return [os.path.join(self.manifestSectionDir, name)
+                for name in os.listdir(self.manifestSectionDir)
+                if not name.endswith(".manifest") and name != os.path.basename(self.accessJournalPath())
+                and not SectionLedger.isLedgerFile(name) and not ShardLayout.isSectionDirName(name)]
+
+    def recordAccess(self, manifestHash, objectHash):
+        """Records a cache hit via the manifest entry for objectHash without
+        taking the lock, returns the size of the access journal."""
+        try:
+            with open(self.accessJournalPath(), 'a') as journal:
+                journal.write('{} {} {:.6f}\n'.format(manifestHash, objectHash, time.time()))
+                return journal.tell()
+        except OSError:
+            # Recording the usage is best effort, don't fail the build
+            return 0
+
+    def foldAccessJournal(self):
+        """Applies the recorded accesses to the manifests, requires the lock."""
+        journalPath = self.accessJournalPath()
+        foldingPath = journalPath + '.folding'
+        # Move the journal out of the way first, so that concurrent cache hits
+        # record their accesses in a new one.
+        try:
+            replaceFile(journalPath, foldingPath)
+        except OSError:
+            return
 
-    def setManifest(self, manifestHash, manifest):
+        accesses = defaultdict(list)
+        lastAccesses = {}
+        with open(foldingPath, 'r') as journal:
+            for line in journal:
+                fields = line.split()
+                try:
+                    accessTime = float(fields[2])
+                except (IndexError, ValueError):
+                    # Skip lines torn by a concurrent append
+                    continue
+                accesses[fields[0]].append(fields[1])
+                lastAccesses[fields[0]] = max(lastAccesses.get(fields[0], 0), accessTime)
+
+        for manifestHash, objectHashes in accesses.items():
+            manifest = self.getManifest(manifestHash)
+            if manifest is None:
+                continue
+            for objectHash in objectHashes:
+                entryHashes = [entry.objectHash for entry in manifest.entries()]
+                if objectHash in entryHashes:
+                    manifest.touchEntry(entryHashes.index(objectHash))
+            # Folding is no use of the manifest, the accesses are
+            self.setManifest(manifestHash, manifest, lastAccesses[manifestHash], len(objectHashes))
+        os.remove(foldingPath)
+
+    def setManifest(self, manifestHash, manifest, lastUsed=None, uses=0):
         manifestPath = self.manifestPath(manifestHash)
         printTraceStatement("Writing manifest with manifestHash = {} to {}".format(manifestHash, manifestPath))
         ensureDirectoryExists(self.manifestSectionDir)
-        with open(manifestPath, 'w') as outFile:
-            # Converting namedtuple to JSON via OrderedDict preserves key names and keys order
-            entries = [e._asdict() for e in manifest.entries()]
-            jsonobject = {'entries': entries}
-            json.dump(jsonobject, outFile, sort_keys=True, indent=2)
+        # Manifests are read without holding the section lock
+        data = ManifestSection.serializeManifest(manifest)
+        writeFileAtomically(manifestPath, data)
+        self.ledger.recordWrite(manifestHash, [str(len(data))], lastUsed, uses)
+
+    def removeManifest(self, manifestHash):
+        # Returns False if the manifest could not be removed because it is
+        # being read right now (Windows refuses to delete open files).
+        try:
+            os.remove(self.manifestPath(manifestHash))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+        self.ledger.recordRemoval(manifestHash)
+        return True
+
+    def rebuildLedger(self):
+        """Reconstructs the ledger from the manifest files, removing stale
+        files on the way. Requires the lock."""
+        for path in self.staleFiles():
+            if os.path.isdir(path):
+                rmtree(path, ignore_errors=True)
+            else:
+                removeFileIfExists(path)
+
+        entries = {}
+        for fileName in os.listdir(self.manifestSectionDir):
+            if not fileName.endswith(".manifest"):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.manifestSectionDir, fileName))
+            except OSError:
+                continue
+            # Access times are unreliable (often not updated at all), so
+            # start out with the time the manifest was written
+            entries[fileName[:-len(".manifest")]] = LedgerEntry(stat.st_mtime, 0, [str(stat.st_size)])
+        self.ledger.compact(entries)
 
     def getManifest(self, manifestHash):
         fileName = self.manifestPath(manifestHash)
         if not os.path.exists(fileName):
             return None
         try:
-            with open(fileName, 'r') as inFile:
-                doc = json.load(inFile)
-                return Manifest([ManifestEntry(e['includeFiles'], e['includesContentHash'], e['objectHash'])
-                                 for e in doc['entries']])
-        except IOError:
+            with open(fileName, 'rb') as inFile:
+                return ManifestSection.deserializeManifest(inFile.read())
+        except (IOError, ValueError, IndexError, struct.error):
             return None
 
+    @staticmethod
+    def serializeManifest(manifest):
+        pathIndices = {}
+        hashIndices = {}
+        entriesData = []
+        for entry, usage in zip(manifest.entries(), manifest.usages()):
+            indices = array('I', [pathIndices.setdefault(p, len(pathIndices)) for p in entry.includeFiles])
+            indices.extend(hashIndices.setdefault(h, len(hashIndices)) for h in entry.includeHashes)
+            if sys.byteorder != 'little':
+                indices.byteswap()
+            entriesData.append(ManifestSection._ENTRY_HEADER.pack(
+                len(entry.includeFiles),
+                hashIndices.setdefault(entry.includesContentHash, len(hashIndices)),
+                hashIndices.setdefault(entry.objectHash, len(hashIndices)),
+                usage.hits,
+                usage.lastUsed))
+            entriesData.append(indices.tobytes())
+
+        tablesData = []
+        for indices in [pathIndices, hashIndices]:
+            table = '\n'.join(sorted(indices, key=indices.get)).encode('utf-8')
+            tablesData += [ManifestSection._TABLE_SIZE.pack(len(table)), table]
+
+        header = ManifestSection._HEADER.pack(
+            ManifestSection.MANIFEST_FILE_MAGIC, ManifestRepository.MANIFEST_FILE_FORMAT_VERSION,
+            len(manifest.entries()), manifest.clock())
+        return b''.join([header] + tablesData + entriesData)
+
+    @staticmethod
+    def _readTable(data, offset):
+        """Returns the entries of the table at offset and the offset past it"""
+        tableSize, = ManifestSection._TABLE_SIZE.unpack_from(data, offset)
+        offset += ManifestSection._TABLE_SIZE.size
+        return data[offset:offset + tableSize].decode('utf-8').split('\n'), offset + tableSize
+
+    @staticmethod
+    def deserializeManifest(data):
+        magic, version, numEntries, clock = ManifestSection._HEADER.unpack_from(data)
+        if magic != ManifestSection.MANIFEST_FILE_MAGIC or version != ManifestRepository.MANIFEST_FILE_FORMAT_VERSION:
+            raise ValueError('Unsupported manifest file format')
+        offset = ManifestSection._HEADER.size
+        paths, offset = ManifestSection._readTable(data, offset)
+        hashes, offset = ManifestSection._readTable(data, offset)
+
+        entries = []
+        usages = []
+        for _ in range(numEntries):
+            numIncludes, includesContentHashIndex, objectHashIndex, hits, lastUsed = \
+                ManifestSection._ENTRY_HEADER.unpack_from(data, offset)
+            offset += ManifestSection._ENTRY_HEADER.size
+
+            indices = array('I')
+            indicesSize = 2 * numIncludes * indices.itemsize
+            indices.frombytes(data[offset:offset + indicesSize])
+            if len(indices) != 2 * numIncludes:
+                raise ValueError('Truncated manifest file')
+            if sys.byteorder != 'little':
+                indices.byteswap()
+            offset += indicesSize
+
+            entries.append(ManifestEntry(
+                [paths[i] for i in indices[:numIncludes]],
+                [hashes[i] for i in indices[numIncludes:]],
+                hashes[includesContentHashIndex],
+                hashes[objectHashIndex]))
+            usages.append(ManifestEntryUsage(hits, lastUsed))
+        return Manifest(entries, usages, clock)
+
 
 @contextlib.contextmanager
 def allSectionsLocked(repository):
-    sections = list(repository.sections())
-    for section in sections:
-        section.lock.acquire()
+    # Sections sharing a lock (see SECTION_LOCK_PREFIX_LENGTH) lock it once
+    locks = {section.lockDir: section.lock for section in repository.sections()}
+    locks = [locks[lockDir] for lockDir in sorted(locks)]
+    for lock in locks:
+        lock.acquire()
     try:
         yield
     finally:
-        for section in sections:
-            section.lock.release()
+        for lock in reversed(locks):
+            lock.release()
+
+
+def previousLayouts(layouts):
+    # Different layouts never share section directories
+    return [layout for layout in layouts[1:] if layout != layouts[0]]
+
+
+def discardSectionIfEmpty(ledger, sectionDir):
+    """Removes a section directory of a previous shard layout once all its
+    files have been moved, requires the lock."""
+    if ledger.entries():
+        return
+    ledger.discard()
+    try:
+        os.rmdir(sectionDir)
+    except OSError:
+        # E.g. holds the sections of a nested layout
+        pass
 
 
 class ManifestRepository(object):
@@ -192,35 +787,115 @@ class ManifestRepository(object):
     # invalidation, such that a manifest that was stored using the old format is not
     # interpreted using the new format. Instead the old file will not be touched
     # again due to a new manifest hash and is cleaned away after some time.
-    MANIFEST_FILE_FORMAT_VERSION = 6
+    MANIFEST_FILE_FORMAT_VERSION = 9
 
-    def __init__(self, manifestsRootDir):
+    def __init__(self, manifestsRootDir, layouts=None):
         self._manifestsRootDir = manifestsRootDir
+        # The current shard layout, followed by the previous one while resharding
+        self._layouts = layouts or [ShardLayout()]
+
+    def _section(self, sectionDir):
+        return ManifestSection(sectionDir, ShardLayout.lockDir(self._manifestsRootDir, sectionDir))
 
     def section(self, manifestHash):
-        return ManifestSection(os.path.join(self._manifestsRootDir, manifestHash[:2]))
+        return self._section(ShardLayout.locateSectionDir(
+            self._manifestsRootDir, self._layouts, manifestHash, manifestHash + ".manifest"))
 
     def sections(self):
-        return (ManifestSection(path) for path in childDirectories(self._manifestsRootDir))
+        return (self._section(path) for path in ShardLayout.allSectionDirs(self._manifestsRootDir, self._layouts))
+
+    def relocate(self):
+        """Moves the manifests stored in the sections of previous shard layouts
+        to the sections of the current layout. Takes the lock of just one
+        section at a time, returns the number of manifests which could not be
+        moved."""
+        failures = 0
+        for layout in previousLayouts(self._layouts):
+            for sectionDir in layout.sectionDirs(self._manifestsRootDir):
+                section = self._section(sectionDir)
+                with section.lock:
+                    section.foldAccessJournal()
+                    if not section.ledger.exists():
+                        section.rebuildLedger()
+                    entries = section.ledger.entries()
+                    manifestHashes = [fileName[:-len(".manifest")] for fileName in os.listdir(sectionDir)
+                                      if fileName.endswith(".manifest")]
+                    for manifestHash in manifestHashes:
+                        # The section of the current layout has the same lock
+                        target = self._section(self._layouts[0].sectionDir(self._manifestsRootDir, manifestHash))
+                        manifestPath = section.manifestPath(manifestHash)
+                        entry = entries.pop(manifestHash, None) or LedgerEntry(
+                            os.stat(manifestPath).st_mtime, 0, [str(os.path.getsize(manifestPath))])
+                        ensureDirectoryExists(target.manifestSectionDir)
+                        try:
+                            replaceFile(manifestPath, target.manifestPath(manifestHash))
+                        except OSError:
+                            failures += 1
+                            continue
+                        target.ledger.recordWrite(manifestHash, entry.fields, entry.lastUsed, entry.uses)
+                        section.ledger.recordRemoval(manifestHash)
+                    section.ledger.compact()
+                    discardSectionIfEmpty(section.ledger, sectionDir)
+        return failures
+
+    def rebuildLedgers(self):
+        for section in self.sections():
+            section.rebuildLedger()
 
     def clean(self, maxManifestsSize):
-        manifestFileInfos = []
+        """Removes the least recently used manifests, returns the size of the
+        remaining ones. Takes the lock of just one section at a time."""
+        _, remainingObjectsSize = self._clean(maxManifestsSize)
+        return remainingObjectsSize
+
+    def cleanIncrementally(self, maxManifestsSize):
+        """Like clean(), but returns the size of the removed manifests since
+        concurrent clcache invocations may add manifests meanwhile."""
+        totalObjectsSize, remainingObjectsSize = self._clean(maxManifestsSize)
+        return totalObjectsSize - remainingObjectsSize
+
+    def _clean(self, maxManifestsSize):
+        manifestInfos = []
         for section in self.sections():
-            for filePath in section.manifestFiles():
+            if not section.ledger.exists() or os.path.exists(section.accessJournalPath()):
+                with section.lock:
+                    # Recorded accesses determine which manifests are evicted.
+                    # Sections written by older clcache versions have no ledger
+                    # yet.
+                    section.foldAccessJournal()
+                    if not section.ledger.exists():
+                        section.rebuildLedger()
+            with section.sharedLock:
+                recordedEntries = section.ledger.entries()
+            for manifestHash, entry in recordedEntries.items():
                 try:
-                    manifestFileInfos.append((os.stat(filePath), filePath))
-                except OSError:
-                    pass
+                    manifestInfos.append((entry, int(entry.fields[0]), manifestHash, section))
+                except (IndexError, ValueError):
+                    # Recorded by an interrupted clcache invocation
+                    continue
 
-        manifestFileInfos.sort(key=lambda t: t[0].st_atime, reverse=True)
+        manifestInfos.sort(key=lambda t: t[0].lastUsed, reverse=True)
 
         remainingObjectsSize = 0
-        for stat, filepath in manifestFileInfos:
-            if remainingObjectsSize + stat.st_size <= maxManifestsSize:
-                remainingObjectsSize += stat.st_size
+        victimsBySection = defaultdict(list)
+        for entry, size, manifestHash, section in manifestInfos:
+            if remainingObjectsSize + size <= maxManifestsSize:
+                remainingObjectsSize += size
             else:
-                os.remove(filepath)
-        return remainingObjectsSize
+                victimsBySection[section.manifestSectionDir].append((entry, size, manifestHash, section))
+
+        for victims in victimsBySection.values():
+            section = victims[0][3]
+            with section.lock:
+                section.foldAccessJournal()
+                recordedEntries = section.ledger.entries()
+                for entry, size, manifestHash, _ in victims:
+                    # Keep manifests which were written or used meanwhile, and
+                    # the ones being read by a concurrent clcache invocation
+                    if recordedEntries.get(manifestHash) != entry or not section.removeManifest(manifestHash):
+                        remainingObjectsSize += size
+                section.ledger.compact()
+        return sum(size for _, size, _, _ in manifestInfos), remainingObjectsSize
 
     @staticmethod
     def getManifestHash(compilerBinary, commandLine, sourceFile):
@@ -233,170 +908,820 @@ class ManifestRepository(object):
         # defines how many compiler processes are running simultaneusly.
         commandLine = [arg for arg in commandLine if not arg.startswith("/MP")]
 
-        additionalData = "{}|{}|{}".format(
-            compilerHash, commandLine, ManifestRepository.MANIFEST_FILE_FORMAT_VERSION)
+        additionalData = "{}|{}|{}|{}".format(
+            compilerHash, commandLine, ManifestRepository.MANIFEST_FILE_FORMAT_VERSION, hashAlgorithmName())
         return getFileHash(sourceFile, additionalData)
 
     @staticmethod
-    def getIncludesContentHashForFiles(includes):
+    def getIncludesContentHashForFiles(includes, fileHashIndex=None):
         try:
-            listOfHashes = [getFileHash(path) for path in includes]
+            listOfHashes = getFileHashes(includes, fileHashIndex)
         except FileNotFoundError:
             raise IncludeNotFoundException
         return ManifestRepository.getIncludesContentHashForHashes(listOfHashes)
 
     @staticmethod
     def getIncludesContentHashForHashes(listOfHashes):
-        return HashAlgorithm(','.join(listOfHashes).encode()).hexdigest()
+        return newHasher(','.join(listOfHashes).encode()).hexdigest()
 
 
 class CacheLock(object):
     """ Implements a lock for the object cache which
-    can be used in 'with' statements. """
+    can be used in 'with' statements. Like mutexes on Windows, the locks
+    may be acquired recursively by the thread holding them.
+
+    The time spent waiting for and holding named locks is collected per
+    process, until recorded in the lock statistics. """
     INFINITE = 0xFFFFFFFF
+
+    _timings = {}
+    _timingsLock = threading.Lock()
+
+    def __init__(self, lockName, timeoutMs, name=None):
+        self._lockName = lockName
+        self._timeoutMs = timeoutMs
+        self.name = name
+        self._acquisitionTimes = []
+
+    def __enter__(self):
+        self.acquire()
+
+    def __exit__(self, typ, value, traceback):
+        self.release()
+
+    def acquire(self):
+        start = time.time()
+        try:
+            self._acquire()
+        except CacheLockException:
+            self._recordTiming(LockTiming(0, 1, time.time() - start, 0.0))
+            raise
+        self._acquisitionTimes.append((start, time.time()))
+
+    def release(self):
+        start, acquired = self._acquisitionTimes.pop()
+        self._release()
+        released = time.time()
+        self._recordTiming(LockTiming(1, 0, acquired - start, released - acquired))
+
+    def _acquire(self):
+        raise NotImplementedError
+
+    def _release(self):
+        raise NotImplementedError
+
+    def _recordTiming(self, timing):
+        if self.name is None:
+            return
+        with CacheLock._timingsLock:
+            CacheLock._timings[self.name] = addLockTimings(CacheLock._timings.get(self.name), timing)
+
+    @staticmethod
+    def takeTimings():
+        """Returns the timings collected since the last call, by lock name."""
+        with CacheLock._timingsLock:
+            timings, CacheLock._timings = CacheLock._timings, {}
+        return timings
+
+    def _timeoutError(self):
+        return CacheLockException(
+            'Failed to acquire lock {} after {}ms; '
+            'try setting CLCACHE_OBJECT_CACHE_TIMEOUT_MS environment variable to a larger value.'.format(
+                self._lockName, self._timeoutMs))
+
+    @staticmethod
+    def _defaultTimeoutMs(timeoutMs):
+        return objectCacheTimeoutMs() if timeoutMs is None else timeoutMs
+
+    @staticmethod
+    def _timingName(path):
+        # e.g. 'objects/ab' for the lock of a cache section
+        return '/'.join([os.path.basename(os.path.dirname(path)), os.path.basename(path)])
+
+    @staticmethod
+    def forPath(path, timeoutMs=None, timed=True):
+        timeoutMs = CacheLock._defaultTimeoutMs(timeoutMs)
+        name = CacheLock._timingName(path) if timed else None
+        if sys.platform == 'win32':
+            lockName = path.replace(':', '-').replace('\\', '-')
+            return MutexCacheLock(lockName, timeoutMs, name)
+        return FileCacheLock(path + '.lock', timeoutMs, name)
+
+    @staticmethod
+    def forSection(sectionDir, shared=False, timeoutMs=None):
+        """Returns a reader-writer lock for a cache section: any number of
+        processes may hold the shared lock, the exclusive lock excludes all
+        others. Processes waiting for the exclusive lock keep new readers
+        out, so writers do not starve."""
+        return FileCacheLock(sectionDir + '.lock', CacheLock._defaultTimeoutMs(timeoutMs),
+                             CacheLock._timingName(sectionDir), shared=shared,
+                             turnstilePath=sectionDir + '.turnstile')
+
+
+class MutexCacheLock(CacheLock):
+    """ Lock based on a named Windows mutex. """
     WAIT_ABANDONED_CODE = 0x00000080
     WAIT_TIMEOUT_CODE = 0x00000102
 
-    def __init__(self, mutexName, timeoutMs):
-        self._mutexName = 'Local\\' + mutexName
+    def __init__(self, mutexName, timeoutMs, name=None):
+        super(MutexCacheLock, self).__init__('Local\\' + mutexName, timeoutMs, name)
         self._mutex = None
-        self._timeoutMs = timeoutMs
 
     def createMutex(self):
         self._mutex = windll.kernel32.CreateMutexW(
             None,
             wintypes.BOOL(False),
-            self._mutexName)
+            self._lockName)
         assert self._mutex
 
-    def __enter__(self):
-        self.acquire()
-
-    def __exit__(self, typ, value, traceback):
-        self.release()
-
     def __del__(self):
         if self._mutex:
             windll.kernel32.CloseHandle(self._mutex)
 
-    def acquire(self):
+    def _acquire(self):
         if not self._mutex:
             self.createMutex()
         result = windll.kernel32.WaitForSingleObject(
             self._mutex, wintypes.INT(self._timeoutMs))
         if result not in [0, self.WAIT_ABANDONED_CODE]:
             if result == self.WAIT_TIMEOUT_CODE:
-                errorString = \
-                    'Failed to acquire lock {} after {}ms; ' \
-                    'try setting CLCACHE_OBJECT_CACHE_TIMEOUT_MS environment variable to a larger value.'.format(
-                        self._mutexName, self._timeoutMs)
-            else:
-                errorString = 'Error! WaitForSingleObject returns {result}, last error {error}'.format(
-                    result=result,
-                    error=windll.kernel32.GetLastError())
+                raise self._timeoutError()
+            errorString = 'Error! WaitForSingleObject returns {result}, last error {error}'.format(
+                result=result,
+                error=windll.kernel32.GetLastError())
             raise CacheLockException(errorString)
 
-    def release(self):
+    def _release(self):
         windll.kernel32.ReleaseMutex(self._mutex)
 
-    @staticmethod
-    def forPath(path):
-        timeoutMs = int(os.environ.get('CLCACHE_OBJECT_CACHE_TIMEOUT_MS', 10 * 1000))
-        lockName = path.replace(':', '-').replace('\\', '-')
-        return CacheLock(lockName, timeoutMs)
+
+if sys.platform == 'win32':
+    LOCKFILE_FAIL_IMMEDIATELY = 0x00000001
+    LOCKFILE_EXCLUSIVE_LOCK = 0x00000002
+    ERROR_LOCK_VIOLATION = 33
+
+    class Overlapped(Structure):
+        # pylint: disable=too-few-public-methods
+        _fields_ = [
+            ('Internal', c_void_p),
+            ('InternalHigh', c_void_p),
+            ('Offset', wintypes.DWORD),
+            ('OffsetHigh', wintypes.DWORD),
+            ('hEvent', wintypes.HANDLE),
+        ]
+
+    def tryLockFile(fd, shared):
+        flags = LOCKFILE_FAIL_IMMEDIATELY | (0 if shared else LOCKFILE_EXCLUSIVE_LOCK)
+        if windll.kernel32.LockFileEx(msvcrt.get_osfhandle(fd), flags, 0, 1, 0, byref(Overlapped())):
+            return True
+        error = windll.kernel32.GetLastError()
+        if error == ERROR_LOCK_VIOLATION:
+            return False
+        raise OSError(error, 'LockFileEx failed')
+
+    def unlockFile(fd):
+        windll.kernel32.UnlockFileEx(msvcrt.get_osfhandle(fd), 0, 1, 0, byref(Overlapped()))
+else:
+    def tryLockFile(fd, shared):
+        try:
+            fcntl.flock(fd, (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+            return True
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return False
+            raise
+
+    def unlockFile(fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+
+
+class FileCacheLock(CacheLock):
+    """ Lock based on locking a lock file, either exclusively or shared with
+    other readers. File locks are owned by open files rather than threads, so
+    all locks of a process on the same lock file share one open file, guarded
+    by a re-entrant lock for the threads of the process. While a process holds
+    the lock, it may acquire it again in the same mode or shared, but it
+    cannot upgrade a shared lock. The lock is released if the process holding
+    it dies, just like abandoned mutexes.
+
+    Readers and writers may pass a turnstile file, which they hold while
+    waiting for the lock file, so that waiting writers keep new readers out. """
+    _states = {}
+    _statesLock = threading.Lock()
+
+    class _State(object):
+        def __init__(self):
+            self.threadLock = threading.RLock()
+            self.fd = None
+            self.shared = False
+            self.count = 0
+
+    def __init__(self, lockPath, timeoutMs, name=None, shared=False, turnstilePath=None):
+        super(FileCacheLock, self).__init__(lockPath, timeoutMs, name)
+        self._shared = shared
+        self._turnstilePath = turnstilePath
+        with FileCacheLock._statesLock:
+            self._state = FileCacheLock._states.setdefault(lockPath, FileCacheLock._State())
+
+    def _acquire(self):
+        if self._timeoutMs == CacheLock.INFINITE:
+            deadline = None
+        else:
+            deadline = time.time() + self._timeoutMs / 1000.0
+
+        state = self._state
+        if not state.threadLock.acquire(timeout=-1 if deadline is None else self._timeoutMs / 1000.0):
+            raise self._timeoutError()
+        acquired = False
+        try:
+            if state.count == 0:
+                state.fd = self._lockFiles(deadline)
+                state.shared = self._shared
+            elif state.shared and not self._shared:
+                raise LogicException("Cannot upgrade shared lock {} to an exclusive one".format(self._lockName))
+            state.count += 1
+            acquired = True
+        finally:
+            if not acquired:
+                state.threadLock.release()
+
+    def _lockFiles(self, deadline):
+        if self._turnstilePath is None:
+            return self._lockFile(self._lockName, self._shared, deadline)
+
+        turnstile = self._lockFile(self._turnstilePath, False, deadline)
+        try:
+            return self._lockFile(self._lockName, self._shared, deadline)
+        finally:
+            unlockFile(turnstile)
+            os.close(turnstile)
+
+    def _lockFile(self, path, shared, deadline):
+        ensureDirectoryExists(os.path.dirname(path))
+        fd = os.open(path, os.O_RDWR | os.O_CREAT)
+        locked = False
+        try:
+            delay = 0.001
+            while True:
+                try:
+                    locked = tryLockFile(fd, shared)
+                except OSError as e:
+                    raise CacheLockException('Error! Locking {} fails: {}'.format(path, e))
+                if locked:
+                    return fd
+                if deadline is not None and time.time() >= deadline:
+                    raise self._timeoutError()
+                time.sleep(delay if deadline is None else max(0, min(delay, deadline - time.time())))
+                delay = min(delay * 2, LOCK_POLL_INTERVAL)
+        finally:
+            if not locked:
+                os.close(fd)
+
+    def _release(self):
+        state = self._state
+        state.count -= 1
+        if state.count == 0:
+            unlockFile(state.fd)
+            os.close(state.fd)
+            state.fd = None
+        state.threadLock.release()
+
+
+class BlobStore(object):
+    """Stores object files by the hash of their contents, so that identical
+    object files (e.g. if just a comment in the source file changed) are
+    stored only once. Blobs are added while holding the lock of the section
+    of the referencing cache entry. Cleaning the cache removes blobs which no
+    cache entry references; the incremental cleaner does not hold the locks of
+    all sections, so it spares blobs which were (re-)added after it started.
+    Adding a blob which exists already marks it as used."""
+    def __init__(self, blobsRootDir, fileCopier=None, layouts=None):
+        self.blobsRootDir = blobsRootDir
+        self.fileCopier = fileCopier or FileCopier()
+        # The current shard layout, followed by the previous one while resharding
+        self._layouts = layouts or [ShardLayout()]
+
+    def blobPath(self, blobName):
+        sectionDir = ShardLayout.locateSectionDir(self.blobsRootDir, self._layouts, blobName, blobName)
+        return os.path.join(sectionDir, blobName)
+
+    def blobs(self):
+        for sectionDir in ShardLayout.allSectionDirs(self.blobsRootDir, self._layouts):
+            for blobName in os.listdir(sectionDir):
+                if not ShardLayout.isSectionDirName(blobName):
+                    yield blobName
+
+    def relocate(self):
+        """Moves the blobs stored in the directories of previous shard layouts
+        to the ones of the current layout, returns the number of blobs which
+        could not be moved."""
+        failures = 0
+        for layout in previousLayouts(self._layouts):
+            for sectionDir in layout.sectionDirs(self.blobsRootDir):
+                for blobName in os.listdir(sectionDir):
+                    if ShardLayout.isSectionDirName(blobName) or blobName.endswith('.tmp'):
+                        continue
+                    targetDir = self._layouts[0].sectionDir(self.blobsRootDir, blobName)
+                    with self.lock(blobName):
+                        ensureDirectoryExists(targetDir)
+                        try:
+                            replaceFile(os.path.join(sectionDir, blobName), os.path.join(targetDir, blobName))
+                        except FileNotFoundError:
+                            pass
+                        except OSError:
+                            failures += 1
+                try:
+                    os.rmdir(sectionDir)
+                except OSError:
+                    # E.g. holds the directories of a nested layout
+                    pass
+        return failures
+
+    def addBlob(self, filePath, compression=None):
+        """Returns the name of the blob and the number of bytes newly stored.
+
+        The name of a blob is the hash of the (uncompressed) file contents,
+        plus the compression method as the extension if compressed."""
+        blobName = getFileHash(filePath)
+        if compression is not None:
+            blobName += '.' + compression
+        blobPath = self.blobPath(blobName)
+        with self.lock(blobName):
+            try:
+                os.utime(blobPath, None)
+                return blobName, 0
+            except FileNotFoundError:
+                pass
+
+        # Concurrent invocations may add the same blob for different cache
+        # entries, so use a unique temporary file.
+        ensureDirectoryExists(os.path.dirname(blobPath))
+        tempPath = '{}.{}.tmp'.format(blobPath, os.getpid())
+        try:
+            if compression is not None:
+                compressFile(filePath, tempPath, compression, compressionLevel(compression))
+            else:
+                copyOrLink(filePath, tempPath, self.fileCopier)
+            replaceFile(tempPath, blobPath)
+        finally:
+            if os.path.exists(tempPath):
+                os.remove(tempPath)
+        return blobName, os.path.getsize(blobPath)
+
+    def blobSize(self, blobName):
+        try:
+            return os.path.getsize(self.blobPath(blobName))
+        except OSError:
+            return 0
+
+    def removeBlob(self, blobName):
+        removeFileIfExists(self.blobPath(blobName))
+
+    def removeBlobIfUnusedSince(self, blobName, timestamp):
+        """Removes the blob unless it was added or marked as used at or after
+        timestamp, as returned by fileSystemTime(). Returns whether the blob is
+        gone."""
+        blobPath = self.blobPath(blobName)
+        with self.lock(blobName):
+            try:
+                if os.stat(blobPath).st_mtime >= timestamp:
+                    return False
+                os.remove(blobPath)
+            except FileNotFoundError:
+                pass
+            except OSError:
+                # Being read by a concurrent clcache invocation right now
+                return False
+        return True
+
+    def lock(self, blobName):
+        return CacheLock.forPath(os.path.join(self.blobsRootDir, blobName[:SECTION_LOCK_PREFIX_LENGTH]))
+
+    def fileSystemTime(self):
+        """Returns the current time with the clock and granularity of the
+        modification times of blobs"""
+        ensureDirectoryExists(self.blobsRootDir)
+        markerPath = os.path.join(self.blobsRootDir, "clock.marker")
+        with open(markerPath, 'a'):
+            pass
+        os.utime(markerPath, None)
+        return os.stat(markerPath).st_mtime
 
 
 class CompilerArtifactsSection(object):
-    def __init__(self, compilerArtifactsSectionDir):
+    # Each cache entry is a single file, consisting of a header followed by
+    # the name of the blob storing the object file, the output and the error
+    # output of the compiler. Entries using a different format (e.g. the
+    # directories used by older clcache versions) are never read, but
+    # recreated when needed and removed when cleaning the cache.
+    ENTRY_FILE_MAGIC = b'CLCE'
+    ENTRY_FILE_FORMAT_VERSION = 2
+    # magic, file format version, size of the object file, seconds it took to
+    # compile it, lengths of the blob name, the output and the error output
+    _HEADER = struct.Struct('<4sIQdIII')
+
+    def __init__(self, compilerArtifactsSectionDir, blobStore, lockDir=None):
         self.compilerArtifactsSectionDir = compilerArtifactsSectionDir
-        self.lock = CacheLock.forPath(self.compilerArtifactsSectionDir)
+        self.blobStore = blobStore
+        self.lockDir = lockDir or compilerArtifactsSectionDir
+        self.lock = CacheLock.forSection(self.lockDir)
+        self.sharedLock = CacheLock.forSection(self.lockDir, shared=True)
+        self.ledger = SectionLedger(self.compilerArtifactsSectionDir)
 
-    def cacheEntryDir(self, key):
-        return os.path.join(self.compilerArtifactsSectionDir, key)
+    def cacheEntryPath(self, key):
+        return os.path.join(self.compilerArtifactsSectionDir, key + ".entry")
 
     def cacheEntries(self):
-        return childDirectories(self.compilerArtifactsSectionDir, absolute=False)
-
-    def cachedObjectName(self, key):
-        return os.path.join(self.cacheEntryDir(key), "object")
+        return [name[:-len(".entry")] for name in os.listdir(self.compilerArtifactsSectionDir)
+                if name.endswith(".entry")]
+
+    def staleFiles(self):
+        """Returns the paths of everything but cache entries in the section,
+        i.e. cache entries of older clcache versions and temporary files of
+        interrupted clcache invocations (but not the section directories of a
+        nested shard layout)"""
+        return [os.path.join(self.compilerArtifactsSectionDir, name)
+                for name in os.listdir(self.compilerArtifactsSectionDir)
+                if not name.endswith(".entry") and not SectionLedger.isLedgerFile(name)
+                and not ShardLayout.isSectionDirName(name)]
 
     def hasEntry(self, key):
-        return os.path.exists(self.cacheEntryDir(key))
+        return os.path.exists(self.cacheEntryPath(key))
 
-    def setEntry(self, key, artifacts):
-        ensureDirectoryExists(self.cacheEntryDir(key))
+    def setEntry(self, key, artifacts, compileDuration=0.0):
+        """Returns the number of bytes newly stored for the object file"""
+        blobName, objectSize, storedSize, blobSize = '', 0, 0, 0
         if artifacts.objectFilePath is not None:
-            copyOrLink(artifacts.objectFilePath, self.cachedObjectName(key))
-        self._setCachedCompilerConsoleOutput(key, 'output.txt', artifacts.stdout)
-        if artifacts.stderr != '':
-            self._setCachedCompilerConsoleOutput(key, 'stderr.txt', artifacts.stderr)
+            blobName, storedSize = self.blobStore.addBlob(artifacts.objectFilePath, compressionMethod())
+            objectSize = os.path.getsize(artifacts.objectFilePath)
+            blobSize = storedSize or self.blobStore.blobSize(blobName)
+
+        # Cache hits do not take the section lock, so entries are published
+        # atomically
+        ensureDirectoryExists(self.compilerArtifactsSectionDir)
+        writeFileAtomically(
+            self.cacheEntryPath(key),
+            CompilerArtifactsSection.serializeEntry(
+                blobName, objectSize, compileDuration, artifacts.stdout, artifacts.stderr))
+        self.ledger.recordWrite(
+            key, CompilerArtifactsSection._ledgerFields(blobName, blobSize, objectSize, compileDuration))
+        return storedSize
+
+    def removeEntry(self, key):
+        # Returns False if the entry could not be removed because it is being
+        # read right now (Windows refuses to delete open files).
+        try:
+            os.remove(self.cacheEntryPath(key))
+        except FileNotFoundError:
+            pass
+        except OSError:
+            return False
+        self.ledger.recordRemoval(key)
+        return True
+
+    def recordedEntries(self):
+        """Returns a dict mapping the keys of the entries recorded in the
+        ledger to RecordedCacheEntry values"""
+        entries = {}
+        for key, entry in self.ledger.entries().items():
+            try:
+                blobName, blobSize, objectSize, compileDuration = entry.fields
+                entries[key] = RecordedCacheEntry(
+                    entry.lastUsed, entry.uses, None if blobName == '-' else blobName,
+                    int(blobSize), int(objectSize), float(compileDuration))
+            except ValueError:
+                # Recorded by an interrupted clcache invocation
+                continue
+        return entries
+
+    def rebuildLedger(self):
+        """Reconstructs the ledger from the cache entries, removing stale
+        files and unusable entries on the way. Requires the lock."""
+        for path in self.staleFiles():
+            if os.path.isdir(path):
+                rmtree(path, ignore_errors=True)
+            else:
+                removeFileIfExists(path)
+
+        entries = {}
+        for key in self.cacheEntries():
+            entry = self.readEntry(key)
+            if entry is None:
+                # Unusable, e.g. written by a future clcache version
+                self.removeEntry(key)
+                continue
+            try:
+                # Not the access time, which is often not updated at all
+                lastUsed = os.stat(self.cacheEntryPath(key)).st_mtime
+            except OSError:
+                continue
+            blobName, objectSize, _, _, compileDuration = entry
+            blobSize = self.blobStore.blobSize(blobName) if blobName is not None else 0
+            entries[key] = LedgerEntry(
+                lastUsed, 0, CompilerArtifactsSection._ledgerFields(blobName, blobSize, objectSize, compileDuration))
+        self.ledger.compact(entries)
 
-    def getEntry(self, key):
-        assert self.hasEntry(key)
-        return CompilerArtifacts(
-            self.cachedObjectName(key),
-            self._getCachedCompilerConsoleOutput(key, 'output.txt'),
-            self._getCachedCompilerConsoleOutput(key, 'stderr.txt')
-            )
-
-    def _getCachedCompilerConsoleOutput(self, key, fileName):
+    @staticmethod
+    def _ledgerFields(blobName, blobSize, objectSize, compileDuration):
+        return [blobName or '-', str(blobSize), str(objectSize), '{:.3f}'.format(compileDuration)]
+
+    def readEntry(self, key):
+        """Returns the name of the blob storing the object file (None if there
+        is no object file), the size of the object file, the output, the error
+        output and the compile duration. Returns None if there is no usable
+        entry."""
         try:
-            outputFilePath = os.path.join(self.cacheEntryDir(key), fileName)
-            with open(outputFilePath, 'rb') as f:
-                return f.read().decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
-        except IOError:
-            return ''
+            with open(self.cacheEntryPath(key), 'rb') as f:
+                return CompilerArtifactsSection.deserializeEntry(f.read())
+        except (IOError, ValueError, struct.error):
+            return None
+
+    def getEntry(self, key):
+        entry = self.readEntry(key)
+        if entry is None:
+            return None
+        blobName, _, stdout, stderr, _ = entry
+        objectFilePath = self.blobStore.blobPath(blobName) if blobName is not None else None
+        return CompilerArtifacts(objectFilePath, stdout, stderr)
 
-    def _setCachedCompilerConsoleOutput(self, key, fileName, output):
-        outputFilePath = os.path.join(self.cacheEntryDir(key), fileName)
-        with open(outputFilePath, 'wb') as f:
-            f.write(output.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC))
+    @staticmethod
+    def serializeEntry(blobName, objectSize, compileDuration, stdout, stderr):
+        fields = [
+            blobName.encode('ascii'),
+            stdout.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
+            stderr.encode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC),
+        ]
+        header = CompilerArtifactsSection._HEADER.pack(
+            CompilerArtifactsSection.ENTRY_FILE_MAGIC, CompilerArtifactsSection.ENTRY_FILE_FORMAT_VERSION,
+            objectSize, compileDuration, *[len(field) for field in fields])
+        return header + b''.join(fields)
+
+    @staticmethod
+    def deserializeEntry(data):
+        header = CompilerArtifactsSection._HEADER
+        magic, version, objectSize, compileDuration, blobNameLength, stdoutLength, stderrLength = \
+            header.unpack_from(data)
+        if magic != CompilerArtifactsSection.ENTRY_FILE_MAGIC \
+                or version != CompilerArtifactsSection.ENTRY_FILE_FORMAT_VERSION:
+            raise ValueError('Unsupported cache entry format')
+        if len(data) != header.size + blobNameLength + stdoutLength + stderrLength:
+            raise ValueError('Truncated cache entry')
+
+        offset = header.size
+        blobName = data[offset:offset + blobNameLength].decode('ascii')
+        offset += blobNameLength
+        stdout = data[offset:offset + stdoutLength].decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
+        offset += stdoutLength
+        stderr = data[offset:offset + stderrLength].decode(CACHE_COMPILER_OUTPUT_STORAGE_CODEC)
+        return blobName or None, objectSize, stdout, stderr, compileDuration
+
+
+class InflationHistory(object):
+    """The inflation value L of the GreedyDual-Size-Frequency eviction policy
+    over time. L is raised to the priority of each evicted cache entry, and
+    the priority of an entry is the value of L at its last use plus the
+    compile time it saves per byte of cache. Thus, entries which were not
+    used for a long time lose their advantage over recently used ones."""
+    def __init__(self, historyFile):
+        self._historyFile = historyFile
+        try:
+            with open(self._historyFile, 'r') as f:
+                self._history = json.load(f)
+        except (IOError, ValueError):
+            self._history = []
+        self._value = self._history[-1][1] if self._history else 0.0
+
+    def valueAt(self, timestamp):
+        index = bisect.bisect_right([t for t, _ in self._history], timestamp)
+        return self._history[index - 1][1] if index > 0 else 0.0
+
+    def raiseTo(self, value):
+        self._value = max(self._value, value)
+
+    def save(self, lastUseTimes):
+        """Records the current value, forgetting values which no last use
+        time of a cache entry refers to anymore"""
+        if not self._history or self._value > self._history[-1][1]:
+            self._history.append([time.time(), self._value])
+        if lastUseTimes:
+            firstNeeded = bisect.bisect_right([t for t, _ in self._history], min(lastUseTimes)) - 1
+            self._history = self._history[max(firstNeeded, 0):]
+        writeFileAtomically(self._historyFile, json.dumps(self._history).encode('utf-8'))
 
 
 class CompilerArtifactsRepository(object):
-    def __init__(self, compilerArtifactsRootDir):
+    def __init__(self, compilerArtifactsRootDir, blobStore, layouts=None):
         self._compilerArtifactsRootDir = compilerArtifactsRootDir
+        self._blobStore = blobStore
+        # The current shard layout, followed by the previous one while resharding
+        self._layouts = layouts or [ShardLayout()]
+
+    @property
+    def blobStore(self):
+        return self._blobStore
+
+    def _section(self, sectionDir):
+        return CompilerArtifactsSection(
+            sectionDir, self._blobStore, ShardLayout.lockDir(self._compilerArtifactsRootDir, sectionDir))
 
     def section(self, key):
-        return CompilerArtifactsSection(os.path.join(self._compilerArtifactsRootDir, key[:2]))
+        return self._section(ShardLayout.locateSectionDir(
+            self._compilerArtifactsRootDir, self._layouts, key, key + ".entry"))
 
     def sections(self):
-        return (CompilerArtifactsSection(path) for path in childDirectories(self._compilerArtifactsRootDir))
+        return (self._section(path)
+                for path in ShardLayout.allSectionDirs(self._compilerArtifactsRootDir, self._layouts))
+
+    def relocate(self):
+        """Moves the cache entries stored in the sections of previous shard
+        layouts to the sections of the current layout. Takes the lock of just
+        one section at a time, returns the number of cache entries which
+        could not be moved."""
+        failures = 0
+        for layout in previousLayouts(self._layouts):
+            for sectionDir in layout.sectionDirs(self._compilerArtifactsRootDir):
+                section = self._section(sectionDir)
+                with section.lock:
+                    entries = section.ledger.entries()
+                    if any(key not in entries for key in section.cacheEntries()):
+                        # E.g. the ledger got lost
+                        section.rebuildLedger()
+                        entries = section.ledger.entries()
+                    for key in section.cacheEntries():
+                        # The section of the current layout has the same lock
+                        target = self._section(self._layouts[0].sectionDir(self._compilerArtifactsRootDir, key))
+                        ensureDirectoryExists(target.compilerArtifactsSectionDir)
+                        try:
+                            replaceFile(section.cacheEntryPath(key), target.cacheEntryPath(key))
+                        except OSError:
+                            failures += 1
+                            continue
+                        if key in entries:
+                            entry = entries[key]
+                            target.ledger.recordWrite(key, entry.fields, entry.lastUsed, entry.uses)
+                        section.ledger.recordRemoval(key)
+                    section.ledger.compact()
+                    discardSectionIfEmpty(section.ledger, sectionDir)
+        return failures
 
     def removeEntry(self, keyToBeRemoved):
-        compilerArtifactsDir = self.section(keyToBeRemoved).cacheEntryDir(keyToBeRemoved)
-        rmtree(compilerArtifactsDir, ignore_errors=True)
+        return self.section(keyToBeRemoved).removeEntry(keyToBeRemoved)
 
-    def clean(self, maxCompilerArtifactsSize):
+    def rebuildLedgers(self):
+        """Reconstructs the ledgers of all sections by walking the whole
+        repository, and removes the blobs which no cache entry references,
+        e.g. because of interrupted clcache invocations."""
+        referencedBlobs = set()
+        for section in self.sections():
+            section.rebuildLedger()
+            referencedBlobs.update(entry.blobName for entry in section.recordedEntries().values())
+
+        for blobName in list(self._blobStore.blobs()):
+            if blobName not in referencedBlobs:
+                self._blobStore.removeBlob(blobName)
+
+    def clean(self, maxCompilerArtifactsSize, evictionPolicy=EVICTION_POLICY_LRU):
+        """Returns the number of remaining entries, the size of the stored
+        objects and the total size of the objects of all entries. Requires the
+        locks of all sections."""
+        _, remaining = self._clean(maxCompilerArtifactsSize, evictionPolicy, None)
+        return remaining
+
+    def cleanIncrementally(self, maxCompilerArtifactsSize, evictionPolicy=EVICTION_POLICY_LRU):
+        """Like clean(), but takes the lock of just one section at a time, so
+        that concurrent clcache invocations can carry on. Since these may add
+        entries meanwhile, returns the number of removed entries, the size of
+        the removed objects and the total size of the objects of the removed
+        entries instead."""
+        totals, remaining = self._clean(maxCompilerArtifactsSize, evictionPolicy, self._blobStore.fileSystemTime())
+        return tuple(total - left for total, left in zip(totals, remaining))
+
+    def _clean(self, maxCompilerArtifactsSize, evictionPolicy, cleaningStarted):
+        """Returns the number of entries, the size of the stored objects and
+        the total size of the objects of all entries as recorded before
+        cleaning, and the same values after cleaning."""
+        objectInfos, blobReferences, blobSizes = self._recordedObjects()
+
+        if evictionPolicy == EVICTION_POLICY_GDSF:
+            inflation = self._inflationHistory()
+            priorities = {cachekey: inflation.valueAt(entry.lastUsed) + self._gdsfValue(entry)
+                          for entry, cachekey, _ in objectInfos}
+            objectInfos.sort(key=lambda t: (priorities[t[1]], t[0].lastUsed))
+        else:
+            objectInfos.sort(key=lambda t: t[0].lastUsed)
+
+        # compute real current size to fix up the stored cacheSize, taking
+        # into account that blobs are stored only once
+        totals = (len(objectInfos), sum(blobSizes.values()), sum(entry.objectSize for entry, _, _ in objectInfos))
+
+        removedObjectInfos = CompilerArtifactsRepository._removeEntries(
+            CompilerArtifactsRepository._chooseVictims(objectInfos, blobReferences, blobSizes,
+                                                       maxCompilerArtifactsSize))
+        for entry, _, _ in removedObjectInfos:
+            if entry.blobName is not None:
+                blobReferences[entry.blobName] -= 1
+        removedSize = self._removeUnreferencedBlobs(blobReferences, blobSizes, cleaningStarted)
+
+        if evictionPolicy == EVICTION_POLICY_GDSF:
+            for _, cachekey, _ in removedObjectInfos:
+                inflation.raiseTo(priorities[cachekey])
+            inflation.save([entry.lastUsed for entry, _, _ in objectInfos])
+
+        remaining = (totals[0] - len(removedObjectInfos), totals[1] - removedSize,
+                     totals[2] - sum(entry.objectSize for entry, _, _ in removedObjectInfos))
+        return totals, remaining
+
+    def _recordedObjects(self):
+        """Returns the recorded cache entries along with their sections, the
+        number of entries referencing each blob and the sizes of the blobs"""
         objectInfos = []
+        # Counting references while cleaning means they cannot get out of
+        # sync due to interrupted clcache invocations.
+        blobReferences = defaultdict(int)
+        blobSizes = {}
         for section in self.sections():
-            for cachekey in section.cacheEntries():
-                try:
-                    objectStat = os.stat(section.cachedObjectName(cachekey))
-                    objectInfos.append((objectStat, cachekey))
-                except OSError:
-                    pass
-
-        objectInfos.sort(key=lambda t: t[0].st_atime)
+            if not section.ledger.exists():
+                with section.lock:
+                    # Sections written by older clcache versions have no ledger yet
+                    if not section.ledger.exists():
+                        section.rebuildLedger()
+            with section.sharedLock:
+                recordedEntries = section.recordedEntries()
+            for cachekey, entry in recordedEntries.items():
+                objectInfos.append((entry, cachekey, section))
+                if entry.blobName is not None:
+                    blobReferences[entry.blobName] += 1
+                    blobSizes[entry.blobName] = entry.blobSize
+        return objectInfos, blobReferences, blobSizes
 
-        # compute real current size to fix up the stored cacheSize
-        currentSizeObjects = sum(x[0].st_size for x in objectInfos)
-
-        removedItems = 0
-        for stat, cachekey in objectInfos:
-            self.removeEntry(cachekey)
-            removedItems += 1
-            currentSizeObjects -= stat.st_size
+    @staticmethod
+    def _chooseVictims(objectInfos, blobReferences, blobSizes, maxCompilerArtifactsSize):
+        """Returns the first entries to remove for getting below the maximum
+        size, assuming that all of them can be removed"""
+        references = dict(blobReferences)
+        currentSizeObjects = sum(blobSizes.values())
+        victims = []
+        for objectInfo in objectInfos:
             if currentSizeObjects < maxCompilerArtifactsSize:
                 break
+            victims.append(objectInfo)
+            # Blobs are freed only once no cache entry references them anymore
+            blobName = objectInfo[0].blobName
+            if blobName is not None:
+                references[blobName] -= 1
+                if references[blobName] == 0:
+                    currentSizeObjects -= blobSizes[blobName]
+        return victims
 
-        return len(objectInfos)-removedItems, currentSizeObjects
+    @staticmethod
+    def _removeEntries(objectInfos):
+        """Removes the given entries taking the lock of one section at a time,
+        returns the ones which were removed"""
+        objectInfosBySection = defaultdict(list)
+        for objectInfo in objectInfos:
+            objectInfosBySection[objectInfo[2].compilerArtifactsSectionDir].append(objectInfo)
+
+        removedObjectInfos = []
+        for sectionObjectInfos in objectInfosBySection.values():
+            section = sectionObjectInfos[0][2]
+            with section.lock:
+                recordedEntries = section.recordedEntries()
+                # Keep entries which were used or rewritten meanwhile, and the
+                # ones being read by a concurrent clcache invocation
+                removedObjectInfos += [(entry, cachekey, section) for entry, cachekey, _ in sectionObjectInfos
+                                       if recordedEntries.get(cachekey) == entry and section.removeEntry(cachekey)]
+                section.ledger.compact()
+        return removedObjectInfos
+
+    def _removeUnreferencedBlobs(self, blobReferences, blobSizes, cleaningStarted):
+        """Removes the blobs which no cache entry references anymore, returns
+        their total size"""
+        removedSize = 0
+        for blobName, references in blobReferences.items():
+            if references > 0:
+                continue
+            if cleaningStarted is None:
+                self._blobStore.removeBlob(blobName)
+            elif not self._blobStore.removeBlobIfUnusedSince(blobName, cleaningStarted):
+                # Referenced by a cache entry added meanwhile
+                continue
+            removedSize += blobSizes[blobName]
+        return removedSize
+
+    @staticmethod
+    def _gdsfValue(entry):
+        # The compile time saved per byte of cache, i.e. the GreedyDual-Size-
+        # Frequency value of the entry without the inflation value.
+        return (1 + entry.uses) * entry.compileDuration / max(entry.blobSize, 1)
+
+    def _inflationHistory(self):
+        return InflationHistory(os.path.join(self._compilerArtifactsRootDir, "inflation.txt"))
 
     @staticmethod
     def computeKeyDirect(manifestHash, includesContentHash):
         # We must take into account manifestHash to avoid
         # collisions when different source files use the same
-        # set of includes.
+        # set of includes. This also covers the hash algorithm.
         return getStringHash(manifestHash + includesContentHash)
 
     @staticmethod
@@ -414,7 +1739,8 @@ class CompilerArtifactsRepository(object):
         compilerHash = getCompilerHash(compilerBinary)
         normalizedCmdLine = CompilerArtifactsRepository._normalizedCommandLine(commandLine)
 
-        h = HashAlgorithm()
+        h = newHasher()
+        h.update(hashAlgorithmName().encode("UTF-8"))
         h.update(compilerHash.encode("UTF-8"))
         h.update(' '.join(normalizedCmdLine).encode("UTF-8"))
         h.update(preprocessedSourceCode)
@@ -452,16 +1778,46 @@ class Cache(object):
             except KeyError:
                 self.dir = os.path.join(os.path.expanduser("~"), "clcache")
 
+        ensureDirectoryExists(self.dir)
+        self.configuration = Configuration(os.path.join(self.dir, "config.txt"))
+        with self.configuration as cfg:
+            # Shared by all repositories, see refreshShardLayouts()
+            self._layouts = cfg.shardLayouts()
+        layouts = self._layouts
+
         manifestsRootDir = os.path.join(self.dir, "manifests")
         ensureDirectoryExists(manifestsRootDir)
-        self.manifestRepository = ManifestRepository(manifestsRootDir)
+        self.manifestRepository = ManifestRepository(manifestsRootDir, layouts)
+
+        blobsRootDir = os.path.join(self.dir, "blobs")
+        ensureDirectoryExists(blobsRootDir)
+        blobStore = BlobStore(blobsRootDir, FileCopier(os.path.join(self.dir, "copymethods.txt")), layouts)
 
         compilerArtifactsRootDir = os.path.join(self.dir, "objects")
         ensureDirectoryExists(compilerArtifactsRootDir)
-        self.compilerArtifactsRepository = CompilerArtifactsRepository(compilerArtifactsRootDir)
+        self.compilerArtifactsRepository = CompilerArtifactsRepository(
+            compilerArtifactsRootDir, blobStore, layouts)
 
-        self.configuration = Configuration(os.path.join(self.dir, "config.txt"))
         self.statistics = Statistics(os.path.join(self.dir, "stats.txt"))
+        self.fileHashIndex = FileHashIndex(os.path.join(self.dir, "hashindex"))
+
+    @property
+    def blobStore(self):
+        return self.compilerArtifactsRepository.blobStore
+
+    # The following stores keep no state besides their files, so they are
+    # created whenever needed.
+    @property
+    def lockStatistics(self):
+        return LockStatistics(os.path.join(self.dir, "locks.txt"))
+
+    @property
+    def writeBackSpool(self):
+        return WriteBackSpool(os.path.join(self.dir, "spool"))
+
+    @property
+    def compileLeases(self):
+        return CompileLeases(os.path.join(self.dir, "leases"))
 
     @property
     @contextlib.contextmanager
@@ -474,11 +1830,62 @@ class Cache(object):
     def cacheDirectory(self):
         return self.dir
 
-    def clean(self, stats, maximumSize):
+    def refreshShardLayouts(self):
+        """Re-reads the shard layouts, returns whether they changed since they
+        were read last. To be called while holding the lock of the section to
+        add files to: resharding switches layouts and moves the files left in
+        the previous layout while holding the locks of all sections, so
+        sections located afterwards are never in directories which are no
+        longer searched."""
+        with self.configuration as cfg:
+            layouts = cfg.shardLayouts()
+        if layouts == self._layouts:
+            return False
+        self._layouts[:] = layouts
+        return True
+
+    def relocateFiles(self):
+        """Moves the files stored in the sections of the previous shard layout
+        to the sections of the current layout, returns the number of files
+        which could not be moved."""
+        return (self.manifestRepository.relocate() + self.compilerArtifactsRepository.relocate() +
+                self.blobStore.relocate())
+
+    def cleanerLock(self):
+        # Held by the clcache process cleaning the cache incrementally.
+        # Acquiring it fails right away if some process holds it already, so
+        # there is no point in timing it.
+        return CacheLock.forPath(os.path.join(self.dir, "cleaner"), timeoutMs=0, timed=False)
+
+    def clean(self, stats, maximumSize, evictionPolicy=EVICTION_POLICY_LRU):
         currentSize = stats.currentCacheSize()
         if currentSize < maximumSize:
             return
 
+        maximumSizeManifests, maximumSizeObjects = Cache._cleaningTargets(maximumSize)
+        self._cleanRepositories(stats, maximumSizeManifests, maximumSizeObjects, evictionPolicy)
+
+    def cleanIncrementally(self, maximumSize, evictionPolicy=EVICTION_POLICY_LRU):
+        """Like clean(), but takes the lock of just one cache section at a
+        time instead of requiring the lock of the whole cache."""
+        with self.statistics as stats:
+            if stats.currentCacheSize() < maximumSize:
+                return
+
+        maximumSizeManifests, maximumSizeObjects = Cache._cleaningTargets(maximumSize)
+        removedSizeManifests = self.manifestRepository.cleanIncrementally(maximumSizeManifests)
+        removedCompilerArtifactsCount, removedCompilerArtifactsSize, logicalRemovedCompilerArtifactsSize = \
+            self.compilerArtifactsRepository.cleanIncrementally(maximumSizeObjects, evictionPolicy)
+
+        # Just subtract what was removed, concurrent clcache invocations may
+        # have registered new entries meanwhile
+        with self.statistics.lock, self.statistics as stats:
+            stats.unregisterCacheEntries(removedCompilerArtifactsCount,
+                                         removedCompilerArtifactsSize + removedSizeManifests,
+                                         logicalRemovedCompilerArtifactsSize + removedSizeManifests)
+
+    @staticmethod
+    def _cleaningTargets(maximumSize):
         # Free at least 10% to avoid cleaning up too often which
         # is a big performance hit with large caches.
         effectiveMaximumSizeOverall = maximumSize * 0.9
@@ -486,18 +1893,354 @@ class Cache(object):
         # Split limit in manifests (10 %) and objects (90 %)
         effectiveMaximumSizeManifests = effectiveMaximumSizeOverall * 0.1
         effectiveMaximumSizeObjects = effectiveMaximumSizeOverall - effectiveMaximumSizeManifests
+        return effectiveMaximumSizeManifests, effectiveMaximumSizeObjects
 
+    def rebuildIndex(self, stats):
+        """Reconstructs the ledgers of all cache sections (e.g. after they got
+        lost or the cache directory was modified manually) and fixes up the
+        statistics, requires the lock."""
+        self.manifestRepository.rebuildLedgers()
+        self.compilerArtifactsRepository.rebuildLedgers()
+        self._cleanRepositories(stats, float('inf'), float('inf'))
+
+    def _cleanRepositories(self, stats, maximumSizeManifests, maximumSizeObjects, evictionPolicy=EVICTION_POLICY_LRU):
         # Clean manifests
-        currentSizeManifests = self.manifestRepository.clean(effectiveMaximumSizeManifests)
+        currentSizeManifests = self.manifestRepository.clean(maximumSizeManifests)
 
         # Clean artifacts
-        currentCompilerArtifactsCount, currentCompilerArtifactsSize = self.compilerArtifactsRepository.clean(
-            effectiveMaximumSizeObjects)
+        currentCompilerArtifactsCount, currentCompilerArtifactsSize, logicalCompilerArtifactsSize = \
+            self.compilerArtifactsRepository.clean(maximumSizeObjects, evictionPolicy)
 
         stats.setCacheSize(currentCompilerArtifactsSize + currentSizeManifests)
+        stats.setLogicalCacheSize(logicalCompilerArtifactsSize + currentSizeManifests)
         stats.setNumCacheEntries(currentCompilerArtifactsCount)
 
 
+class FileHashIndex(object):
+    """Persistent mapping of file paths to the hashes of their contents.
+
+    An entry is only trusted as long as the size, modification time and inode
+    of the file (as well as the hash algorithm) did not change, so hashing an
+    unchanged header costs a single stat() call instead of reading the complete
+    file.
+
+    The entries are spread over SHARD_COUNT files by the directory of the
+    file. Include files of a source file are usually located in a handful of
+    directories, so only a few small shards are loaded, and only the shards
+    which got new entries are written back.
+    """
+    # Files which were modified less than this many nanoseconds before being
+    # hashed are not recorded: another write within the granularity of the
+    # file system timestamps would go unnoticed otherwise.
+    RACY_INTERVAL_NS = 2 * 1000 * 1000 * 1000
+
+    SHARD_COUNT = 256
+
+    # Start over with an empty shard once it grows beyond this many entries,
+    # such that paths which are no longer used do not accumulate forever.
+    MAX_SHARD_ENTRIES = 10000
+
+    def __init__(self, indexDir):
+        self._indexDir = indexDir
+        self._shards = {}
+        self._updates = {}
+        # Hashes may be requested from multiple threads at once
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _shardName(key):
+        directory = os.path.dirname(key).encode('utf-8', 'surrogateescape')
+        return '{:02x}'.format(zlib.crc32(directory) % FileHashIndex.SHARD_COUNT)
+
+    def _shardPath(self, shardName):
+        return os.path.join(self._indexDir, shardName + '.json')
+
+    def _load(self, shardName):
+        try:
+            with open(self._shardPath(shardName), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return {}
+
+    def getFileHash(self, filePath):
+        key = os.path.normcase(os.path.abspath(filePath))
+        shardName = FileHashIndex._shardName(key)
+        with self._lock:
+            if shardName not in self._shards:
+                self._shards[shardName] = self._load(shardName)
+            shard = self._shards[shardName]
+
+        stat = os.stat(filePath)
+        fingerprint = [stat.st_size, stat.st_mtime_ns, stat.st_ino, hashAlgorithmName()]
+
+        entry = shard.get(key)
+        if entry is not None and entry[:4] == fingerprint:
+            return entry[4]
+
+        fileHash = getFileHash(filePath)
+        if int(time.time() * 1e9) - stat.st_mtime_ns >= FileHashIndex.RACY_INTERVAL_NS:
+            with self._lock:
+                shard[key] = self._updates.setdefault(shardName, {})[key] = fingerprint + [fileHash]
+        return fileHash
+
+    def save(self):
+        for shardName, updates in self._updates.items():
+            # Merge with whatever concurrent clcache invocations stored meanwhile
+            shard = self._load(shardName)
+            if len(shard) + len(updates) > FileHashIndex.MAX_SHARD_ENTRIES:
+                shard = {}
+            shard.update(updates)
+
+            try:
+                ensureDirectoryExists(self._indexDir)
+                writeFileAtomically(self._shardPath(shardName), json.dumps(shard).encode('utf-8'))
+            except OSError:
+                # Losing updates is fine, they are just recomputed next time
+                pass
+        self._updates = {}
+
+
+class CompileLeases(object):
+    """Markers for the cache entries being compiled by some clcache invocation,
+    so that invocations missing the same entry concurrently wait for it to be
+    added instead of compiling it as well, without locking the section of the
+    entry while the compiler runs. The clcache invocation holding a lease
+    renews it while compiling; a lease which was not renewed for a given time
+    expires, in case the invocation holding it died."""
+    def __init__(self, leasesDir):
+        self.leasesDir = leasesDir
+
+    def leasePath(self, key):
+        return os.path.join(self.leasesDir, key)
+
+    def acquire(self, key, expirySeconds):
+        """Returns a token for releasing the lease, or None if some other
+        clcache invocation holds it."""
+        ensureDirectoryExists(self.leasesDir)
+        leasePath = self.leasePath(key)
+        token = '{} {}'.format(os.getpid(), time.time())
+        for _ in range(2):
+            try:
+                fd = os.open(leasePath, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+            except FileExistsError:
+                if not self._expired(leasePath, expirySeconds):
+                    return None
+                removeFileIfExists(leasePath)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                f.write(token)
+            return token
+        return None
+
+    @contextlib.contextmanager
+    def held(self, key, token, expirySeconds):
+        """Renews the lease while the body runs, such that it does not expire
+        during long compiles, and releases it afterwards."""
+        stopped = threading.Event()
+
+        def renewUntilStopped():
+            while not stopped.wait(expirySeconds / 4):
+                self.renew(key, token)
+
+        renewer = threading.Thread(target=renewUntilStopped, daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            renewer.join()
+            self.release(key, token)
+
+    def renew(self, key, token):
+        leasePath = self.leasePath(key)
+        if self._holder(leasePath) != token:
+            # Expired and taken over by some other clcache invocation
+            return
+        try:
+            os.utime(leasePath, None)
+        except OSError:
+            pass
+
+    def release(self, key, token):
+        leasePath = self.leasePath(key)
+        if self._holder(leasePath) != token:
+            # Expired and taken over by some other clcache invocation
+            return
+        removeFileIfExists(leasePath)
+
+    @staticmethod
+    def _holder(leasePath):
+        try:
+            with open(leasePath, 'r') as f:
+                return f.read()
+        except IOError:
+            return None
+
+    @staticmethod
+    def _expired(leasePath, expirySeconds):
+        try:
+            return time.time() - os.stat(leasePath).st_mtime > expirySeconds
+        except FileNotFoundError:
+            return True
+
+
+class WriteBackSpool(object):
+    """Results of compiler invocations which missed the cache, waiting to be
+    added to the cache by a detached clcache process (see CLCACHE_WRITEBACK).
+
+    Each job consists of the object file, staged using a hard link if
+    possible, and a JSON file with everything else needed for adding it.
+    """
+    def __init__(self, spoolDir):
+        self.spoolDir = spoolDir
+
+    def publisherLock(self):
+        # Held by the clcache process adding the jobs to the cache. Acquiring
+        # it fails right away if some process holds it already, so there is no
+        # point in timing it.
+        return CacheLock.forPath(self.spoolDir, timeoutMs=0, timed=False)
+
+    def jobPath(self, jobId):
+        return os.path.join(self.spoolDir, jobId + ".job")
+
+    def stagedObjectPath(self, jobId):
+        return os.path.join(self.spoolDir, jobId + ".obj")
+
+    def jobs(self):
+        try:
+            names = os.listdir(self.spoolDir)
+        except OSError:
+            return []
+        return sorted(name[:-len(".job")] for name in names if name.endswith(".job"))
+
+    def addJob(self, objectFile, job):
+        ensureDirectoryExists(self.spoolDir)
+        jobId = '{:.6f}-{}'.format(time.time(), os.getpid())
+        stagedObjectFile = self.stagedObjectPath(jobId)
+        try:
+            os.link(objectFile, stagedObjectFile)
+        except OSError:
+            FileCopier().copy(objectFile, stagedObjectFile)
+
+        # A hard link shares its contents with the object file in the build
+        # directory, which the build may overwrite before the job is processed.
+        stat = os.stat(stagedObjectFile)
+        job = dict(job, stagedObjectStat=[stat.st_size, stat.st_mtime_ns])
+        writeFileAtomically(self.jobPath(jobId), json.dumps(job).encode('utf-8'))
+        return jobId
+
+    def loadJob(self, jobId):
+        """Returns None if the job cannot be read, e.g. since the clcache
+        invocation adding it was interrupted."""
+        try:
+            with open(self.jobPath(jobId), 'r') as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def stagedObjectChanged(self, jobId, job):
+        try:
+            stat = os.stat(self.stagedObjectPath(jobId))
+        except OSError:
+            return True
+        return job['stagedObjectStat'] != [stat.st_size, stat.st_mtime_ns]
+
+    def removeJob(self, jobId):
+        removeFileIfExists(self.jobPath(jobId))
+        removeFileIfExists(self.stagedObjectPath(jobId))
+
+
+class FileCopier(object):
+    """Copies files using the cheapest method the file systems involved
+    support: a reflink, copy_file_range(), sendfile() or a plain copy.
+
+    Methods which turned out to be unsupported for a pair of file systems are
+    remembered (persistently, if a file is given), so they are not tried again.
+    """
+    # errno values indicating that a copy method is not supported (rather than
+    # that copying failed)
+    UNSUPPORTED_ERRORS = {
+        getattr(errno, name)
+        for name in ['EBADF', 'EINVAL', 'ENOSYS', 'ENOTSUP', 'ENOTTY', 'EOPNOTSUPP', 'EXDEV']
+        if hasattr(errno, name)
+    }
+
+    def __init__(self, capabilitiesFile=None):
+        self._capabilitiesFile = capabilitiesFile
+        self._unsupportedMethods = None
+        self.methods = []
+        if fcntl is not None and sys.platform.startswith('linux'):
+            self.methods.append(('reflink', FileCopier._reflink))
+        if hasattr(os, 'copy_file_range'):
+            self.methods.append(('copy_file_range', FileCopier._copyFileRange))
+        if hasattr(os, 'sendfile') and sys.platform.startswith('linux'):
+            self.methods.append(('sendfile', FileCopier._sendFile))
+        self.methods.append(('copy', copyfile))
+
+    def copy(self, srcFilePath, dstFilePath):
+        """Copies srcFilePath to dstFilePath, returns the name of the method used"""
+        fileSystems = '{}:{}'.format(
+            os.stat(srcFilePath).st_dev, os.stat(os.path.dirname(os.path.abspath(dstFilePath))).st_dev)
+        unsupportedMethods = self._loadUnsupportedMethods().get(fileSystems, [])
+        for name, method in self.methods:
+            if name in unsupportedMethods:
+                continue
+            try:
+                method(srcFilePath, dstFilePath)
+                return name
+            except OSError as e:
+                if name == 'copy' or e.errno not in FileCopier.UNSUPPORTED_ERRORS:
+                    raise
+                self._recordUnsupportedMethod(fileSystems, name)
+        assert False, 'copying files is always supported'
+
+    def _loadUnsupportedMethods(self):
+        if self._unsupportedMethods is None:
+            self._unsupportedMethods = {}
+            if self._capabilitiesFile is not None:
+                try:
+                    with open(self._capabilitiesFile, 'r') as f:
+                        self._unsupportedMethods = json.load(f)
+                except (IOError, ValueError):
+                    pass
+        return self._unsupportedMethods
+
+    def _recordUnsupportedMethod(self, fileSystems, name):
+        printTraceStatement("Copying files via {} is not supported for file systems {}".format(name, fileSystems))
+        self._unsupportedMethods.setdefault(fileSystems, []).append(name)
+        if self._capabilitiesFile is not None:
+            try:
+                writeFileAtomically(self._capabilitiesFile, json.dumps(self._unsupportedMethods).encode('utf-8'))
+            except OSError:
+                # It is just tried again next time
+                pass
+
+    @staticmethod
+    def _reflink(srcFilePath, dstFilePath):
+        with open(srcFilePath, 'rb') as inFile, open(dstFilePath, 'wb') as outFile:
+            fcntl.ioctl(outFile.fileno(), FICLONE, inFile.fileno())
+
+    @staticmethod
+    def _copyFileRange(srcFilePath, dstFilePath):
+        FileCopier._copyInKernel(srcFilePath, dstFilePath, os.copy_file_range) # pylint: disable=no-member
+
+    @staticmethod
+    def _sendFile(srcFilePath, dstFilePath):
+        FileCopier._copyInKernel(
+            srcFilePath, dstFilePath, lambda inFd, outFd, count: os.sendfile(outFd, inFd, None, count))
+
+    @staticmethod
+    def _copyInKernel(srcFilePath, dstFilePath, copyFunction):
+        with open(srcFilePath, 'rb') as inFile, open(dstFilePath, 'wb') as outFile:
+            remaining = os.fstat(inFile.fileno()).st_size
+            while remaining > 0:
+                copied = copyFunction(inFile.fileno(), outFile.fileno(), remaining)
+                if copied == 0:
+                    # Some file systems claim support but don't copy anything
+                    raise OSError(errno.EINVAL, 'No data copied', srcFilePath)
+                remaining -= copied
+
+
 class PersistentJSONDict(object):
     def __init__(self, fileName):
         self._dirty = False
@@ -511,8 +2254,8 @@ class PersistentJSONDict(object):
 
     def save(self):
         if self._dirty:
-            with open(self._fileName, 'w') as f:
-                json.dump(self._dict, f, sort_keys=True, indent=4)
+            # Every clcache invocation reads the shard layout from the configuration
+            writeFileAtomically(self._fileName, json.dumps(self._dict, sort_keys=True, indent=4).encode('utf-8'))
 
     def __setitem__(self, key, value):
         self._dict[key] = value
@@ -529,7 +2272,15 @@ class PersistentJSONDict(object):
 
 
 class Configuration(object):
-    _defaultValues = {"MaximumCacheSize": 1073741824} # 1 GiB
+    _defaultValues = {
+        "MaximumCacheSize": 1073741824, # 1 GiB
+        "MaximumManifestEntries": MAX_MANIFEST_HASHES,
+        "EvictionPolicy": EVICTION_POLICY_LRU,
+        "ShardDepth": 1,
+        "ShardWidth": 2,
+        # [depth, width] of the layout the cache is being resharded from
+        "PreviousShardLayout": None,
+    }
 
     def __init__(self, configurationFile):
         self._configurationFile = configurationFile
@@ -552,8 +2303,164 @@ class Configuration(object):
     def setMaximumCacheSize(self, size):
         self._cfg["MaximumCacheSize"] = size
 
+    def maximumManifestEntries(self):
+        return self._cfg["MaximumManifestEntries"]
+
+    def setMaximumManifestEntries(self, count):
+        self._cfg["MaximumManifestEntries"] = count
+
+    def evictionPolicy(self):
+        policy = self._cfg["EvictionPolicy"]
+        if policy not in EVICTION_POLICIES:
+            raise LogicException("Unsupported eviction policy {} (supported: {})".format(
+                policy, ', '.join(EVICTION_POLICIES)))
+        return policy
+
+    def setEvictionPolicy(self, policy):
+        self._cfg["EvictionPolicy"] = policy
+
+    def shardLayout(self):
+        return ShardLayout(self._cfg["ShardDepth"], self._cfg["ShardWidth"])
+
+    def previousShardLayout(self):
+        previousLayout = self._cfg["PreviousShardLayout"]
+        return ShardLayout(*previousLayout) if previousLayout is not None else None
+
+    def shardLayouts(self):
+        """Returns the current shard layout, followed by the previous one while resharding"""
+        previousLayout = self.previousShardLayout()
+        return [self.shardLayout()] + ([previousLayout] if previousLayout is not None else [])
+
+    def setShardLayout(self, layout, previousLayout=None):
+        self._cfg["ShardDepth"] = layout.depth
+        self._cfg["ShardWidth"] = layout.width
+        self._cfg["PreviousShardLayout"] = \
+            [previousLayout.depth, previousLayout.width] if previousLayout is not None else None
+
+
+class ShardedCounters(object):
+    """Counters stored in a file, which concurrent clcache invocations update
+    without a global lock: each process adds its changes to one of
+    STATISTICS_SHARDS shard files (chosen by its process id), guarded by the
+    lock of the shard. Reading the counters sums up the file and all shards.
+    Setting absolute values requires the lock, and merges the shards into the
+    file."""
+    def __init__(self, countersFile):
+        self._countersFile = countersFile
+        self._shardsDir = os.path.splitext(countersFile)[0] + ".shards"
+        self._loadedCounters = None
+        self._shardTotals = None
+        self._changes = None
+        self._values = None
+        self.lock = CacheLock.forPath(self._countersFile)
+
+    def __enter__(self):
+        # The counters are only read if needed; changes are collected and
+        # written to a shard when leaving the context.
+        self._loadedCounters = None
+        self._shardTotals = None
+        self._changes = defaultdict(int)
+        self._values = {}
+        return self
+
+    def __exit__(self, typ, value, traceback):
+        if self._values:
+            # Setting absolute values requires the lock
+            self._compact()
+        elif any(self._changes.values()):
+            self._addToShard(self._shardPath(os.getpid() % STATISTICS_SHARDS), self._changes)
+
+    def __eq__(self, other):
+        return type(self) is type(other) and self.__dict__ == other.__dict__
+
+    def _shardPath(self, index):
+        return os.path.join(self._shardsDir, "shard{:02d}.json".format(index))
+
+    def _shardPaths(self):
+        return [self._shardPath(index) for index in range(STATISTICS_SHARDS)]
 
-class Statistics(object):
+    @staticmethod
+    def _readCounters(path):
+        counters = defaultdict(int)
+        try:
+            with open(path, 'r') as f:
+                counters.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+        return counters
+
+    @staticmethod
+    def _writeCounters(path, counters):
+        writeFileAtomically(path, json.dumps(counters, sort_keys=True, indent=4).encode('utf-8'))
+
+    def _readShardTotals(self):
+        totals = defaultdict(int)
+        for path in self._shardPaths():
+            for key, delta in ShardedCounters._readCounters(path).items():
+                totals[key] += delta
+        return totals
+
+    def _addToShard(self, path, changes):
+        ensureDirectoryExists(self._shardsDir)
+        with CacheLock.forPath(path, timed=False):
+            counters = ShardedCounters._readCounters(path)
+            for key, delta in changes.items():
+                counters[key] += delta
+            ShardedCounters._writeCounters(path, counters)
+
+    def _compact(self):
+        shardLocks = [CacheLock.forPath(path, timed=False) for path in self._shardPaths()]
+        with contextlib.ExitStack() as stack:
+            for shardLock in shardLocks:
+                stack.enter_context(shardLock)
+
+            counters = ShardedCounters._readCounters(self._countersFile)
+            shardTotals = self._readShardTotals()
+            for key, delta in shardTotals.items():
+                counters[key] += delta
+            for key, value in self._values.items():
+                # Keep what concurrent clcache invocations registered since the
+                # counters were read
+                counters[key] = value + shardTotals[key] - self._shardTotals[key]
+            for key, delta in self._changes.items():
+                counters[key] += delta
+
+            ShardedCounters._writeCounters(self._countersFile, counters)
+            for path in self._shardPaths():
+                removeFileIfExists(path)
+
+    def _load(self):
+        if self._loadedCounters is None:
+            self._shardTotals = self._readShardTotals()
+            self._loadedCounters = ShardedCounters._readCounters(self._countersFile)
+            for key, delta in self._shardTotals.items():
+                self._loadedCounters[key] += delta
+
+    def _allCounters(self):
+        self._load()
+        counters = defaultdict(int, self._loadedCounters)
+        counters.update(self._values)
+        for key, delta in self._changes.items():
+            counters[key] += delta
+        return counters
+
+    def _get(self, key):
+        if key in self._values:
+            return self._values[key] + self._changes[key]
+        self._load()
+        return self._loadedCounters[key] + self._changes[key]
+
+    def _set(self, key, value):
+        # Values are set relative to the counters as read
+        self._load()
+        self._values[key] = value
+        self._changes.pop(key, None)
+
+    def _add(self, key, delta=1):
+        self._changes[key] += delta
+
+
+class Statistics(ShardedCounters):
     CALLS_WITH_INVALID_ARGUMENT = "CallsWithInvalidArgument"
     CALLS_WITHOUT_SOURCE_FILE = "CallsWithoutSourceFile"
     CALLS_WITH_MULTIPLE_SOURCE_FILES = "CallsWithMultipleSourceFiles"
@@ -568,6 +2475,7 @@ class Statistics(object):
     SOURCE_CHANGED_MISSES = "SourceChangedMisses"
     CACHE_ENTRIES = "CacheEntries"
     CACHE_SIZE = "CacheSize"
+    LOGICAL_CACHE_SIZE = "LogicalCacheSize"
 
     RESETTABLE_KEYS = {
         CALLS_WITH_INVALID_ARGUMENT,
@@ -586,125 +2494,152 @@ class Statistics(object):
     NON_RESETTABLE_KEYS = {
         CACHE_ENTRIES,
         CACHE_SIZE,
+        LOGICAL_CACHE_SIZE,
     }
 
-    def __init__(self, statsFile):
-        self._statsFile = statsFile
-        self._stats = None
-        self.lock = CacheLock.forPath(self._statsFile)
-
-    def __enter__(self):
-        self._stats = PersistentJSONDict(self._statsFile)
-        for k in Statistics.RESETTABLE_KEYS | Statistics.NON_RESETTABLE_KEYS:
-            if k not in self._stats:
-                self._stats[k] = 0
-        return self
-
-    def __exit__(self, typ, value, traceback):
-        # Does not write to disc when unchanged
-        self._stats.save()
-
-    def __eq__(self, other):
-        return type(self) is type(other) and self.__dict__ == other.__dict__
-
     def numCallsWithInvalidArgument(self):
-        return self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT]
+        return self._get(Statistics.CALLS_WITH_INVALID_ARGUMENT)
 
     def registerCallWithInvalidArgument(self):
-        self._stats[Statistics.CALLS_WITH_INVALID_ARGUMENT] += 1
+        self._add(Statistics.CALLS_WITH_INVALID_ARGUMENT)
 
     def numCallsWithoutSourceFile(self):
-        return self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE]
+        return self._get(Statistics.CALLS_WITHOUT_SOURCE_FILE)
 
     def registerCallWithoutSourceFile(self):
-        self._stats[Statistics.CALLS_WITHOUT_SOURCE_FILE] += 1
+        self._add(Statistics.CALLS_WITHOUT_SOURCE_FILE)
 
     def numCallsWithMultipleSourceFiles(self):
-        return self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES]
+        return self._get(Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES)
 
     def registerCallWithMultipleSourceFiles(self):
-        self._stats[Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES] += 1
+        self._add(Statistics.CALLS_WITH_MULTIPLE_SOURCE_FILES)
 
     def numCallsWithPch(self):
-        return self._stats[Statistics.CALLS_WITH_PCH]
+        return self._get(Statistics.CALLS_WITH_PCH)
 
     def registerCallWithPch(self):
-        self._stats[Statistics.CALLS_WITH_PCH] += 1
+        self._add(Statistics.CALLS_WITH_PCH)
 
     def numCallsForLinking(self):
-        return self._stats[Statistics.CALLS_FOR_LINKING]
+        return self._get(Statistics.CALLS_FOR_LINKING)
 
     def registerCallForLinking(self):
-        self._stats[Statistics.CALLS_FOR_LINKING] += 1
+        self._add(Statistics.CALLS_FOR_LINKING)
 
     def numCallsForExternalDebugInfo(self):
-        return self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO]
+        return self._get(Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO)
 
     def registerCallForExternalDebugInfo(self):
-        self._stats[Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO] += 1
+        self._add(Statistics.CALLS_FOR_EXTERNAL_DEBUG_INFO)
 
     def numEvictedMisses(self):
-        return self._stats[Statistics.EVICTED_MISSES]
+        return self._get(Statistics.EVICTED_MISSES)
 
     def registerEvictedMiss(self):
         self.registerCacheMiss()
-        self._stats[Statistics.EVICTED_MISSES] += 1
+        self._add(Statistics.EVICTED_MISSES)
 
     def numHeaderChangedMisses(self):
-        return self._stats[Statistics.HEADER_CHANGED_MISSES]
+        return self._get(Statistics.HEADER_CHANGED_MISSES)
 
     def registerHeaderChangedMiss(self):
         self.registerCacheMiss()
-        self._stats[Statistics.HEADER_CHANGED_MISSES] += 1
+        self._add(Statistics.HEADER_CHANGED_MISSES)
 
     def numSourceChangedMisses(self):
-        return self._stats[Statistics.SOURCE_CHANGED_MISSES]
+        return self._get(Statistics.SOURCE_CHANGED_MISSES)
 
     def registerSourceChangedMiss(self):
         self.registerCacheMiss()
-        self._stats[Statistics.SOURCE_CHANGED_MISSES] += 1
+        self._add(Statistics.SOURCE_CHANGED_MISSES)
 
     def numCacheEntries(self):
-        return self._stats[Statistics.CACHE_ENTRIES]
+        return self._get(Statistics.CACHE_ENTRIES)
 
     def setNumCacheEntries(self, number):
-        self._stats[Statistics.CACHE_ENTRIES] = number
+        self._set(Statistics.CACHE_ENTRIES, number)
+
+    def registerCacheEntry(self, size, logicalSize=None):
+        # size is the number of bytes actually stored, which is less than the
+        # logical size if the object file was stored already
+        self._add(Statistics.CACHE_ENTRIES)
+        self._add(Statistics.CACHE_SIZE, size)
+        self._add(Statistics.LOGICAL_CACHE_SIZE, size if logicalSize is None else logicalSize)
 
-    def registerCacheEntry(self, size):
-        self._stats[Statistics.CACHE_ENTRIES] += 1
-        self._stats[Statistics.CACHE_SIZE] += size
+    def unregisterCacheEntry(self, size, logicalSize=None):
+        self._add(Statistics.CACHE_ENTRIES, -1)
+        self._add(Statistics.CACHE_SIZE, -size)
+        self._add(Statistics.LOGICAL_CACHE_SIZE, -(size if logicalSize is None else logicalSize))
 
-    def unregisterCacheEntry(self, size):
-        self._stats[Statistics.CACHE_ENTRIES] -= 1
-        self._stats[Statistics.CACHE_SIZE] -= size
+    def unregisterCacheEntries(self, count, size, logicalSize):
+        self._add(Statistics.CACHE_ENTRIES, -count)
+        self._add(Statistics.CACHE_SIZE, -size)
+        self._add(Statistics.LOGICAL_CACHE_SIZE, -logicalSize)
 
     def currentCacheSize(self):
-        return self._stats[Statistics.CACHE_SIZE]
+        return self._get(Statistics.CACHE_SIZE)
 
     def setCacheSize(self, size):
-        self._stats[Statistics.CACHE_SIZE] = size
+        self._set(Statistics.CACHE_SIZE, size)
+
+    def currentLogicalCacheSize(self):
+        return self._get(Statistics.LOGICAL_CACHE_SIZE)
+
+    def setLogicalCacheSize(self, size):
+        self._set(Statistics.LOGICAL_CACHE_SIZE, size)
+
+    def deduplicationRatio(self):
+        if self.currentCacheSize() == 0:
+            return 1.0
+        return self.currentLogicalCacheSize() / self.currentCacheSize()
 
     def numCacheHits(self):
-        return self._stats[Statistics.CACHE_HITS]
+        return self._get(Statistics.CACHE_HITS)
 
     def registerCacheHit(self):
-        self._stats[Statistics.CACHE_HITS] += 1
+        self._add(Statistics.CACHE_HITS)
 
     def numCacheMisses(self):
-        return self._stats[Statistics.CACHE_MISSES]
+        return self._get(Statistics.CACHE_MISSES)
 
     def registerCacheMiss(self):
-        self._stats[Statistics.CACHE_MISSES] += 1
+        self._add(Statistics.CACHE_MISSES)
 
     def numCallsForPreprocessing(self):
-        return self._stats[Statistics.CALLS_FOR_PREPROCESSING]
+        return self._get(Statistics.CALLS_FOR_PREPROCESSING)
 
     def registerCallForPreprocessing(self):
-        self._stats[Statistics.CALLS_FOR_PREPROCESSING] += 1
+        self._add(Statistics.CALLS_FOR_PREPROCESSING)
 
     def resetCounters(self):
         for k in Statistics.RESETTABLE_KEYS:
-            self._stats[k] = 0
+            self._set(k, 0)
+
+
+class LockStatistics(ShardedCounters):
+    """The time spent on cache locks, by lock name, e.g. 'objects/ab' for the
+    lock of a cache section."""
+    def registerLockTimings(self, timings):
+        for name, timing in timings.items():
+            for field, value in zip(LockTiming._fields, timing):
+                self._add(LockStatistics._key(field, name), value)
+
+    def lockTimings(self):
+        timings = defaultdict(lambda: LockTiming(0, 0, 0.0, 0.0))
+        for key, value in self._allCounters().items():
+            field, _, name = key.partition(':')
+            if field in LockTiming._fields:
+                timings[name] = timings[name]._replace(**{field: value})
+        return dict(timings)
+
+    def resetTimings(self):
+        for key in self._allCounters():
+            self._set(key, 0)
+
+    @staticmethod
+    def _key(field, name):
+        return '{}:{}'.format(field, name)
 
 
 class AnalysisError(Exception):
@@ -739,6 +2674,35 @@ class InvalidArgumentError(AnalysisError):
     pass
 
 
+def hashAlgorithmName():
+    name = os.environ.get('CLCACHE_HASH_ALGORITHM', DEFAULT_HASH_ALGORITHM).lower()
+    if name not in HASH_ALGORITHMS:
+        raise LogicException('Unsupported hash algorithm {}, supported are: {}'.format(
+            name, ', '.join(sorted(HASH_ALGORITHMS))))
+    return name
+
+
+def compressionMethod():
+    """Returns the compression method for new objects, None if disabled"""
+    name = os.environ.get('CLCACHE_COMPRESS', '').lower()
+    if not name:
+        return None
+    if name not in COMPRESSION_METHODS:
+        raise LogicException('Unsupported compression method {}, supported are: {}'.format(
+            name, ', '.join(sorted(COMPRESSION_METHODS))))
+    return name
+
+
+def compressionLevel(method):
+    if 'CLCACHE_COMPRESSLEVEL' in os.environ:
+        return int(os.environ['CLCACHE_COMPRESSLEVEL'])
+    return COMPRESSION_METHODS[method].defaultLevel
+
+
+def newHasher(data=b''):
+    return HASH_ALGORITHMS[hashAlgorithmName()](data)
+
+
 def getCompilerHash(compilerBinary):
     stat = os.stat(compilerBinary)
     data = '|'.join([
@@ -746,15 +2710,42 @@ def getCompilerHash(compilerBinary):
         str(stat.st_size),
         VERSION,
         ])
-    hasher = HashAlgorithm()
+    hasher = newHasher()
     hasher.update(data.encode("UTF-8"))
     return hasher.hexdigest()
 
 
+def updateHashFromFile(hasher, inFile):
+    fileSize = os.fstat(inFile.fileno()).st_size
+    if fileSize >= HASH_MMAP_THRESHOLD:
+        # Hash mapped windows of the file; unmapping each window right away
+        # keeps the resident memory bounded.
+        offset = 0
+        try:
+            while offset < fileSize:
+                length = min(HASH_MMAP_WINDOW_SIZE, fileSize - offset)
+                with mmap.mmap(inFile.fileno(), length, offset=offset, access=mmap.ACCESS_READ) as window:
+                    hasher.update(window)
+                offset += length
+            return
+        except (OSError, ValueError):
+            # Mapping fails if the file was truncated meanwhile; continue
+            # reading wherever mapping stopped.
+            inFile.seek(offset)
+
+    buf = bytearray(HASH_CHUNK_SIZE)
+    view = memoryview(buf)
+    while True:
+        bytesRead = inFile.readinto(buf)
+        if not bytesRead:
+            break
+        hasher.update(view[:bytesRead])
+
+
 def getFileHash(filePath, additionalData=None):
-    hasher = HashAlgorithm()
+    hasher = newHasher()
     with open(filePath, 'rb') as inFile:
-        hasher.update(inFile.read())
+        updateHashFromFile(hasher, inFile)
     if additionalData is not None:
         # Encoding of this additional data does not really matter
         # as long as we keep it fixed, otherwise hashes change.
@@ -763,8 +2754,33 @@ def getFileHash(filePath, additionalData=None):
     return hasher.hexdigest()
 
 
+def hashingThreadCount():
+    defaultCount = min(2 * multiprocessing.cpu_count(), MAX_DEFAULT_HASHING_THREADS)
+    return int(os.environ.get('CLCACHE_HASH_THREADS', defaultCount))
+
+
+def hashingExecutor():
+    # Direct mode lookups hash many small batches of files, so the pool is
+    # created once and reused for the lifetime of the process.
+    threadCount = hashingThreadCount()
+    with HASHING_EXECUTORS_LOCK:
+        if threadCount not in HASHING_EXECUTORS:
+            HASHING_EXECUTORS[threadCount] = ThreadPoolExecutor(max_workers=threadCount)
+        return HASHING_EXECUTORS[threadCount]
+
+
+# Returns the hashes of the given files in the same order as the files
+def getFileHashes(filePaths, fileHashIndex=None):
+    hashFile = fileHashIndex.getFileHash if fileHashIndex is not None else getFileHash
+    threadCount = min(hashingThreadCount(), len(filePaths))
+    if threadCount <= 1 or len(filePaths) < PARALLEL_HASHING_THRESHOLD:
+        return [hashFile(path) for path in filePaths]
+
+    return list(hashingExecutor().map(hashFile, filePaths))
+
+
 def getStringHash(dataString):
-    hasher = HashAlgorithm()
+    hasher = newHasher()
     hasher.update(dataString.encode("UTF-8"))
     return hasher.hexdigest()
 
@@ -792,6 +2808,13 @@ def collapseBasedirToPlaceholder(path):
             return path
 
 
+def removeFileIfExists(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
 def ensureDirectoryExists(path):
     try:
         os.makedirs(path)
@@ -800,12 +2823,81 @@ def ensureDirectoryExists(path):
             raise
 
 
-def copyOrLink(srcFilePath, dstFilePath):
+def replaceFile(srcFilePath, dstFilePath):
+    # On Windows, replacing a file fails while a concurrent (lock-free) reader
+    # still has the old file open. Readers only keep files open very briefly,
+    # so just retry a few times.
+    for attempt in range(REPLACE_FILE_ATTEMPTS):
+        try:
+            os.replace(srcFilePath, dstFilePath)
+            return
+        except PermissionError:
+            if attempt == REPLACE_FILE_ATTEMPTS - 1:
+                raise
+            time.sleep(REPLACE_FILE_RETRY_DELAY)
+
+
+def writeFileAtomically(filePath, data):
+    # Write to a temporary file next to the destination and rename it into
+    # place, so that readers never see partially written files. The name of
+    # the temporary file is unique among the running writers. Unlike with
+    # mkstemp(), the file gets the permissions given by the umask, such that
+    # a cache can be shared by several users.
+    tempPath = os.path.join(os.path.dirname(filePath), '{}.{}.tmp'.format(os.getpid(), threading.get_ident()))
+    fd = os.open(tempPath, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0), 0o666)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        replaceFile(tempPath, filePath)
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+
+def compressFile(srcFilePath, dstFilePath, method, level):
+    compressor = COMPRESSION_METHODS[method].newCompressor(level)
+    with open(srcFilePath, 'rb') as inFile, open(dstFilePath, 'wb') as outFile:
+        for chunk in iter(functools.partial(inFile.read, HASH_CHUNK_SIZE), b''):
+            outFile.write(compressor.compress(chunk))
+        outFile.write(compressor.flush())
+
+
+def decompressFile(srcFilePath, dstFilePath, method):
+    # Decompress chunk-wise straight into the destination, the object file is
+    # never held in memory as a whole. The temporary file avoids leaving a
+    # truncated object file behind if decompression fails.
+    decompressor = COMPRESSION_METHODS[method].newDecompressor()
+    ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
+    tempDst = dstFilePath + '.tmp'
+    try:
+        with open(srcFilePath, 'rb') as inFile, open(tempDst, 'wb') as outFile:
+            for chunk in iter(functools.partial(inFile.read, HASH_CHUNK_SIZE), b''):
+                outFile.write(decompressor.decompress(chunk))
+            if hasattr(decompressor, 'flush'):
+                outFile.write(decompressor.flush())
+        if not decompressor.eof:
+            raise IOError('Corrupt cached object file {}: truncated'.format(srcFilePath))
+        replaceFile(tempDst, dstFilePath)
+    except COMPRESSION_METHODS[method].error as e:
+        raise IOError('Corrupt cached object file {}: {}'.format(srcFilePath, e))
+    finally:
+        removeFileIfExists(tempDst)
+
+
+def restoreObjectFile(cachedObjectPath, dstFilePath, fileCopier=None):
+    method = os.path.splitext(cachedObjectPath)[1][1:]
+    if method in COMPRESSION_METHODS:
+        decompressFile(cachedObjectPath, dstFilePath, method)
+    else:
+        copyOrLink(cachedObjectPath, dstFilePath, fileCopier)
+
+
+def copyOrLink(srcFilePath, dstFilePath, fileCopier=None):
     ensureDirectoryExists(os.path.dirname(os.path.abspath(dstFilePath)))
 
     if "CLCACHE_HARDLINK" in os.environ:
-        ret = windll.kernel32.CreateHardLinkW(str(dstFilePath), str(srcFilePath), None)
-        if ret != 0:
+        try:
+            os.link(srcFilePath, dstFilePath)
             # Touch the time stamp of the new link so that the build system
             # doesn't confused by a potentially old time on the file. The
             # hard link gets the same timestamp as the cached file.
@@ -814,13 +2906,15 @@ def copyOrLink(srcFilePath, dstFilePath):
             # links). This shouldn't be a problem though.
             os.utime(dstFilePath, None)
             return
+        except OSError:
+            pass
 
     # If hardlinking fails for some reason (or it's not enabled), just
     # fall back to moving bytes around. Always to a temporary path first to
     # lower the chances of corrupting it.
     tempDst = dstFilePath + '.tmp'
-    copyfile(srcFilePath, tempDst)
-    os.rename(tempDst, dstFilePath)
+    (fileCopier or FileCopier()).copy(srcFilePath, tempDst)
+    replaceFile(tempDst, dstFilePath)
 
 
 def myExecutablePath():
@@ -1276,6 +3370,8 @@ def printStatistics(cache):
 clcache statistics:
   current cache dir         : {}
   cache size                : {:,} bytes
+  logical cache size        : {:,} bytes
+  deduplication ratio       : {:.2f}
   maximum cache size        : {:,} bytes
   cache entries             : {}
   cache hits                : {}
@@ -1297,6 +3393,8 @@ clcache statistics:
         print(template.format(
             cache.cacheDirectory(),
             stats.currentCacheSize(),
+            stats.currentLogicalCacheSize(),
+            stats.deduplicationRatio(),
             cfg.maximumCacheSize(),
             stats.numCacheEntries(),
             stats.numCacheHits(),
@@ -1314,21 +3412,104 @@ clcache statistics:
         ))
 
 
+def printLockReport(cache):
+    with cache.lockStatistics as lockStats:
+        timings = lockStats.lockTimings()
+
+    total = LockTiming(0, 0, 0.0, 0.0)
+    for timing in timings.values():
+        total = addLockTimings(total, timing)
+
+    print("""clcache lock report:
+    acquisitions     : {}
+    timeouts         : {}
+    total wait time  : {:.3f} s
+    total hold time  : {:.3f} s""".format(*total))
+
+    usedLocks = [(name, timing) for name, timing in timings.items() if timing.acquisitions or timing.timeouts]
+    mostContended = sorted(usedLocks, key=lambda t: t[1].waitTime, reverse=True)[:LOCK_REPORT_ENTRIES]
+    if mostContended:
+        print("most contended locks:")
+    for name, timing in mostContended:
+        print("    {:<16} : waited {:.3f} s ({:.1f} ms per acquisition), held {:.3f} s, "
+              "{} acquisitions, {} timeouts".format(
+                  name, timing.waitTime, 1000.0 * timing.waitTime / max(timing.acquisitions, 1),
+                  timing.holdTime, timing.acquisitions, timing.timeouts))
+
+
+def recordLockTimings(cache):
+    timings = CacheLock.takeTimings()
+    if timings:
+        with cache.lockStatistics as lockStats:
+            lockStats.registerLockTimings(timings)
+
+
 def resetStatistics(cache):
     with cache.statistics as stats:
         stats.resetCounters()
+    with cache.lockStatistics.lock, cache.lockStatistics as lockStats:
+        lockStats.resetTimings()
 
 
 def cleanCache(cache):
     with cache.statistics as stats, cache.configuration as cfg:
-        cache.clean(stats, cfg.maximumCacheSize())
+        cache.clean(stats, cfg.maximumCacheSize(), cfg.evictionPolicy())
+
+
+def cleanCacheIncrementally(cache):
+    """Cleans the cache unless some other clcache process does so already."""
+    try:
+        with cache.cleanerLock():
+            with cache.configuration as cfg:
+                maximumSize, evictionPolicy = cfg.maximumCacheSize(), cfg.evictionPolicy()
+            cache.cleanIncrementally(maximumSize, evictionPolicy)
+    except CacheLockException:
+        return
 
 
 def clearCache(cache):
     with cache.statistics as stats:
+        # Also catch files which are missing from the ledgers
+        cache.rebuildIndex(stats)
         cache.clean(stats, 0)
 
 
+def rebuildCacheIndex(cache):
+    with cache.statistics as stats:
+        cache.rebuildIndex(stats)
+
+
+def reshardCache(cache, layout):
+    """Moves the files of the cache to the sections of the given shard layout
+    while concurrent clcache invocations carry on: the lock of the whole cache
+    is taken just for switching layouts, and for moving the files which
+    invocations using the previous layout added meanwhile. Finishes resharding
+    interrupted earlier, returns the number of files which could not be moved
+    (i.e. whether to try again)."""
+    failures = finishResharding(cache)
+    if failures:
+        return failures
+    with cache.lock, cache.configuration as cfg:
+        previousLayout = cfg.shardLayout()
+        if layout == previousLayout:
+            return 0
+        cfg.setShardLayout(layout, previousLayout)
+    return finishResharding(Cache(cache.cacheDirectory()))
+
+
+def finishResharding(cache):
+    with cache.configuration as cfg:
+        if cfg.previousShardLayout() is None:
+            return 0
+    cache.relocateFiles()
+    with cache.lock:
+        failures = cache.relocateFiles()
+        if not failures:
+            with cache.configuration as cfg:
+                cfg.setShardLayout(cfg.shardLayout())
+    return failures
+
+
 # Returns pair:
 #   1. set of include filepaths
 #   2. new compiler output
@@ -1368,49 +3549,95 @@ def parseIncludesSet(compilerOutput, sourceFile, strip):
         return includesSet, compilerOutput
 
 
-def addObjectToCache(stats, cache, section, cachekey, artifacts):
+def addObjectToCache(stats, cache, section, cachekey, artifacts, compileDuration):
     # This function asserts that the caller locked 'section' and 'stats'
     # already and also saves them
     printTraceStatement("Adding file {} to cache using key {}".format(artifacts.objectFilePath, cachekey))
 
-    section.setEntry(cachekey, artifacts)
-    stats.registerCacheEntry(os.path.getsize(artifacts.objectFilePath))
+    storedSize = section.setEntry(cachekey, artifacts, compileDuration)
+    stats.registerCacheEntry(storedSize, os.path.getsize(artifacts.objectFilePath))
 
     with cache.configuration as cfg:
         return stats.currentCacheSize() >= cfg.maximumCacheSize()
 
 
 def processCacheHit(cache, objectFile, cachekey):
+    # Entries are published and removed atomically, so no lock is needed
+    # for reading them. Returns None if there is no (usable) entry.
+    section = cache.compilerArtifactsRepository.section(cachekey)
+    cachedArtifacts = section.getEntry(cachekey)
+    if cachedArtifacts is None:
+        return None
+
     printTraceStatement("Reusing cached object for key {} for object file {}".format(cachekey, objectFile))
+    if os.path.exists(objectFile):
+        os.remove(objectFile)
 
-    section = cache.compilerArtifactsRepository.section(cachekey)
-    with section.lock:
-        with cache.statistics.lock, cache.statistics as stats:
-            stats.registerCacheHit()
+    if cachedArtifacts.objectFilePath is not None:
+        try:
+            restoreObjectFile(cachedArtifacts.objectFilePath, objectFile, cache.blobStore.fileCopier)
+        except OSError:
+            printTraceStatement("Cached object for key {} was evicted concurrently".format(cachekey))
+            return None
 
-        if os.path.exists(objectFile):
-            os.remove(objectFile)
+    if section.ledger.recordUse(cachekey) > MAX_LEDGER_USES_SIZE:
+        with section.lock:
+            section.ledger.compact()
 
-        cachedArtifacts = section.getEntry(cachekey)
-        copyOrLink(cachedArtifacts.objectFilePath, objectFile)
-        printTraceStatement("Finished. Exit code 0")
-        return 0, cachedArtifacts.stdout, cachedArtifacts.stderr, False
+    with cache.statistics as stats:
+        stats.registerCacheHit()
+    printTraceStatement("Finished. Exit code 0")
+    return 0, cachedArtifacts.stdout, cachedArtifacts.stderr, False
 
 
-def createManifestEntry(manifestHash, includePaths):
+def createManifestEntry(manifestHash, includePaths, fileHashIndex=None):
     sortedIncludePaths = sorted(set(includePaths))
-    includeHashes = [getFileHash(path) for path in sortedIncludePaths]
+    includeHashes = getFileHashes(sortedIncludePaths, fileHashIndex)
 
     safeIncludes = [collapseBasedirToPlaceholder(path) for path in sortedIncludePaths]
     includesContentHash = ManifestRepository.getIncludesContentHashForHashes(includeHashes)
     cachekey = CompilerArtifactsRepository.computeKeyDirect(manifestHash, includesContentHash)
 
-    return ManifestEntry(safeIncludes, includesContentHash, cachekey)
+    return ManifestEntry(safeIncludes, includeHashes, includesContentHash, cachekey)
 
 
-def createOrUpdateManifest(manifestSection, manifestHash, entry):
+def getIncludeFileHash(path, knownHashes, fileHashIndex=None):
+    # Returns None for include files which do not exist (anymore)
+    path = expandBasedirPlaceholder(path)
+    if path not in knownHashes:
+        try:
+            knownHashes[path] = getFileHashes([path], fileHashIndex)[0]
+        except FileNotFoundError:
+            knownHashes[path] = None
+    return knownHashes[path]
+
+
+def verifyManifestEntry(entry, knownHashes, fileHashIndex=None):
+    """Checks whether the include files of a manifest entry are unchanged.
+
+    Hashes of files are looked up in (and added to) knownHashes, so checking
+    many entries of a manifest hashes every include file at most once.
+    """
+    includeFiles = [expandBasedirPlaceholder(path) for path in entry.includeFiles]
+    for start in range(0, len(includeFiles), INCLUDE_VERIFICATION_BATCH_SIZE):
+        batch = includeFiles[start:start + INCLUDE_VERIFICATION_BATCH_SIZE]
+        unknownFiles = [path for path in batch if path not in knownHashes]
+        try:
+            knownHashes.update(zip(unknownFiles, getFileHashes(unknownFiles, fileHashIndex)))
+        except FileNotFoundError:
+            return False
+
+        expectedHashes = entry.includeHashes[start:start + INCLUDE_VERIFICATION_BATCH_SIZE]
+        if any(knownHashes[path] != expectedHash for path, expectedHash in zip(batch, expectedHashes)):
+            return False
+    return True
+
+
+def createOrUpdateManifest(manifestSection, manifestHash, entry, maxEntries=MAX_MANIFEST_HASHES):
+    # Fold the recorded cache hits first, they affect which entries are evicted
+    manifestSection.foldAccessJournal()
     manifest = manifestSection.getManifest(manifestHash) or Manifest()
-    manifest.addEntry(entry)
+    manifest.addEntry(entry, maxEntries)
     manifestSection.setManifest(manifestHash, manifest)
     return manifest
 
@@ -1422,23 +3649,151 @@ def postprocessUnusableManifestMiss(
         cmdLine = list(cmdLine)
         cmdLine.insert(0, '/showIncludes')
         stripIncludes = True
+    compileStart = time.time()
     returnCode, compilerOutput, compilerStderr = invokeRealCompiler(compiler, cmdLine, captureOutput=True)
+    compileDuration = time.time() - compileStart
     includePaths, compilerOutput = parseIncludesSet(compilerOutput, sourceFile, stripIncludes)
 
-    entry = createManifestEntry(manifestHash, includePaths)
-    cachekey = entry.objectHash
+    entry = createManifestEntry(manifestHash, includePaths, cache.fileHashIndex)
+
+    artifacts = None
+    if returnCode == 0 and os.path.exists(objectFile):
+        artifacts = CompilerArtifacts(objectFile, compilerOutput, compilerStderr)
+        if writeBackEnabled():
+            spoolCacheEntry(cache, entry.objectHash, artifacts, compileDuration, reason, manifestHash, entry)
+            return returnCode, compilerOutput, compilerStderr, False
 
+    cleanupRequired = addDirectModeCacheEntry(
+        cache, manifestSection, manifestHash, entry, artifacts, compileDuration, reason)
+    return returnCode, compilerOutput, compilerStderr, cleanupRequired
+
+
+def addDirectModeCacheEntry(cache, manifestSection, manifestHash, entry, artifacts, compileDuration, reason):
+    """Registers the cache miss and adds the artifacts (None if compiling
+    failed) to the cache. Returns whether the cache needs to be cleaned."""
     cleanupRequired = False
+    cachekey = entry.objectHash
     section = cache.compilerArtifactsRepository.section(cachekey)
-    with section.lock, cache.statistics.lock, cache.statistics as stats:
+    with manifestSection.lock, section.lock, cache.statistics as stats:
+        if cache.refreshShardLayouts():
+            # The cache was resharded meanwhile; the locks are the same
+            manifestSection = cache.manifestRepository.section(manifestHash)
+            section = cache.compilerArtifactsRepository.section(cachekey)
         reason(stats)
-        if returnCode == 0 and os.path.exists(objectFile) and not section.hasEntry(cachekey):
-            artifacts = CompilerArtifacts(objectFile, compilerOutput, compilerStderr)
-            cleanupRequired = addObjectToCache(stats, cache, section, cachekey, artifacts)
-            manifest = createOrUpdateManifest(manifestSection, manifestHash, entry)
-            manifestSection.setManifest(manifestHash, manifest)
+        if artifacts is not None and not section.hasEntry(cachekey):
+            cleanupRequired = addObjectToCache(stats, cache, section, cachekey, artifacts, compileDuration)
+            with cache.configuration as cfg:
+                createOrUpdateManifest(manifestSection, manifestHash, entry, cfg.maximumManifestEntries())
+    return cleanupRequired
 
-    return returnCode, compilerOutput, compilerStderr, cleanupRequired
+
+def writeBackEnabled():
+    return 'CLCACHE_WRITEBACK' in os.environ
+
+
+def spoolCacheEntry(cache, cachekey, artifacts, compileDuration, reason, manifestHash=None, manifestEntry=None):
+    # Instead of adding the object to the cache (and updating manifest and
+    # statistics) now, leave that to a detached clcache process so that the
+    # build can carry on.
+    cache.writeBackSpool.addJob(artifacts.objectFilePath, {
+        'cachekey': cachekey,
+        'stdout': artifacts.stdout,
+        'stderr': artifacts.stderr,
+        'compileDuration': compileDuration,
+        'reason': reason.__name__,
+        'manifestHash': manifestHash,
+        'manifestEntry': list(manifestEntry) if manifestEntry is not None else None,
+    })
+    launchWriteBackPublisher(cache)
+
+
+def launchWriteBackPublisher(cache):
+    launchDetachedProcess(cache, cache.writeBackSpool.publisherLock(), "--publish-spool")
+
+
+def launchCleaner(cache):
+    # Compiles never wait for the cache to be cleaned, a detached clcache
+    # process does that while locking one cache section at a time.
+    launchDetachedProcess(cache, cache.cleanerLock(), "--clean-incrementally")
+
+
+def launchDetachedProcess(cache, lock, option):
+    """Runs clcache with the given option in the background, unless some
+    process holds the lock (i.e. does the job) already."""
+    try:
+        with lock:
+            pass
+    except CacheLockException:
+        # Some process does the job already
+        return
+
+    if hasattr(sys, "frozen"):
+        cmdLine = [sys.executable, option]
+    else:
+        cmdLine = [sys.executable, os.path.abspath(__file__), option]
+    if sys.platform == 'win32':
+        # DETACHED_PROCESS | CREATE_NEW_PROCESS_GROUP
+        options = {'creationflags': 0x00000008 | 0x00000200}
+    else:
+        options = {'start_new_session': True, 'close_fds': True}
+    subprocess.Popen(cmdLine, env=dict(os.environ, CLCACHE_DIR=cache.cacheDirectory()),
+                     stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, **options)
+
+
+def publishWriteBackSpool(cache):
+    """Adds all spooled cache entries to the cache, unless some other clcache
+    process does so already. Each job is tried once; jobs which could not be
+    removed are left for the next run."""
+    spool = cache.writeBackSpool
+    triedJobs = set()
+    while True:
+        cleanupRequired = False
+        try:
+            with spool.publisherLock():
+                for jobId in spool.jobs():
+                    if jobId not in triedJobs:
+                        triedJobs.add(jobId)
+                        cleanupRequired = publishWriteBackJob(cache, jobId) or cleanupRequired
+        except CacheLockException:
+            # The other process checks for new jobs after releasing the lock
+            return
+
+        if cleanupRequired:
+            cleanCacheIncrementally(cache)
+        # Jobs added while holding the lock did not launch a publisher
+        if all(jobId in triedJobs for jobId in spool.jobs()):
+            return
+
+
+def publishWriteBackJob(cache, jobId):
+    spool = cache.writeBackSpool
+    job = spool.loadJob(jobId)
+    cleanupRequired = False
+    if job is not None and spool.stagedObjectChanged(jobId, job):
+        printTraceStatement("Dropping spooled cache entry {}, the object file changed".format(jobId))
+        # The compile missed the cache all the same
+        updateCacheStatistics(cache, getattr(Statistics, job['reason']))
+    elif job is not None:
+        printTraceStatement("Adding spooled cache entry {}".format(jobId))
+        cachekey = job['cachekey']
+        artifacts = CompilerArtifacts(spool.stagedObjectPath(jobId), job['stdout'], job['stderr'])
+        reason = getattr(Statistics, job['reason'])
+        if job['manifestHash'] is not None:
+            manifestSection = cache.manifestRepository.section(job['manifestHash'])
+            cleanupRequired = addDirectModeCacheEntry(
+                cache, manifestSection, job['manifestHash'], ManifestEntry(*job['manifestEntry']), artifacts,
+                job['compileDuration'], reason)
+        else:
+            section = cache.compilerArtifactsRepository.section(cachekey)
+            with section.lock, cache.statistics as stats:
+                if cache.refreshShardLayouts():
+                    section = cache.compilerArtifactsRepository.section(cachekey)
+                reason(stats)
+                if not section.hasEntry(cachekey):
+                    cleanupRequired = addObjectToCache(
+                        stats, cache, section, cachekey, artifacts, job['compileDuration'])
+    spool.removeJob(jobId)
+    return cleanupRequired
 
 
 def installSignalHandlers():
@@ -1459,11 +3814,30 @@ clcache.py v{}
   -C        : clear cache
   -z        : reset cache statistics
   -M <size> : set maximum cache size (in bytes)
+  --publish-spool : add cache entries spooled because of CLCACHE_WRITEBACK
+  --rebuild-index : rebuild the index used for cleaning the cache by scanning it
+  --clean-incrementally : clean the cache without blocking concurrent compiles
+  --lock-report : print the time spent waiting for and holding cache locks
+  --reshard <depth> <width> : move the cache files to a new directory layout
 """.strip().format(VERSION))
         return 0
 
     cache = Cache()
 
+    if len(sys.argv) == 2 and sys.argv[1] == "--publish-spool":
+        publishWriteBackSpool(cache)
+        recordLockTimings(cache)
+        return 0
+
+    if len(sys.argv) == 2 and sys.argv[1] == "--clean-incrementally":
+        cleanCacheIncrementally(cache)
+        recordLockTimings(cache)
+        return 0
+
+    if len(sys.argv) == 2 and sys.argv[1] == "--lock-report":
+        printLockReport(cache)
+        return 0
+
     if len(sys.argv) == 2 and sys.argv[1] == "-s":
         with cache.lock:
             printStatistics(cache)
@@ -1481,6 +3855,12 @@ clcache.py v{}
         print('Cache cleared')
         return 0
 
+    if len(sys.argv) == 2 and sys.argv[1] == "--rebuild-index":
+        with cache.lock:
+            rebuildCacheIndex(cache)
+        print('Cache index rebuilt')
+        return 0
+
     if len(sys.argv) == 2 and sys.argv[1] == "-z":
         with cache.lock:
             resetStatistics(cache)
@@ -1502,6 +3882,19 @@ clcache.py v{}
             cfg.setMaximumCacheSize(maxSizeValue)
         return 0
 
+    if len(sys.argv) == 4 and sys.argv[1] == "--reshard":
+        try:
+            layout = ShardLayout(int(sys.argv[2]), int(sys.argv[3]))
+        except (ValueError, LogicException):
+            print("Unsupported shard layout: depth '{}', width '{}'.".format(sys.argv[2], sys.argv[3]),
+                  file=sys.stderr)
+            return 1
+        if reshardCache(cache, layout):
+            print("Some files are in use, run clcache --reshard again.", file=sys.stderr)
+            return 1
+        print('Cache resharded')
+        return 0
+
     compiler = findCompilerBinary()
     if not compiler:
         print("Failed to locate cl.exe on PATH (and CLCACHE_CL is not set), aborting.")
@@ -1514,6 +3907,7 @@ clcache.py v{}
         return invokeRealCompiler(compiler, sys.argv[1:])[0]
     try:
         exitCode, compilerStdout, compilerStderr = processCompileRequest(cache, compiler, sys.argv)
+        recordLockTimings(cache)
         printBinary(sys.stdout, compilerStdout.encode(CL_DEFAULT_CODEC))
         printBinary(sys.stderr, compilerStderr.encode(CL_DEFAULT_CODEC))
         return exitCode
@@ -1523,7 +3917,7 @@ clcache.py v{}
 
 
 def updateCacheStatistics(cache, method):
-    with cache.statistics.lock, cache.statistics as stats:
+    with cache.statistics as stats:
         method(stats)
 
 
@@ -1547,11 +3941,11 @@ def processCompileRequest(cache, compiler, args):
             else:
                 returnCode, compilerOutput, compilerStderr, cleanupRequired = \
                     processDirect(cache, objectFile, compiler, cmdLine, sourceFiles[0])
+                cache.fileHashIndex.save()
             printTraceStatement("Finished. Exit code {0:d}".format(returnCode))
 
             if cleanupRequired:
-                with cache.lock:
-                    cleanCache(cache)
+                launchCleaner(cache)
 
             return returnCode, compilerOutput, compilerStderr
     except InvalidArgumentError:
@@ -1586,34 +3980,53 @@ def processCompileRequest(cache, compiler, args):
 def processDirect(cache, objectFile, compiler, cmdLine, sourceFile):
     manifestHash = ManifestRepository.getManifestHash(compiler, cmdLine, sourceFile)
     manifestSection = cache.manifestRepository.section(manifestHash)
-    with manifestSection.lock:
-        manifest = manifestSection.getManifest(manifestHash)
-        if manifest is None:
-            return postprocessUnusableManifestMiss(
-                cache, objectFile, manifestSection, manifestHash, sourceFile, compiler, cmdLine,
-                Statistics.registerSourceChangedMiss)
-
-        for entryIndex, entry in enumerate(manifest.entries()):
-            # NOTE: command line options already included in hash for manifest name
-            try:
-                includesContentHash = ManifestRepository.getIncludesContentHashForFiles(
-                    [expandBasedirPlaceholder(path) for path in entry.includeFiles])
-
-                if entry.includesContentHash == includesContentHash:
-                    cachekey = entry.objectHash
-                    assert cachekey is not None
-                    # Move manifest entry to the top of the entries in the manifest
-                    manifest.touchEntry(entryIndex)
-                    manifestSection.setManifest(manifestHash, manifest)
-
-                    return getOrSetArtifacts(
-                        cache, cachekey, objectFile, compiler, cmdLine, Statistics.registerEvictedMiss)
-            except IncludeNotFoundException:
-                pass
-
+    missReason = None
+
+    def lookup():
+        nonlocal missReason
+        result, missReason = processManifestLookup(
+            cache, objectFile, manifestSection, manifestHash, compiler, cmdLine)
+        return result
+
+    result = lookup()
+    if result is not None:
+        return result
+
+    # Concurrent misses of the same manifest wait for the lease of the first
+    # one and look up the manifest entry it added.
+    leaseKey = manifestHash + ".manifest"
+    result, leaseToken = acquireCompileLease(cache, leaseKey, lookup)
+    if result is not None:
+        return result
+    with cache.compileLeases.held(leaseKey, leaseToken, compileLeaseExpiryMs() / 1000.0):
         return postprocessUnusableManifestMiss(
-            cache, objectFile, manifestSection, manifestHash, sourceFile, compiler, cmdLine,
-            Statistics.registerHeaderChangedMiss)
+            cache, objectFile, manifestSection, manifestHash, sourceFile, compiler, cmdLine, missReason)
+
+
+def processManifestLookup(cache, objectFile, manifestSection, manifestHash, compiler, cmdLine):
+    """Returns the result of processing the invocation via the manifest entry
+    matching the include files, or None and the kind of the cache miss if
+    there is no such entry."""
+    # Manifests are published atomically, so they can be read without a lock
+    manifest = manifestSection.getManifest(manifestHash)
+    if manifest is None:
+        return None, Statistics.registerSourceChangedMiss
+
+    # NOTE: command line options already included in hash for manifest name
+    entryIndex = ManifestDecisionTree(manifest.entries()).findEntry({}, cache.fileHashIndex)
+    if entryIndex is None:
+        return None, Statistics.registerHeaderChangedMiss
+
+    cachekey = manifest.entries()[entryIndex].objectHash
+    assert cachekey is not None
+    # Don't rewrite the manifest for moving the entry to the top, just record
+    # the access. This keeps cache hits free of writes to manifests.
+    if manifestSection.recordAccess(manifestHash, cachekey) > MAX_ACCESS_JOURNAL_SIZE:
+        with manifestSection.lock:
+            manifestSection.foldAccessJournal()
+
+    return getOrSetArtifacts(
+        cache, cachekey, objectFile, compiler, cmdLine, Statistics.registerEvictedMiss), None
 
 
 def processNoDirect(cache, objectFile, compiler, cmdLine, environment):
@@ -1623,22 +4036,66 @@ def processNoDirect(cache, objectFile, compiler, cmdLine, environment):
 
 def getOrSetArtifacts(cache, cachekey, objectFile, compiler, cmdLine, statsField, environment=None):
     artifactSection = cache.compilerArtifactsRepository.section(cachekey)
-    cleanupRequired = False
-    with artifactSection.lock:
-        if artifactSection.hasEntry(cachekey):
-            return processCacheHit(cache, objectFile, cachekey)
+    result = processCacheHit(cache, objectFile, cachekey)
+    if result is not None:
+        return result
+
+    # The section is not locked while compiling, so that compiles of other
+    # cache entries in the same section carry on. Concurrent misses of the
+    # same entry wait for the lease of the first one and reuse its result.
+    result, leaseToken = acquireCompileLease(
+        cache, cachekey, lambda: processCacheHit(cache, objectFile, cachekey))
+    if result is not None:
+        return result
 
+    cleanupRequired = False
+    with cache.compileLeases.held(cachekey, leaseToken, compileLeaseExpiryMs() / 1000.0):
+        compileStart = time.time()
         compilerResult = invokeRealCompiler(compiler, cmdLine, captureOutput=True, environment=environment)
+        compileDuration = time.time() - compileStart
         returnCode, compilerStdout, compilerStderr = compilerResult
-        with cache.statistics.lock, cache.statistics as stats:
+        if returnCode == 0 and os.path.exists(objectFile) and writeBackEnabled():
+            artifacts = CompilerArtifacts(objectFile, compilerStdout, compilerStderr)
+            spoolCacheEntry(cache, cachekey, artifacts, compileDuration, statsField)
+            return compilerResult + (False,)
+
+        with cache.statistics as stats:
             statsField(stats)
             if returnCode == 0 and os.path.exists(objectFile):
                 artifacts = CompilerArtifacts(objectFile, compilerStdout, compilerStderr)
-                cleanupRequired = addObjectToCache(stats, cache, artifactSection, cachekey, artifacts)
+                with artifactSection.lock:
+                    if cache.refreshShardLayouts():
+                        artifactSection = cache.compilerArtifactsRepository.section(cachekey)
+                    # Added meanwhile if the lease expired while compiling
+                    if not artifactSection.hasEntry(cachekey):
+                        cleanupRequired = addObjectToCache(
+                            stats, cache, artifactSection, cachekey, artifacts, compileDuration)
 
     return compilerResult + (cleanupRequired,)
 
 
+def acquireCompileLease(cache, leaseKey, lookup):
+    """Waits until either lookup() returns the result of a cache hit, e.g. on
+    the entry added by some other clcache invocation, or the lease for
+    compiling was acquired, returning its token. Leases are renewed while
+    compiling, so this waits for as long as the compile takes; expired
+    leases are taken over."""
+    expirySeconds = compileLeaseExpiryMs() / 1000.0
+    delay = 0.001
+    while True:
+        leaseToken = cache.compileLeases.acquire(leaseKey, expirySeconds)
+        # Some other clcache invocation may have added the entry meanwhile
+        result = lookup()
+        if result is not None:
+            if leaseToken is not None:
+                cache.compileLeases.release(leaseKey, leaseToken)
+            return result, None
+        if leaseToken is not None:
+            return None, leaseToken
+        time.sleep(delay)
+        delay = min(delay * 2, LOCK_POLL_INTERVAL)
+
+
 if __name__ == '__main__':
     if 'CLCACHE_PROFILE' in os.environ:
         INVOCATION_HASH = getStringHash(','.join(sys.argv))
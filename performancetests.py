@@ -9,14 +9,21 @@
 # In Python unittests are always members, not functions. Silence lint in this file.
 # pylint: disable=no-self-use
 #
-from multiprocessing import cpu_count
+from collections import defaultdict
+from multiprocessing import Pool, cpu_count
+import ctypes
+import functools
+import itertools
+import json
 import os
+import random
 import shutil
 import subprocess
 import sys
 import tempfile
 import timeit
 import unittest
+import unittest.mock
 
 import clcache
 
@@ -34,6 +41,77 @@ def takeTime(code):
     code()
     return timeit.default_timer() - start
 
+
+def peakMemoryUsage():
+    try:
+        import resource
+        # ru_maxrss is given in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [
+                ('cb', wintypes.DWORD),
+                ('PageFaultCount', wintypes.DWORD),
+                ('PeakWorkingSetSize', ctypes.c_size_t),
+                ('WorkingSetSize', ctypes.c_size_t),
+                ('QuotaPeakPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaPeakNonPagedPoolUsage', ctypes.c_size_t),
+                ('QuotaNonPagedPoolUsage', ctypes.c_size_t),
+                ('PagefileUsage', ctypes.c_size_t),
+                ('PeakPagefileUsage', ctypes.c_size_t),
+            ]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        ctypes.windll.psapi.GetProcessMemoryInfo(
+            ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb)
+        return counters.PeakWorkingSetSize
+
+
+def readAllFileHash(filePath):
+    # How getFileHash() used to work before hashing files chunk-wise
+    hasher = clcache.newHasher()
+    with open(filePath, 'rb') as inFile:
+        hasher.update(inFile.read())
+    return hasher.hexdigest()
+
+
+def measureFileHashing(filePath, streaming):
+    # Executed in a dedicated process per measurement, such that the peak
+    # memory usage is not distorted by earlier measurements.
+    hashFunction = clcache.getFileHash if streaming else readAllFileHash
+    baseline = peakMemoryUsage()
+    start = timeit.default_timer()
+    fileHash = hashFunction(filePath)
+    duration = timeit.default_timer() - start
+    print(fileHash, duration, peakMemoryUsage() - baseline)
+
+
+def createHeaderTree(directory, numHeaders, headerSize=20 * 1024):
+    os.makedirs(directory)
+    headers = []
+    for i in range(numHeaders):
+        path = os.path.join(directory, 'header{:04d}.h'.format(i))
+        with open(path, 'w') as f:
+            f.write('// header {}\n'.format(i).ljust(headerSize, '/'))
+        # Make sure the headers are not considered to be modified concurrently
+        mtime = os.stat(path).st_mtime - 60
+        os.utime(path, (mtime, mtime))
+        headers.append(os.path.normcase(os.path.abspath(path)))
+    return headers
+
+
+def populateDirectModeCache(cache, compiler, cmdLine, sourceFile, objectFile, headers):
+    manifestHash = clcache.ManifestRepository.getManifestHash(compiler, cmdLine, sourceFile)
+    entry = clcache.createManifestEntry(manifestHash, headers)
+    cache.manifestRepository.section(manifestHash).setManifest(manifestHash, clcache.Manifest([entry]))
+    artifacts = clcache.CompilerArtifacts(objectFile, '', '')
+    cache.compilerArtifactsRepository.section(entry.objectHash).setEntry(entry.objectHash, artifacts)
+
+
 class TestConcurrency(unittest.TestCase):
     NUM_SOURCE_FILES = 30
 
@@ -78,12 +156,17 @@ class TestConcurrency(unittest.TestCase):
                 self.assertEqual(stats.numCacheMisses(), len(TestConcurrency.sources))
                 self.assertEqual(stats.numCacheEntries(), len(TestConcurrency.sources))
 
-            # Recompile with many concurrent processes, measuring time
-            cmd = CLCACHE_CMD + ['/nologo', '/EHsc', '/c', '/MP{}'.format(cpu_count())] + TestConcurrency.sources
-            hotCacheConcurrent = takeTime(lambda: subprocess.check_call(cmd, env=customEnv))
+            # Recompile with an increasing number of concurrent processes,
+            # measuring time. Cache hits don't lock, so this should scale with
+            # the number of cores.
+            jobCounts = sorted(set([1, 2, 4, cpu_count()]))
+            hotCacheConcurrent = []
+            for jobs in jobCounts:
+                cmd = CLCACHE_CMD + ['/nologo', '/EHsc', '/c', '/MP{}'.format(jobs)] + TestConcurrency.sources
+                hotCacheConcurrent.append(takeTime(functools.partial(subprocess.check_call, cmd, env=customEnv)))
 
             with cache.statistics as stats:
-                self.assertEqual(stats.numCacheHits(), len(TestConcurrency.sources) * 2)
+                self.assertEqual(stats.numCacheHits(), len(TestConcurrency.sources) * (1 + len(jobCounts)))
                 self.assertEqual(stats.numCacheMisses(), len(TestConcurrency.sources))
                 self.assertEqual(stats.numCacheEntries(), len(TestConcurrency.sources))
 
@@ -91,8 +174,490 @@ class TestConcurrency(unittest.TestCase):
                   .format(len(TestConcurrency.sources), coldCacheSequential))
             print("Compiling {} source files sequentially, hot cache: {} seconds"
                   .format(len(TestConcurrency.sources), hotCacheSequential))
-            print("Compiling {} source files concurrently via /MP{}, hot cache: {} seconds"
-                  .format(len(TestConcurrency.sources), cpu_count(), hotCacheConcurrent))
+            for jobs, duration in zip(jobCounts, hotCacheConcurrent):
+                print("Compiling {} source files concurrently via /MP{}, hot cache: {} seconds ({:.2f}x speedup)"
+                      .format(len(TestConcurrency.sources), jobs, duration, hotCacheSequential / duration))
+
+
+def registerCacheHits(statsFile, shards, count):
+    # Runs in a separate process; with a single shard, all processes update
+    # the same file like before the statistics were sharded.
+    clcache.STATISTICS_SHARDS = shards
+    statistics = clcache.Statistics(statsFile)
+    for _ in range(count):
+        with statistics as stats:
+            stats.registerCacheHit()
+
+
+class TestStatisticsThroughput(unittest.TestCase):
+    NUM_UPDATES = 200
+
+    def _updatesPerSecond(self, shards, jobs):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, 'stats.txt')
+            with Pool(jobs) as pool:
+                duration = takeTime(lambda: pool.starmap(
+                    registerCacheHits, [(statsFile, shards, TestStatisticsThroughput.NUM_UPDATES)] * jobs))
+
+            with clcache.Statistics(statsFile) as stats:
+                self.assertEqual(stats.numCacheHits(), TestStatisticsThroughput.NUM_UPDATES * jobs)
+            return TestStatisticsThroughput.NUM_UPDATES * jobs / duration
+
+    def testConcurrentUpdates(self):
+        for jobs in sorted(set([1, 2, 4, cpu_count()])):
+            single = self._updatesPerSecond(1, jobs)
+            sharded = self._updatesPerSecond(clcache.STATISTICS_SHARDS, jobs)
+            print("Registering cache hits from {} processes: {:.0f} updates/s with a single statistics file, "
+                  "{:.0f} updates/s with {} shards".format(jobs, single, sharded, clcache.STATISTICS_SHARDS))
+
+
+def acquireLocks(paths, count):
+    # Runs in a separate process
+    locks = [clcache.CacheLock.forPath(path) for path in paths]
+    for i in range(count):
+        with locks[i % len(locks)]:
+            pass
+
+
+class TestLockThroughput(unittest.TestCase):
+    NUM_ACQUISITIONS = 2000
+
+    def _acquisitionsPerSecond(self, jobs, sharedLock):
+        with tempfile.TemporaryDirectory() as tempDir:
+            if sharedLock:
+                paths = [[os.path.join(tempDir, 'section')]] * jobs
+            else:
+                paths = [[os.path.join(tempDir, 'section{}'.format(job))] for job in range(jobs)]
+            with Pool(jobs) as pool:
+                duration = takeTime(lambda: pool.starmap(
+                    acquireLocks, [(p, TestLockThroughput.NUM_ACQUISITIONS) for p in paths]))
+            return TestLockThroughput.NUM_ACQUISITIONS * jobs / duration
+
+    def testConcurrentAcquisitions(self):
+        for jobs in sorted(set([1, 2, 4, cpu_count()])):
+            print("Acquiring locks from {} processes: {:.0f} acquisitions/s of one lock, "
+                  "{:.0f} acquisitions/s of a lock per process".format(
+                      jobs, self._acquisitionsPerSecond(jobs, True), self._acquisitionsPerSecond(jobs, False)))
+
+
+def readSection(cacheDir, shared, count):
+    # Runs in a separate process
+    section = clcache.Cache(cacheDir).compilerArtifactsRepository.section('ab')
+    lock = section.sharedLock if shared else section.lock
+    for _ in range(count):
+        with lock:
+            section.recordedEntries()
+
+
+class TestSectionReaderContention(unittest.TestCase):
+    NUM_ENTRIES = 1000
+    NUM_READS = 50
+
+    def _readsPerSecond(self, cacheDir, jobs, shared):
+        with Pool(jobs) as pool:
+            duration = takeTime(lambda: pool.starmap(
+                readSection, [(cacheDir, shared, TestSectionReaderContention.NUM_READS)] * jobs))
+        return TestSectionReaderContention.NUM_READS * jobs / duration
+
+    def testParallelReaders(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            section = clcache.Cache(tempDir).compilerArtifactsRepository.section('ab')
+            for i in range(TestSectionReaderContention.NUM_ENTRIES):
+                section.setEntry('ab{:030d}'.format(i), clcache.CompilerArtifacts(None, '', ''))
+
+            for jobs in sorted(set([1, 2, 4, cpu_count()])):
+                print("Reading one section from {} processes: {:.0f} reads/s with exclusive locks, "
+                      "{:.0f} reads/s with shared locks".format(
+                          jobs, self._readsPerSecond(tempDir, jobs, False), self._readsPerSecond(tempDir, jobs, True)))
+
+
+class TestDirectModeHitLatency(unittest.TestCase):
+    NUM_HEADERS = 800
+    NUM_RUNS = 10
+
+    def testFileHashIndex(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headers = createHeaderTree(os.path.join(tempDir, 'include'), TestDirectModeHitLatency.NUM_HEADERS)
+            sourceFile = os.path.join(tempDir, 'main.cpp')
+            objectFile = os.path.join(tempDir, 'main.obj')
+            for path in [sourceFile, objectFile]:
+                with open(path, 'w') as f:
+                    f.write('int main() { return 0; }')
+
+            # The compiler is never invoked for cache hits, any file will do
+            compiler = PYTHON_BINARY
+            cmdLine = ['/nologo', '/c', sourceFile]
+
+            cache = clcache.Cache(os.path.join(tempDir, 'cache'))
+            populateDirectModeCache(cache, compiler, cmdLine, sourceFile, objectFile, headers)
+
+            def processHit():
+                cache.fileHashIndex = clcache.FileHashIndex(os.path.join(cache.dir, 'hashindex'))
+                clcache.processDirect(cache, objectFile, compiler, cmdLine, sourceFile)
+                cache.fileHashIndex.save()
+
+            def processHitColdIndex():
+                shutil.rmtree(os.path.join(cache.dir, 'hashindex'))
+                processHit()
+
+            processHit()
+            coldIndex = min(takeTime(processHitColdIndex) for _ in range(TestDirectModeHitLatency.NUM_RUNS))
+            warmIndex = min(takeTime(processHit) for _ in range(TestDirectModeHitLatency.NUM_RUNS))
+
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheHits(), 2 * TestDirectModeHitLatency.NUM_RUNS + 1)
+
+            print("Direct mode hit with {} headers, hashing all headers: {} seconds"
+                  .format(TestDirectModeHitLatency.NUM_HEADERS, coldIndex))
+            print("Direct mode hit with {} headers, using file hash index: {} seconds"
+                  .format(TestDirectModeHitLatency.NUM_HEADERS, warmIndex))
+
+
+class TestFileHashing(unittest.TestCase):
+    FILE_SIZES = [1024, 1024 * 1024, 64 * 1024 * 1024, 500 * 1024 * 1024]
+
+    def _measure(self, filePath, streaming):
+        code = 'import performancetests; performancetests.measureFileHashing({!r}, {!r})'.format(filePath, streaming)
+        output = subprocess.check_output([PYTHON_BINARY, '-c', code],
+                                         cwd=os.path.dirname(os.path.realpath(__file__)))
+        fileHash, duration, peakMemory = output.decode().split()
+        return fileHash, float(duration), int(peakMemory)
+
+    def testStreamingHashing(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filePath = os.path.join(tempDir, 'data.bin')
+            for size in TestFileHashing.FILE_SIZES:
+                with open(filePath, 'wb') as f:
+                    chunk = os.urandom(1024 * 1024)
+                    for _ in range(size // len(chunk)):
+                        f.write(chunk)
+                    f.write(chunk[:size % len(chunk)])
+
+                readAllHash, readAllDuration, readAllMemory = self._measure(filePath, streaming=False)
+                streamingHash, streamingDuration, streamingMemory = self._measure(filePath, streaming=True)
+                self.assertEqual(readAllHash, streamingHash)
+
+                for mode, duration, memory in [('reading whole file', readAllDuration, readAllMemory),
+                                               ('streaming', streamingDuration, streamingMemory)]:
+                    print("Hashing {:,} bytes, {}: {:.1f} MB/s, peak memory increase {:,} bytes"
+                          .format(size, mode, size / max(duration, 1e-9) / 1e6, memory))
+
+
+class TestParallelHashing(unittest.TestCase):
+    NUM_HEADERS = 800
+    THREAD_COUNTS = [1, 2, 4, 8, 16]
+    NUM_RUNS = 5
+
+    def testIncludesContentHashScaling(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headers = createHeaderTree(os.path.join(tempDir, 'include'), TestParallelHashing.NUM_HEADERS)
+            for threadCount in TestParallelHashing.THREAD_COUNTS:
+                with unittest.mock.patch.dict(os.environ, {'CLCACHE_HASH_THREADS': str(threadCount)}):
+                    duration = min(
+                        takeTime(lambda: clcache.ManifestRepository.getIncludesContentHashForFiles(headers))
+                        for _ in range(TestParallelHashing.NUM_RUNS))
+                print("Hashing {} headers using {} threads: {} seconds"
+                      .format(len(headers), threadCount, duration))
+
+
+def createNearIdenticalManifestEntries(manifestHash, headers, numEntries):
+    # All entries but the last one differ from the current state of the
+    # headers in a single header each, like after switching branches a few
+    # times. The last entry is the only one matching.
+    matchingEntry = clcache.createManifestEntry(manifestHash, headers)
+    entries = []
+    for i in range(numEntries - 1):
+        includeHashes = list(matchingEntry.includeHashes)
+        includeHashes[(i * 7919) % len(includeHashes)] = clcache.getStringHash(str(i))
+        entries.append(matchingEntry._replace(
+            includeHashes=includeHashes,
+            includesContentHash=clcache.ManifestRepository.getIncludesContentHashForHashes(includeHashes)))
+    return entries + [matchingEntry]
+
+
+class TestManifestEntryVerification(unittest.TestCase):
+    NUM_HEADERS = 800
+    NUM_ENTRIES = 100
+    NUM_ENTRIES_RAISED_LIMIT = 500
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tempDir = tempfile.TemporaryDirectory()
+        cls.headers = createHeaderTree(os.path.join(cls.tempDir.name, 'include'),
+                                       TestManifestEntryVerification.NUM_HEADERS, headerSize=4096)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempDir.cleanup()
+
+    def _createEntries(self, numEntries):
+        return createNearIdenticalManifestEntries(
+            'ffffffffffffffffffffffffffffffff', TestManifestEntryVerification.headers, numEntries)
+
+    def _measureLookups(self, entries, lookups):
+        for description, lookup in lookups:
+            self.assertEqual(lookup(), entries[-1])
+            print("Finding matching entry among {} entries with {} headers, {}: {} seconds"
+                  .format(len(entries), len(TestManifestEntryVerification.headers), description, takeTime(lookup)))
+
+    @staticmethod
+    def _findEntryHashingAllIncludes(entries):
+        # How manifest entries used to be verified
+        for entry in entries:
+            if entry.includesContentHash == \
+                    clcache.ManifestRepository.getIncludesContentHashForFiles(entry.includeFiles):
+                return entry
+        return None
+
+    @staticmethod
+    def _findEntryWithEarlyExit(entries):
+        knownHashes = {}
+        for entry in entries:
+            if clcache.verifyManifestEntry(entry, knownHashes):
+                return entry
+        return None
+
+    @staticmethod
+    def _findEntryUsingDecisionTree(entries):
+        return entries[clcache.ManifestDecisionTree(entries).findEntry({})]
+
+    def testNearIdenticalEntries(self):
+        entries = self._createEntries(TestManifestEntryVerification.NUM_ENTRIES)
+        self._measureLookups(entries, [
+            ('hashing all includes', lambda: self._findEntryHashingAllIncludes(entries)),
+            ('linear scan with early exit', lambda: self._findEntryWithEarlyExit(entries)),
+            ('decision tree', lambda: self._findEntryUsingDecisionTree(entries)),
+        ])
+
+    def testManyNearIdenticalEntries(self):
+        entries = self._createEntries(TestManifestEntryVerification.NUM_ENTRIES_RAISED_LIMIT)
+        self._measureLookups(entries, [
+            ('linear scan with early exit', lambda: self._findEntryWithEarlyExit(entries)),
+            ('decision tree', lambda: self._findEntryUsingDecisionTree(entries)),
+        ])
+
+
+class TestManifestFileFormat(unittest.TestCase):
+    NUM_ENTRIES = 100
+    NUM_HEADERS = 1000
+    NUM_RUNS = 5
+
+    @staticmethod
+    def _dumpJson(manifestPath, manifest):
+        # How manifests used to be stored
+        with open(manifestPath, 'w') as outFile:
+            entries = [e._asdict() for e in manifest.entries()]
+            json.dump({'entries': entries}, outFile, sort_keys=True, indent=2)
+
+    @staticmethod
+    def _loadJson(manifestPath):
+        with open(manifestPath, 'r') as inFile:
+            doc = json.load(inFile)
+            return clcache.Manifest([clcache.ManifestEntry(e['includeFiles'], e['includeHashes'],
+                                                           e['includesContentHash'], e['objectHash'])
+                                     for e in doc['entries']])
+
+    def testLoadAndDump(self):
+        includeDir = r'c:\program files (x86)\windows kits\10\include\10.0.14393.0\um'
+        headers = [os.path.join(includeDir, 'header{:04d}.h'.format(i))
+                   for i in range(TestManifestFileFormat.NUM_HEADERS)]
+        includeHashes = [clcache.getStringHash(path) for path in headers]
+        entries = []
+        for i in range(TestManifestFileFormat.NUM_ENTRIES):
+            # Entries differ in a few include files and their hashes
+            entryHeaders = headers[i:]
+            entryHashes = includeHashes[i:]
+            entryHashes[i] = clcache.getStringHash(str(i))
+            entries.append(clcache.ManifestEntry(
+                entryHeaders, entryHashes,
+                clcache.ManifestRepository.getIncludesContentHashForHashes(entryHashes),
+                clcache.getStringHash('object{}'.format(i))))
+        manifest = clcache.Manifest(entries)
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            manifestHash = 'ffffffffffffffffffffffffffffffff'
+            section = clcache.ManifestSection(tempDir)
+            jsonPath = os.path.join(tempDir, 'manifest.json')
+
+            formats = [
+                ('JSON', jsonPath,
+                 lambda: TestManifestFileFormat._dumpJson(jsonPath, manifest),
+                 lambda: TestManifestFileFormat._loadJson(jsonPath)),
+                ('binary', section.manifestPath(manifestHash),
+                 lambda: section.setManifest(manifestHash, manifest),
+                 lambda: section.getManifest(manifestHash)),
+            ]
+            for name, path, dump, load in formats:
+                dumpTime = min(takeTime(dump) for _ in range(TestManifestFileFormat.NUM_RUNS))
+                loadTime = min(takeTime(load) for _ in range(TestManifestFileFormat.NUM_RUNS))
+                self.assertEqual(load().entries(), entries)
+                print("Manifest with {} entries of {} headers, {} format: {:,} bytes, dump {} seconds, load {} seconds"
+                      .format(len(entries), TestManifestFileFormat.NUM_HEADERS, name, os.path.getsize(path),
+                              dumpTime, loadTime))
+
+
+class TestHashAlgorithms(unittest.TestCase):
+    # (number of headers, size of each header) resembling a typical include
+    # set with many small, some medium and few large (e.g. SDK) headers
+    INCLUDE_SET = [(500, 4 * 1024), (250, 32 * 1024), (50, 256 * 1024)]
+    NUM_RUNS = 5
+
+    def testHeaderHashingThroughput(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            headers = []
+            for i, (numHeaders, headerSize) in enumerate(TestHashAlgorithms.INCLUDE_SET):
+                headers += createHeaderTree(os.path.join(tempDir, 'include{}'.format(i)), numHeaders, headerSize)
+            totalSize = sum(numHeaders * headerSize for numHeaders, headerSize in TestHashAlgorithms.INCLUDE_SET)
+
+            for name in sorted(clcache.HASH_ALGORITHMS):
+                with unittest.mock.patch.dict(os.environ, {'CLCACHE_HASH_ALGORITHM': name}):
+                    duration = min(takeTime(lambda: clcache.getFileHashes(headers))
+                                   for _ in range(TestHashAlgorithms.NUM_RUNS))
+                print("Hashing {} headers ({:,} bytes) using {}: {:.4f} seconds, {:.1f} MB/s"
+                      .format(len(headers), totalSize, name, duration, totalSize / duration / 1e6))
+
+
+def createObjectFile(filePath, size):
+    # Resemble the compressibility of object files: mostly symbol names,
+    # relocation tables and padding, with some high entropy machine code.
+    with open(CLCACHE_SCRIPT, 'rb') as f:
+        text = f.read()
+    with open(filePath, 'wb') as f:
+        written = 0
+        while written < size:
+            block = os.urandom(1024) + text[written % len(text):][:2048] + b'\0' * 1024
+            f.write(block)
+            written += len(block)
+
+
+class TestCompression(unittest.TestCase):
+    OBJECT_SIZE = 8 * 1024 * 1024
+    NUM_RUNS = 5
+
+    def _measureHit(self, objectFile, compression, level):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(tempDir)
+            cachekey = "fdde59862785f9f0ad6e661b9b5746b7"
+            env = {'CLCACHE_COMPRESS': compression or '', 'CLCACHE_COMPRESSLEVEL': str(level)}
+            with unittest.mock.patch.dict(os.environ, env):
+                section = cache.compilerArtifactsRepository.section(cachekey)
+                storedSize = section.setEntry(cachekey, clcache.CompilerArtifacts(objectFile, "", ""))
+
+            restoredFile = os.path.join(tempDir, "restored.obj")
+            duration = min(takeTime(lambda: clcache.processCacheHit(cache, restoredFile, cachekey))
+                           for _ in range(TestCompression.NUM_RUNS))
+            return storedSize, duration
+
+    def testHitLatencyByCompressionLevel(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "main.obj")
+            createObjectFile(objectFile, TestCompression.OBJECT_SIZE)
+            objectSize = os.path.getsize(objectFile)
+
+            storedSize, duration = self._measureHit(objectFile, None, 0)
+            print("Cache hit for {:,} byte object, uncompressed: {:.4f} seconds".format(objectSize, duration))
+
+            levels = {'zlib': [1, 6, 9], 'lzma': [0, 6, 9]}
+            for compression in sorted(clcache.COMPRESSION_METHODS):
+                for level in levels[compression]:
+                    storedSize, duration = self._measureHit(objectFile, compression, level)
+                    print("Cache hit for {:,} byte object, {} level {}: {:.4f} seconds, stored {:,} bytes ({:.1%})"
+                          .format(objectSize, compression, level, duration, storedSize, storedSize / objectSize))
+
+
+class TestObjectRestore(unittest.TestCase):
+    OBJECT_SIZE = 64 * 1024 * 1024
+    NUM_RUNS = 5
+
+    def testRestoreMethods(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "main.obj")
+            createObjectFile(objectFile, TestObjectRestore.OBJECT_SIZE)
+            restoredFile = os.path.join(tempDir, "restored.obj")
+
+            for name, method in clcache.FileCopier().methods:
+                try:
+                    method(objectFile, restoredFile)
+                except OSError as e:
+                    print("Restoring object file via {}: not supported ({})".format(name, e))
+                    continue
+                duration = min(takeTime(functools.partial(method, objectFile, restoredFile))
+                               for _ in range(TestObjectRestore.NUM_RUNS))
+                print("Restoring {:,} byte object file via {}: {:.4f} seconds"
+                      .format(os.path.getsize(objectFile), name, duration))
+
+
+class TestEvictionPolicy(unittest.TestCase):
+    """Replays an access trace against a cache which is too small to hold all
+    objects and reports the hit rate and the share of the compile time saved
+    by cache hits."""
+    NUM_KEYS = 400
+    NUM_HOT_KEYS = 40
+    TRACE_LENGTH = 4000
+    OBJECT_SIZE = 1024
+    MAXIMUM_SIZE = 80 * OBJECT_SIZE
+
+    def _accessTrace(self):
+        rng = random.Random(42)
+        keys = ['{:032x}'.format(rng.getrandbits(128)) for _ in range(TestEvictionPolicy.NUM_KEYS)]
+        hotKeys = keys[:TestEvictionPolicy.NUM_HOT_KEYS]
+        # Most compilations are of the same few files, the others are scattered
+        return [rng.choice(hotKeys) if rng.random() < 0.8 else rng.choice(keys)
+                for _ in range(TestEvictionPolicy.TRACE_LENGTH)]
+
+    def _replay(self, trace, objectSizes, compileDurations, evictionPolicy=clcache.EVICTION_POLICY_LRU):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(tempDir)
+            repository = cache.compilerArtifactsRepository
+            objectFile = os.path.join(tempDir, "main.obj")
+
+            hits = 0
+            savedTime = 0.0
+            currentSize = 0
+            for key in trace:
+                if clcache.processCacheHit(cache, objectFile, key) is not None:
+                    hits += 1
+                    savedTime += compileDurations[key]
+                    continue
+                with open(objectFile, 'wb') as f:
+                    f.write(key.encode('ascii').ljust(objectSizes[key], b'\0'))
+                currentSize += repository.section(key).setEntry(
+                    key, clcache.CompilerArtifacts(objectFile, "", ""), compileDurations[key])
+                if currentSize >= TestEvictionPolicy.MAXIMUM_SIZE:
+                    currentSize = repository.clean(TestEvictionPolicy.MAXIMUM_SIZE * 0.9, evictionPolicy)[1]
+            return hits / len(trace), savedTime / sum(compileDurations[key] for key in trace)
+
+    def testHitRateRetention(self):
+        trace = self._accessTrace()
+        objectSizes = defaultdict(lambda: TestEvictionPolicy.OBJECT_SIZE)
+        compileDurations = defaultdict(lambda: 1.0)
+        # Use a logical clock, so that every recorded use has a distinct time
+        clock = itertools.count(1000)
+        with unittest.mock.patch('clcache.time.time', side_effect=lambda: next(clock)):
+            withUses, _ = self._replay(trace, objectSizes, compileDurations)
+            with unittest.mock.patch('clcache.SectionLedger.recordUse', return_value=0):
+                withoutUses, _ = self._replay(trace, objectSizes, compileDurations)
+
+        print("Hit rate with {} accesses to {} keys, capacity {} entries: {:.1%} using the recorded last use, "
+              "{:.1%} using the time entries were written".format(
+                  len(trace), TestEvictionPolicy.NUM_KEYS,
+                  TestEvictionPolicy.MAXIMUM_SIZE // TestEvictionPolicy.OBJECT_SIZE, withUses, withoutUses))
+        self.assertGreater(withUses, withoutUses)
+
+    def testCostAwareEviction(self):
+        trace = self._accessTrace()
+        # Compile durations vary a lot more than object sizes; a few
+        # translation units take very long
+        rng = random.Random(4711)
+        objectSizes = {key: rng.randint(TestEvictionPolicy.OBJECT_SIZE // 2, TestEvictionPolicy.OBJECT_SIZE * 2)
+                       for key in set(trace)}
+        compileDurations = {key: min(rng.paretovariate(1.2), 60.0) for key in set(trace)}
+        clock = itertools.count(1000)
+        with unittest.mock.patch('clcache.time.time', side_effect=lambda: next(clock)):
+            for evictionPolicy in clcache.EVICTION_POLICIES:
+                hitRate, savedTime = self._replay(trace, objectSizes, compileDurations, evictionPolicy)
+                print("Eviction policy {}: hit rate {:.1%}, saved {:.1%} of the compile time"
+                      .format(evictionPolicy, hitRate, savedTime))
 
 
 if __name__ == '__main__':
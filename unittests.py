@@ -10,23 +10,43 @@
 # pylint: disable=no-self-use
 #
 from contextlib import contextmanager
+import errno
+import io
+import json
 import multiprocessing
 import os
+import sys
+import threading
+import time
 import unittest
+from unittest.mock import patch
 import tempfile
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 import clcache
 from clcache import (
+    BlobStore,
+    CacheLock,
     CommandLineAnalyzer,
     CompilerArtifactsRepository,
     Configuration,
+    FileHashIndex,
+    LockStatistics,
+    LockTiming,
     Manifest,
     ManifestEntry,
     ManifestRepository,
+    SectionLedger,
+    ShardLayout,
     Statistics,
 )
 from clcache import (
     AnalysisError,
+    CacheLockException,
     CalledForLinkError,
     CalledForPreprocessingError,
     InvalidArgumentError,
@@ -101,6 +121,227 @@ class TestHelperFunctions(unittest.TestCase):
             self.assertIn(r".\d\4.txt", files)
             self.assertIn(r".\d\e\5.txt", files)
 
+    @unittest.skipIf(sys.platform == 'win32', "file modes are used on POSIX systems only")
+    def testWriteFileAtomicallyUsesUmask(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filePath = os.path.join(tempDir, 'data.txt')
+            previousUmask = os.umask(0o022)
+            try:
+                clcache.writeFileAtomically(filePath, b'data')
+            finally:
+                os.umask(previousUmask)
+            self.assertEqual(os.stat(filePath).st_mode & 0o777, 0o644)
+            self.assertEqual(os.listdir(tempDir), ['data.txt'])
+
+
+class TestGetFileHash(unittest.TestCase):
+    def _assertHashOfContents(self, contents):
+        with tempfile.TemporaryDirectory() as tempDir:
+            filePath = os.path.join(tempDir, 'data.bin')
+            with open(filePath, 'wb') as f:
+                f.write(contents)
+            self.assertEqual(clcache.getFileHash(filePath), clcache.newHasher(contents).hexdigest())
+            self.assertEqual(clcache.getFileHash(filePath, 'extra'),
+                             clcache.newHasher(contents + b'extra').hexdigest())
+
+    def testEmptyFile(self):
+        self._assertHashOfContents(b'')
+
+    def testChunkBoundaries(self):
+        for size in [clcache.HASH_CHUNK_SIZE - 1, clcache.HASH_CHUNK_SIZE, 3 * clcache.HASH_CHUNK_SIZE + 1]:
+            self._assertHashOfContents(bytes(i % 251 for i in range(size)))
+
+    def testMappedFile(self):
+        self._assertHashOfContents(b'0123456789abcdef' * (clcache.HASH_MMAP_THRESHOLD // 16 + 1))
+
+
+class TestGetFileHashes(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls.tempDir = tempfile.TemporaryDirectory()
+        cls.filePaths = []
+        for i in range(2 * clcache.PARALLEL_HASHING_THRESHOLD):
+            filePath = os.path.join(cls.tempDir.name, 'file{}.h'.format(i))
+            with open(filePath, 'w') as f:
+                f.write('#define FILE{}'.format(i))
+            cls.filePaths.append(filePath)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.tempDir.cleanup()
+
+    def testOrderIsPreserved(self):
+        expectedHashes = [clcache.getFileHash(path) for path in TestGetFileHashes.filePaths]
+        for threadCount in ['1', '4', '64']:
+            with patch.dict(os.environ, {'CLCACHE_HASH_THREADS': threadCount}):
+                self.assertEqual(clcache.getFileHashes(TestGetFileHashes.filePaths), expectedHashes)
+                self.assertEqual(clcache.getFileHashes(TestGetFileHashes.filePaths[:2]), expectedHashes[:2])
+
+    def testMissingFile(self):
+        filePaths = TestGetFileHashes.filePaths + [os.path.join(TestGetFileHashes.tempDir.name, 'nonexisting.h')]
+        with patch.dict(os.environ, {'CLCACHE_HASH_THREADS': '4'}):
+            with self.assertRaises(FileNotFoundError):
+                clcache.getFileHashes(filePaths)
+
+    def testExecutorIsReused(self):
+        with patch.dict(os.environ, {'CLCACHE_HASH_THREADS': '4'}):
+            clcache.getFileHashes(TestGetFileHashes.filePaths)
+            executor = clcache.hashingExecutor()
+            clcache.getFileHashes(TestGetFileHashes.filePaths)
+            self.assertIs(clcache.hashingExecutor(), executor)
+
+
+class TestHashAlgorithms(unittest.TestCase):
+    def testDefault(self):
+        with patch.dict(os.environ):
+            os.environ.pop('CLCACHE_HASH_ALGORITHM', None)
+            self.assertEqual(clcache.hashAlgorithmName(), clcache.DEFAULT_HASH_ALGORITHM)
+
+    def testUnsupported(self):
+        with patch.dict(os.environ, {'CLCACHE_HASH_ALGORITHM': 'crc32'}):
+            with self.assertRaises(clcache.LogicException):
+                clcache.getStringHash('foo')
+
+    def testAllAlgorithms(self):
+        for name, algorithm in clcache.HASH_ALGORITHMS.items():
+            with patch.dict(os.environ, {'CLCACHE_HASH_ALGORITHM': name}):
+                self.assertEqual(clcache.getStringHash('foo'), algorithm(b'foo').hexdigest())
+
+    def testManifestHashesDoNotAlias(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            sourceFile = os.path.join(tempDir, 'main.cpp')
+            with open(sourceFile, 'w') as f:
+                f.write('int main() { return 0; }')
+
+            manifestHashes = set()
+            for name in clcache.HASH_ALGORITHMS:
+                with patch.dict(os.environ, {'CLCACHE_HASH_ALGORITHM': name}):
+                    manifestHashes.add(ManifestRepository.getManifestHash(sourceFile, ['/c'], sourceFile))
+            self.assertEqual(len(manifestHashes), len(clcache.HASH_ALGORITHMS))
+
+
+class TestCompression(unittest.TestCase):
+    def testDisabledByDefault(self):
+        with patch.dict(os.environ):
+            os.environ.pop('CLCACHE_COMPRESS', None)
+            self.assertIsNone(clcache.compressionMethod())
+
+    def testUnsupported(self):
+        with patch.dict(os.environ, {'CLCACHE_COMPRESS': 'rar'}):
+            with self.assertRaises(clcache.LogicException):
+                clcache.compressionMethod()
+
+    def testStoreAndRestore(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "main.obj")
+            contents = os.urandom(1000) + b'\0' * 300 * 1024
+            with open(objectFile, 'wb') as f:
+                f.write(contents)
+
+            key = "fdde59862785f9f0ad6e661b9b5746b7"
+            for method in clcache.COMPRESSION_METHODS:
+                for level in ['1', '9']:
+                    with patch.dict(os.environ, {'CLCACHE_COMPRESS': method, 'CLCACHE_COMPRESSLEVEL': level}):
+                        cacheDir = os.path.join(tempDir, "cache-{}-{}".format(method, level))
+                        car = CompilerArtifactsRepository(os.path.join(cacheDir, "objects"),
+                                                          BlobStore(os.path.join(cacheDir, "blobs")))
+                        storedSize = car.section(key).setEntry(key, clcache.CompilerArtifacts(objectFile, "", ""))
+                        self.assertLess(storedSize, len(contents) / 10)
+                        self.assertEqual(car.section(key).readEntry(key)[1], len(contents))
+
+                    # Restoring does not depend on the current setting
+                    restoredFile = os.path.join(tempDir, "restored.obj")
+                    clcache.restoreObjectFile(car.section(key).getEntry(key).objectFilePath, restoredFile)
+                    with open(restoredFile, 'rb') as f:
+                        self.assertEqual(f.read(), contents)
+
+    def testCorruptCompressedObject(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cachedObject = os.path.join(tempDir, "0123.zlib")
+            with open(cachedObject, 'wb') as f:
+                f.write(b'garbage')
+
+            restoredFile = os.path.join(tempDir, "restored.obj")
+            with self.assertRaises(IOError):
+                clcache.restoreObjectFile(cachedObject, restoredFile)
+            self.assertEqual(os.listdir(tempDir), ["0123.zlib"])
+
+    def testTruncatedCompressedObject(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            contents = os.urandom(100000)
+            for method in clcache.COMPRESSION_METHODS:
+                compressor = clcache.COMPRESSION_METHODS[method].newCompressor(1)
+                data = compressor.compress(contents) + compressor.flush()
+                cachedObject = os.path.join(tempDir, "0123." + method)
+                with open(cachedObject, 'wb') as f:
+                    f.write(data[:len(data) // 2])
+
+                restoredFile = os.path.join(tempDir, "objects", "restored.obj")
+                with self.assertRaises(IOError):
+                    clcache.restoreObjectFile(cachedObject, restoredFile)
+                self.assertFalse(os.path.exists(restoredFile))
+                self.assertEqual(os.listdir(os.path.join(tempDir, "objects")), [])
+
+
+class TestFileCopier(unittest.TestCase):
+    def _createFile(self, directory, contents=b'object file contents'):
+        filePath = os.path.join(directory, "main.obj")
+        with open(filePath, 'wb') as f:
+            f.write(contents)
+        return filePath
+
+    def testAllMethods(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            srcFile = self._createFile(tempDir, os.urandom(100 * 1024))
+            for name, method in clcache.FileCopier().methods:
+                dstFile = os.path.join(tempDir, name + ".obj")
+                try:
+                    method(srcFile, dstFile)
+                except OSError:
+                    # e.g. reflinks are not supported by all file systems
+                    continue
+                with open(srcFile, 'rb') as src, open(dstFile, 'rb') as dst:
+                    self.assertEqual(src.read(), dst.read(), name)
+
+    def testFallbackIsRemembered(self):
+        calls = []
+
+        def unsupportedMethod(srcFilePath, dstFilePath):
+            calls.append((srcFilePath, dstFilePath))
+            raise OSError(errno.EOPNOTSUPP, "Operation not supported")
+
+        with tempfile.TemporaryDirectory() as tempDir:
+            srcFile = self._createFile(tempDir)
+            capabilitiesFile = os.path.join(tempDir, "copymethods.txt")
+
+            copier = clcache.FileCopier(capabilitiesFile)
+            copier.methods = [('unsupported', unsupportedMethod)] + copier.methods[-1:]
+            self.assertEqual(copier.copy(srcFile, os.path.join(tempDir, "1.obj")), 'copy')
+            self.assertEqual(copier.copy(srcFile, os.path.join(tempDir, "2.obj")), 'copy')
+            self.assertEqual(len(calls), 1)
+
+            # Remembered across clcache invocations
+            copier = clcache.FileCopier(capabilitiesFile)
+            copier.methods = [('unsupported', unsupportedMethod)] + copier.methods[-1:]
+            self.assertEqual(copier.copy(srcFile, os.path.join(tempDir, "3.obj")), 'copy')
+            self.assertEqual(len(calls), 1)
+
+            with open(os.path.join(tempDir, "3.obj"), 'rb') as f:
+                self.assertEqual(f.read(), b'object file contents')
+
+    def testErrorsArePropagated(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            with self.assertRaises(OSError):
+                clcache.FileCopier().copy(os.path.join(tempDir, "missing.obj"), os.path.join(tempDir, "main.obj"))
+
+    def testHardlink(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            srcFile = self._createFile(tempDir)
+            dstFile = os.path.join(tempDir, "link.obj")
+            with patch.dict(os.environ, {'CLCACHE_HARDLINK': '1'}):
+                clcache.copyOrLink(srcFile, dstFile)
+            self.assertTrue(os.path.samefile(srcFile, dstFile))
+
 
 class TestExtentCommandLineFromEnvironment(unittest.TestCase):
     def testEmpty(self):
@@ -155,6 +396,15 @@ class TestConfiguration(unittest.TestCase):
         configuration = Configuration(os.path.join(ASSETS_DIR, "configuration", "testDefaults.json"))
         with configuration as cfg:
             self.assertGreaterEqual(cfg.maximumCacheSize(), 1024) # 1KiB
+            self.assertEqual(cfg.maximumManifestEntries(), clcache.MAX_MANIFEST_HASHES)
+            self.assertEqual(cfg.evictionPolicy(), clcache.EVICTION_POLICY_LRU)
+
+    def testUnsupportedEvictionPolicy(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            with Configuration(os.path.join(tempDir, "config.txt")) as cfg:
+                cfg.setEvictionPolicy("MRU")
+                with self.assertRaises(clcache.LogicException):
+                    cfg.evictionPolicy()
 
 
 class TestStatistics(unittest.TestCase):
@@ -208,12 +458,53 @@ class TestStatistics(unittest.TestCase):
             # accumulated: headerChanged, sourceChanged, eviced, miss
             self.assertEqual(s.numCacheMisses(), 4)
 
+    def testShardedCounters(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            statsFile = os.path.join(tempDir, "stats.txt")
+
+            def shardFiles():
+                shardsDir = os.path.join(tempDir, "stats.shards")
+                return [f for f in os.listdir(shardsDir) if f.endswith('.json')]
+
+            # Processes with different ids update different shards
+            for pid in [1, 2, 2, 17]:
+                with patch('clcache.os.getpid', return_value=pid), Statistics(statsFile) as s:
+                    s.registerCacheHit()
+                    s.registerCacheEntry(100)
+            self.assertFalse(os.path.exists(statsFile))
+            self.assertEqual(len(shardFiles()), 2)
+
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.numCacheHits(), 4)
+                self.assertEqual(s.numCacheEntries(), 4)
+                self.assertEqual(s.currentCacheSize(), 400)
+
+            # Setting values merges the shards, keeping changes registered concurrently
+            stats = Statistics(statsFile)
+            with stats.lock, stats as s:
+                self.assertEqual(s.currentCacheSize(), 400)
+                with Statistics(statsFile) as concurrent:
+                    concurrent.registerCacheEntry(50)
+                    concurrent.registerCacheMiss()
+                s.setCacheSize(300)
+                s.resetCounters()
+            self.assertTrue(os.path.exists(statsFile))
+            self.assertEqual(shardFiles(), [])
+
+            with Statistics(statsFile) as s:
+                self.assertEqual(s.currentCacheSize(), 350)
+                self.assertEqual(s.numCacheEntries(), 5)
+                self.assertEqual(s.numCacheHits(), 0)
+                self.assertEqual(s.numCacheMisses(), 1)
+
 
 class TestManifestRepository(unittest.TestCase):
     entry1 = ManifestEntry([r'somepath\myinclude.h'],
+                           ["fdde59862785f9f0ad6e661b9b5746b7"],
                            "fdde59862785f9f0ad6e661b9b5746b7",
                            "a649723940dc975ebd17167d29a532f8")
     entry2 = ManifestEntry([r'somepath\myinclude.h', r'moreincludes.h'],
+                           ["fdde59862785f9f0ad6e661b9b5746b7", "474e7fc26a592d84dfa7416c10f036c6"],
                            "474e7fc26a592d84dfa7416c10f036c6",
                            "8771d7ebcf6c8bd57a3d6485f63e3a89")
     # Size in (120, 240] bytes
@@ -227,7 +518,7 @@ class TestManifestRepository(unittest.TestCase):
 
         size = 0
         for path, _, filenames in clcache.WALK(dirPath):
-            size += sum(filesize(path, f) for f in filenames)
+            size += sum(filesize(path, f) for f in filenames if not SectionLedger.isLedgerFile(f))
 
         return size
 
@@ -238,7 +529,7 @@ class TestManifestRepository(unittest.TestCase):
 
         self.assertEqual(ms.manifestSectionDir, os.path.join(manifestsRootDir, "fd"))
         self.assertEqual(ms.manifestPath("fdde59862785f9f0ad6e661b9b5746b7"),
-                         os.path.join(manifestsRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.json"))
+                         os.path.join(manifestsRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.manifest"))
 
     def testIncludesContentHash(self):
         self.assertEqual(
@@ -298,6 +589,65 @@ class TestManifestRepository(unittest.TestCase):
         retrieved2Entry = retrieved2.entries()[0]
         self.assertEqual(retrieved2Entry, TestManifestRepository.entry2)
 
+    def testStoreAndGetManyEntries(self):
+        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
+        ms = ManifestRepository(manifestsRootDir).section("8a33738d88be7edbacef48e262bbb5bc")
+
+        entries = []
+        for i in range(10):
+            includeFiles = [r'c:\projects\include\header{}.h'.format(j) for j in range(i, i + 20)] + [r'?\ümlaut.h']
+            includeHashes = [clcache.getStringHash(str(j % 7)) for j in range(len(includeFiles))]
+            entries.append(ManifestEntry(includeFiles, includeHashes,
+                                         ManifestRepository.getIncludesContentHashForHashes(includeHashes),
+                                         clcache.getStringHash(str(i))))
+        entries.append(ManifestEntry([], [], ManifestRepository.getIncludesContentHashForHashes([]), "0" * 32))
+
+        usages = [clcache.ManifestEntryUsage(i, 2 * i) for i in range(len(entries))]
+
+        ms.setManifest("8a33738d88be7edbacef48e262bbb5bc", Manifest(entries, usages, 42))
+        retrieved = ms.getManifest("8a33738d88be7edbacef48e262bbb5bc")
+        self.assertEqual(retrieved.entries(), entries)
+        self.assertEqual(retrieved.usages(), usages)
+        self.assertEqual(retrieved.clock(), 42)
+
+    def testCorruptManifest(self):
+        manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
+        ms = ManifestRepository(manifestsRootDir).section("8a33738d88be7edbacef48e262bbb5bc")
+        ms.setManifest("8a33738d88be7edbacef48e262bbb5bc", TestManifestRepository.manifest2)
+
+        manifestPath = ms.manifestPath("8a33738d88be7edbacef48e262bbb5bc")
+        with open(manifestPath, 'rb') as f:
+            data = f.read()
+        for corruptData in [b'', data[:-3], b'XXXX' + data[4:]]:
+            with open(manifestPath, 'wb') as f:
+                f.write(corruptData)
+            self.assertIsNone(ms.getManifest("8a33738d88be7edbacef48e262bbb5bc"))
+
+    def testAccessJournal(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+            ms = ManifestRepository(tempDir).section(manifestHash)
+            ms.setManifest(manifestHash, Manifest([TestManifestRepository.entry1, TestManifestRepository.entry2]))
+            manifestStat = os.stat(ms.manifestPath(manifestHash))
+
+            # Recording accesses does not touch the manifest
+            ms.recordAccess(manifestHash, TestManifestRepository.entry2.objectHash)
+            ms.recordAccess(manifestHash, TestManifestRepository.entry2.objectHash)
+            ms.recordAccess(manifestHash, "0" * 32)
+            self.assertEqual(os.stat(ms.manifestPath(manifestHash)), manifestStat)
+            self.assertEqual(ms.getManifest(manifestHash).entries()[0], TestManifestRepository.entry1)
+
+            ms.foldAccessJournal()
+            self.assertFalse(os.path.exists(ms.accessJournalPath()))
+            manifest = ms.getManifest(manifestHash)
+            self.assertEqual(manifest.entries(),
+                             [TestManifestRepository.entry2, TestManifestRepository.entry1])
+            self.assertEqual(manifest.usages()[0].hits, 2)
+
+            # Folding without any recorded accesses is fine
+            ms.foldAccessJournal()
+            self.assertEqual(ms.getManifest(manifestHash).entries(), manifest.entries())
+
     def testNonExistingManifest(self):
         manifestsRootDir = os.path.join(ASSETS_DIR, "manifests")
         mm = ManifestRepository(manifestsRootDir)
@@ -331,19 +681,633 @@ class TestManifestRepository(unittest.TestCase):
         self.assertEqual(cleaningResultSize, 0)
         self.assertEqual(self._getDirectorySize(manifestsRootDir), 0)
 
+    def testCleanKeepsRecentlyAccessed(self):
+        with tempfile.TemporaryDirectory() as tempDir, \
+                patch('clcache.time.time', side_effect=range(1000, 2000)):
+            mm = ManifestRepository(tempDir)
+            manifestHashes = ["8a33738d88be7edbacef48e262bbb5bc", "0623305942d216c165970948424ae7d1"]
+            for manifestHash in manifestHashes:
+                mm.section(manifestHash).setManifest(manifestHash, TestManifestRepository.manifest1)
+            # Hit via the older manifest; file access times are not consulted
+            ms = mm.section(manifestHashes[0])
+            ms.recordAccess(manifestHashes[0], TestManifestRepository.entry1.objectHash)
+            for manifestHash in manifestHashes:
+                os.utime(mm.section(manifestHash).manifestPath(manifestHash), (0, 0))
+
+            manifestSize = os.path.getsize(ms.manifestPath(manifestHashes[0]))
+            self.assertEqual(mm.clean(manifestSize), manifestSize)
+            self.assertIsNotNone(ms.getManifest(manifestHashes[0]))
+            self.assertIsNone(mm.section(manifestHashes[1]).getManifest(manifestHashes[1]))
+
+    def testRebuildLedgersRemovesStaleFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            mm = ManifestRepository(tempDir)
+            manifestHash = "8a33738d88be7edbacef48e262bbb5bc"
+            ms = mm.section(manifestHash)
+            ms.setManifest(manifestHash, TestManifestRepository.manifest1)
+            ms.recordAccess(manifestHash, TestManifestRepository.entry1.objectHash)
+            # Manifest as stored by older clcache versions, and files left by
+            # interrupted clcache invocations
+            for fileName in ["0623305942d216c165970948424ae7d1.json", "tmpabc.tmp", "access.journal.folding"]:
+                with open(os.path.join(ms.manifestSectionDir, fileName), 'w') as f:
+                    f.write("stale")
+
+            mm.rebuildLedgers()
+            self.assertEqual(sorted(os.listdir(ms.manifestSectionDir)),
+                             [manifestHash + ".manifest", "access.journal", SectionLedger.LEDGER_FILE_NAME])
+            self.assertEqual(mm.clean(0), 0)
+            self.assertEqual(os.listdir(ms.manifestSectionDir), [SectionLedger.LEDGER_FILE_NAME])
+
 
 class TestCompilerArtifactsRepository(unittest.TestCase):
     def testPaths(self):
         compilerArtifactsRepositoryRootDir = os.path.join(ASSETS_DIR, "compiler-artifacts-repository")
-        car = CompilerArtifactsRepository(compilerArtifactsRepositoryRootDir)
+        car = CompilerArtifactsRepository(compilerArtifactsRepositoryRootDir,
+                                          BlobStore(os.path.join(ASSETS_DIR, "blobs")))
         cas = car.section("fdde59862785f9f0ad6e661b9b5746b7")
 
         # section path
         self.assertEqual(cas.compilerArtifactsSectionDir, os.path.join(compilerArtifactsRepositoryRootDir, "fd"))
 
         # entry path
-        self.assertEqual(cas.cachedObjectName("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
-            compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7", "object"))
+        self.assertEqual(cas.cacheEntryPath("fdde59862785f9f0ad6e661b9b5746b7"), os.path.join(
+            compilerArtifactsRepositoryRootDir, "fd", "fdde59862785f9f0ad6e661b9b5746b7.entry"))
+
+    def testSetAndRemoveEntry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "main.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'object')
+
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"),
+                                              BlobStore(os.path.join(tempDir, "blobs")))
+            key = "fdde59862785f9f0ad6e661b9b5746b7"
+            cas = car.section(key)
+            cas.setEntry(key, clcache.CompilerArtifacts(objectFile, "stdout", "stderr"))
+
+            self.assertTrue(cas.hasEntry(key))
+            # No temporary files are left behind
+            self.assertEqual(cas.cacheEntries(), [key])
+            self.assertEqual(cas.staleFiles(), [])
+            artifacts = cas.getEntry(key)
+            with open(artifacts.objectFilePath, 'rb') as f:
+                self.assertEqual(f.read(), b'object')
+            self.assertEqual(artifacts.stdout, "stdout")
+            self.assertEqual(artifacts.stderr, "stderr")
+
+            self.assertTrue(car.removeEntry(key))
+            self.assertFalse(cas.hasEntry(key))
+            self.assertEqual(cas.cacheEntries(), [])
+            self.assertEqual(cas.staleFiles(), [])
+            # Removing an entry which does not exist is fine
+            self.assertTrue(car.removeEntry(key))
+
+    def testEntryWithoutObjectFile(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"),
+                                              BlobStore(os.path.join(tempDir, "blobs")))
+            key = "fdde59862785f9f0ad6e661b9b5746b7"
+            cas = car.section(key)
+            self.assertEqual(cas.setEntry(key, clcache.CompilerArtifacts(None, "ümlaut", "")), 0)
+            self.assertEqual(cas.getEntry(key), clcache.CompilerArtifacts(None, "ümlaut", ""))
+
+    def testUnusableEntries(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"),
+                                              BlobStore(os.path.join(tempDir, "blobs")))
+            key = "fdde59862785f9f0ad6e661b9b5746b7"
+            cas = car.section(key)
+            cas.setEntry(key, clcache.CompilerArtifacts(None, "stdout", "stderr"))
+            with open(cas.cacheEntryPath(key), 'rb') as f:
+                data = f.read()
+
+            self.assertIsNone(cas.getEntry("474e7fc26a592d84dfa7416c10f036c6"))
+            for corruptData in [b'', data[:-3], b'XXXX' + data[4:], data[:4] + b'\xff' + data[5:]]:
+                with open(cas.cacheEntryPath(key), 'wb') as f:
+                    f.write(corruptData)
+                self.assertIsNone(cas.getEntry(key))
+
+    def testCleanRemovesStaleFiles(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"),
+                                              BlobStore(os.path.join(tempDir, "blobs")))
+            cas = car.section("fdde59862785f9f0ad6e661b9b5746b7")
+            # Cache entry as stored by older clcache versions
+            os.makedirs(os.path.join(cas.compilerArtifactsSectionDir, "fdde59862785f9f0ad6e661b9b5746b7"))
+            with open(os.path.join(cas.compilerArtifactsSectionDir, "tmpabc.tmp"), 'w') as f:
+                f.write("interrupted")
+
+            self.assertEqual(cas.cacheEntries(), [])
+            self.assertFalse(cas.hasEntry("fdde59862785f9f0ad6e661b9b5746b7"))
+            car.clean(0)
+            self.assertEqual(os.listdir(cas.compilerArtifactsSectionDir), [SectionLedger.LEDGER_FILE_NAME])
+
+    def testDeduplication(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "main.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+
+            blobStore = BlobStore(os.path.join(tempDir, "blobs"))
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"), blobStore)
+            keys = ["fdde59862785f9f0ad6e661b9b5746b7", "474e7fc26a592d84dfa7416c10f036c6"]
+            storedSizes = [car.section(key).setEntry(key, clcache.CompilerArtifacts(objectFile, "", ""))
+                           for key in keys]
+
+            # The object file is stored only once
+            self.assertEqual(storedSizes, [1000, 0])
+            self.assertEqual(len(list(blobStore.blobs())), 1)
+            self.assertEqual(car.section(keys[0]).getEntry(keys[0]).objectFilePath,
+                             car.section(keys[1]).getEntry(keys[1]).objectFilePath)
+
+            # The blob is accounted for only once
+            self.assertEqual(car.clean(1001), (2, 1000, 2000))
+
+            # Evicting one entry keeps the blob referenced by the other one
+            car.removeEntry(keys[0])
+            self.assertEqual(car.clean(1001), (1, 1000, 1000))
+            self.assertEqual(len(list(blobStore.blobs())), 1)
+
+            # Evicting the last reference frees the blob
+            self.assertEqual(car.clean(0), (0, 0, 0))
+            self.assertEqual(list(blobStore.blobs()), [])
+
+    def testCleanEvictsLeastRecentlyUsed(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"),
+                                              BlobStore(os.path.join(tempDir, "blobs")))
+            keys = ["fdde59862785f9f0ad6e661b9b5746b7", "474e7fc26a592d84dfa7416c10f036c6"]
+            for key in keys:
+                objectFile = os.path.join(tempDir, key + ".obj")
+                with open(objectFile, 'w') as f:
+                    f.write(key)
+                car.section(key).setEntry(key, clcache.CompilerArtifacts(objectFile, "", ""))
+
+            # Let the first entry be the most recently used one
+            ledger = car.section(keys[0]).ledger
+            entry = ledger.entries()[keys[0]]
+            ledger.compact({keys[0]: entry._replace(lastUsed=entry.lastUsed + 60)})
+
+            self.assertEqual(car.clean(64), (1, 32, 32))
+            self.assertTrue(car.section(keys[0]).hasEntry(keys[0]))
+            self.assertFalse(car.section(keys[1]).hasEntry(keys[1]))
+
+    def testRebuildLedgers(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "main.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'x' * 1000)
+
+            blobStore = BlobStore(os.path.join(tempDir, "blobs"))
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"), blobStore)
+            key = "fdde59862785f9f0ad6e661b9b5746b7"
+            cas = car.section(key)
+            cas.setEntry(key, clcache.CompilerArtifacts(objectFile, "", ""))
+            recordedEntries = cas.recordedEntries()
+            # Blob of an interrupted clcache invocation
+            with open(os.path.join(tempDir, "orphan.obj"), 'wb') as f:
+                f.write(b'orphan')
+            blobStore.addBlob(os.path.join(tempDir, "orphan.obj"))
+
+            os.remove(cas.ledger.ledgerPath)
+            car.rebuildLedgers()
+            self.assertEqual(cas.recordedEntries().keys(), recordedEntries.keys())
+            self.assertEqual(cas.recordedEntries()[key][1:], recordedEntries[key][1:])
+            self.assertEqual(len(list(blobStore.blobs())), 1)
+
+    def testCompileDuration(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"),
+                                              BlobStore(os.path.join(tempDir, "blobs")))
+            key = "fdde59862785f9f0ad6e661b9b5746b7"
+            cas = car.section(key)
+            cas.setEntry(key, clcache.CompilerArtifacts(None, "", ""), 2.5)
+            self.assertEqual(cas.readEntry(key)[4], 2.5)
+            self.assertEqual(cas.recordedEntries()[key].compileDuration, 2.5)
+
+            # The compile duration survives rebuilding the ledger
+            cas.rebuildLedger()
+            self.assertEqual(cas.recordedEntries()[key].compileDuration, 2.5)
+
+    def testCleanGreedyDualSizeFrequency(self):
+        with tempfile.TemporaryDirectory() as tempDir, \
+                patch('clcache.time.time', side_effect=range(1000, 2000)):
+            car = CompilerArtifactsRepository(os.path.join(tempDir, "objects"),
+                                              BlobStore(os.path.join(tempDir, "blobs")))
+            # An expensive entry, a cheap one used after it and a cheap one
+            # which was hit a lot
+            keys = ["fdde59862785f9f0ad6e661b9b5746b7", "474e7fc26a592d84dfa7416c10f036c6",
+                    "0623305942d216c165970948424ae7d1"]
+            for key, compileDuration in zip(keys, [40.0, 0.5, 0.5]):
+                objectFile = os.path.join(tempDir, key + ".obj")
+                with open(objectFile, 'w') as f:
+                    f.write(key)
+                car.section(key).setEntry(key, clcache.CompilerArtifacts(objectFile, "", ""), compileDuration)
+            for _ in range(100):
+                car.section(keys[2]).ledger.recordUse(keys[2])
+
+            self.assertEqual(car.clean(96, clcache.EVICTION_POLICY_GDSF), (2, 64, 64))
+            self.assertEqual([car.section(key).hasEntry(key) for key in keys], [True, False, True])
+
+            # Entries used from now on start out with the priority of the
+            # evicted entry, so that formerly valuable entries do not stay forever
+            inflation = clcache.InflationHistory(os.path.join(tempDir, "objects", "inflation.txt"))
+            self.assertEqual(inflation.valueAt(999), 0.0)
+            self.assertAlmostEqual(inflation.valueAt(2000), 0.5 / 32)
+
+
+class TestBlobStore(unittest.TestCase):
+    def testRemoveBlobIfUnusedSince(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            objectFile = os.path.join(tempDir, "main.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'object')
+            blobStore = BlobStore(os.path.join(tempDir, "blobs"))
+            blobName, _ = blobStore.addBlob(objectFile)
+            os.utime(blobStore.blobPath(blobName), (0, 0))
+
+            cleaningStarted = blobStore.fileSystemTime()
+            # Adding the blob again (for another cache entry) marks it as used
+            self.assertEqual(blobStore.addBlob(objectFile), (blobName, 0))
+            self.assertFalse(blobStore.removeBlobIfUnusedSince(blobName, cleaningStarted))
+            self.assertEqual(list(blobStore.blobs()), [blobName])
+
+            os.utime(blobStore.blobPath(blobName), (0, 0))
+            self.assertTrue(blobStore.removeBlobIfUnusedSince(blobName, cleaningStarted))
+            self.assertEqual(list(blobStore.blobs()), [])
+            self.assertTrue(blobStore.removeBlobIfUnusedSince(blobName, cleaningStarted))
+
+
+class TestIncrementalCleaning(unittest.TestCase):
+    def testCleanIncrementally(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            keys = ["fdde59862785f9f0ad6e661b9b5746b7", "474e7fc26a592d84dfa7416c10f036c6",
+                    "0623305942d216c165970948424ae7d1"]
+            with cache.statistics.lock, cache.statistics as stats:
+                for key in keys:
+                    objectFile = os.path.join(tempDir, key + ".obj")
+                    with open(objectFile, 'wb') as f:
+                        f.write(key.encode('ascii') * 32)
+                    section = cache.compilerArtifactsRepository.section(key)
+                    clcache.addObjectToCache(stats, cache, section, key, clcache.CompilerArtifacts(objectFile, "", ""),
+                                             1.0)
+
+            # Below the high watermark, nothing happens
+            cache.cleanIncrementally(3 * 1024 + 1)
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 3)
+
+            # Entries are evicted down to the low watermark. Blobs are removed
+            # only if they were not added again after cleaning started.
+            for blobName in cache.blobStore.blobs():
+                os.utime(cache.blobStore.blobPath(blobName), (0, 0))
+            cache.cleanIncrementally(2 * 1024)
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 1)
+                self.assertEqual(stats.currentCacheSize(), 1024)
+                self.assertEqual(stats.currentLogicalCacheSize(), 1024)
+            self.assertEqual([cache.compilerArtifactsRepository.section(key).hasEntry(key) for key in keys],
+                             [False, False, True])
+            self.assertEqual(len(list(cache.blobStore.blobs())), 1)
+
+    def testConcurrentAddCountedOnce(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+
+            def addEntry(key):
+                objectFile = os.path.join(tempDir, key + ".obj")
+                with open(objectFile, 'wb') as f:
+                    f.write(key.encode('ascii') * 32)
+                with cache.statistics.lock, cache.statistics as stats:
+                    section = cache.compilerArtifactsRepository.section(key)
+                    clcache.addObjectToCache(stats, cache, section, key, clcache.CompilerArtifacts(objectFile, "", ""),
+                                             1.0)
+
+            addEntry("fdde59862785f9f0ad6e661b9b5746b7")
+            addEntry("474e7fc26a592d84dfa7416c10f036c6")
+
+            # Another clcache invocation adds an entry after cleaning started
+            # but before the compiler artifacts are looked at
+            cleanManifests = cache.manifestRepository.cleanIncrementally
+
+            def cleanManifestsAndAddEntry(maxManifestsSize):
+                removedSize = cleanManifests(maxManifestsSize)
+                addEntry("0623305942d216c165970948424ae7d1")
+                return removedSize
+
+            with patch.object(cache.manifestRepository, 'cleanIncrementally', cleanManifestsAndAddEntry):
+                cache.cleanIncrementally(2 * 1024)
+
+            remainingEntries = cache.compilerArtifactsRepository.clean(float('inf'))
+            with cache.statistics as stats:
+                self.assertEqual((stats.numCacheEntries(), stats.currentCacheSize(), stats.currentLogicalCacheSize()),
+                                 remainingEntries)
+
+
+class TestSectionLedger(unittest.TestCase):
+    def testRecordAndCompact(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            ledger = SectionLedger(tempDir)
+            self.assertFalse(ledger.exists())
+            self.assertEqual(ledger.entries(), {})
+
+            ledger.recordWrite("a", ["1"])
+            ledger.recordWrite("b", ["2", "x"])
+            ledger.recordWrite("c", ["3"])
+            ledger.recordRemoval("c")
+            ledger.recordUse("b")
+            # Uses of files which are not recorded are ignored
+            ledger.recordUse("d")
+            # As are lines torn by concurrent appends
+            with open(ledger.usesPath, 'a') as f:
+                f.write("* a\n* b 12.5x\n")
+
+            entries = ledger.entries()
+            self.assertEqual(sorted(entries), ["a", "b"])
+            self.assertEqual(entries["a"].fields, ["1"])
+            self.assertEqual(entries["b"].fields, ["2", "x"])
+            self.assertGreaterEqual(entries["b"].lastUsed, entries["a"].lastUsed)
+
+            ledger.compact()
+            self.assertFalse(os.path.exists(ledger.usesPath))
+            self.assertEqual(ledger.entries(), entries)
+            with open(ledger.ledgerPath) as f:
+                self.assertEqual(len(f.readlines()), 2)
+
+            ledger.compact({"a": entries["a"]})
+            self.assertEqual(ledger.entries(), {"a": entries["a"]})
+
+
+class TestShardLayout(unittest.TestCase):
+    manifestHash = "474e7fc26a592d84dfa7416c10f036c6"
+    cachekey = "fdde59862785f9f0ad6e661b9b5746b7"
+
+    def _populate(self, cache, tempDir):
+        section = cache.manifestRepository.section(self.manifestHash)
+        with section.lock:
+            section.setManifest(self.manifestHash, TestManifestRepository.manifest1)
+        objectFile = os.path.join(tempDir, "main.obj")
+        with open(objectFile, 'wb') as f:
+            f.write(b'object')
+        section = cache.compilerArtifactsRepository.section(self.cachekey)
+        with section.lock, cache.statistics.lock, cache.statistics as stats:
+            clcache.addObjectToCache(stats, cache, section, self.cachekey,
+                                     clcache.CompilerArtifacts(objectFile, "stdout", ""), 1.0)
+
+    def _assertReadable(self, cache):
+        manifestSection = cache.manifestRepository.section(self.manifestHash)
+        self.assertEqual(manifestSection.getManifest(self.manifestHash).entries(), [TestManifestRepository.entry1])
+        artifacts = cache.compilerArtifactsRepository.section(self.cachekey).getEntry(self.cachekey)
+        self.assertEqual(artifacts.stdout, "stdout")
+        with open(artifacts.objectFilePath, 'rb') as f:
+            self.assertEqual(f.read(), b'object')
+
+    def testSectionDirs(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            self.assertEqual(ShardLayout().sectionDir(tempDir, self.cachekey), os.path.join(tempDir, "fd"))
+            layout = ShardLayout(2, 2)
+            self.assertEqual(layout.sectionDir(tempDir, self.cachekey), os.path.join(tempDir, "fd", "de"))
+            self.assertEqual(ShardLayout.lockDir(tempDir, layout.sectionDir(tempDir, self.cachekey)),
+                             os.path.join(tempDir, "fd"))
+
+            for path in [os.path.join(tempDir, "fd", "de"), os.path.join(tempDir, "fd", "xyz")]:
+                os.makedirs(path)
+            self.assertEqual(layout.sectionDirs(tempDir), [os.path.join(tempDir, "fd", "de")])
+
+        for depth, width in [(0, 2), (1, 1), (1, ShardLayout.MAX_WIDTH + 1)]:
+            with self.assertRaises(clcache.LogicException):
+                ShardLayout(depth, width)
+
+    def testSectionsShareLocks(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            repository = ManifestRepository(tempDir, [ShardLayout(2, 2)])
+            for manifestHash in [self.manifestHash, "47ff" + self.manifestHash[4:]]:
+                section = repository.section(manifestHash)
+                with section.lock:
+                    section.setManifest(manifestHash, TestManifestRepository.manifest1)
+
+            sections = list(repository.sections())
+            self.assertEqual(len(sections), 2)
+            self.assertEqual({section.lockDir for section in sections}, {os.path.join(tempDir, "47")})
+            with clcache.allSectionsLocked(repository):
+                pass
+
+    def testLookupWhileResharding(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = os.path.join(tempDir, "cache")
+            self._populate(clcache.Cache(cacheDir), tempDir)
+            with Configuration(os.path.join(cacheDir, "config.txt")) as cfg:
+                cfg.setShardLayout(ShardLayout(2, 2), ShardLayout())
+
+            # Files are found in the sections of either layout
+            cache = clcache.Cache(cacheDir)
+            self._assertReadable(cache)
+            self.assertEqual(len(list(cache.compilerArtifactsRepository.sections())), 1)
+            self.assertEqual(cache.relocateFiles(), 0)
+            sections = cache.compilerArtifactsRepository.sections()
+            self.assertEqual(sum(len(section.cacheEntries()) for section in sections), 1)
+            self.assertTrue(os.path.exists(os.path.join(cacheDir, "objects", "fd", "de", self.cachekey + ".entry")))
+            self._assertReadable(cache)
+
+    def testReshard(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = os.path.join(tempDir, "cache")
+            cache = clcache.Cache(cacheDir)
+            self._populate(cache, tempDir)
+            ledgerEntries = cache.compilerArtifactsRepository.section(self.cachekey).ledger.entries()
+
+            self.assertEqual(clcache.reshardCache(cache, ShardLayout(2, 2)), 0)
+            for path in [os.path.join("manifests", "47", "4e", self.manifestHash + ".manifest"),
+                         os.path.join("objects", "fd", "de", self.cachekey + ".entry")]:
+                self.assertTrue(os.path.exists(os.path.join(cacheDir, path)))
+            for path in [os.path.join("manifests", "47", SectionLedger.LEDGER_FILE_NAME),
+                         os.path.join("objects", "fd", SectionLedger.LEDGER_FILE_NAME)]:
+                self.assertFalse(os.path.exists(os.path.join(cacheDir, path)))
+            with Configuration(os.path.join(cacheDir, "config.txt")) as cfg:
+                self.assertEqual(cfg.shardLayouts(), [ShardLayout(2, 2)])
+
+            cache = clcache.Cache(cacheDir)
+            self._assertReadable(cache)
+            self.assertEqual(len(ShardLayout(2, 2).sectionDirs(cache.blobStore.blobsRootDir)), 1)
+            section = cache.compilerArtifactsRepository.section(self.cachekey)
+            self.assertEqual(section.ledger.entries(), ledgerEntries)
+
+            # Nested sections are no stale files of their parent directories
+            self.assertEqual(clcache.reshardCache(cache, ShardLayout()), 0)
+            cache = clcache.Cache(cacheDir)
+            self._assertReadable(cache)
+            self.assertFalse(os.path.exists(os.path.join(cacheDir, "objects", "fd", "de")))
+            with cache.lock:
+                clcache.rebuildCacheIndex(cache)
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheEntries(), 1)
+
+    def testAddAfterResharding(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cacheDir = os.path.join(tempDir, "cache")
+            cache = clcache.Cache(cacheDir)
+            manifestSection = cache.manifestRepository.section(self.manifestHash)
+            # Some other clcache process reshards the cache while compiling
+            self.assertEqual(clcache.reshardCache(clcache.Cache(cacheDir), ShardLayout(2, 2)), 0)
+
+            objectFile = os.path.join(tempDir, "main.obj")
+            with open(objectFile, 'wb') as f:
+                f.write(b'object')
+            entry = TestManifestRepository.entry1
+            clcache.addDirectModeCacheEntry(
+                cache, manifestSection, self.manifestHash, entry, clcache.CompilerArtifacts(objectFile, "stdout", ""),
+                1.0, Statistics.registerSourceChangedMiss)
+
+            cache = clcache.Cache(cacheDir)
+            manifest = cache.manifestRepository.section(self.manifestHash).getManifest(self.manifestHash)
+            self.assertEqual(manifest.entries(), [entry])
+            artifacts = cache.compilerArtifactsRepository.section(entry.objectHash).getEntry(entry.objectHash)
+            with open(artifacts.objectFilePath, 'rb') as f:
+                self.assertEqual(f.read(), b'object')
+            self.assertFalse(os.path.exists(os.path.join(cacheDir, "objects", "a6", entry.objectHash + ".entry")))
+
+
+class TestLockTimings(unittest.TestCase):
+    def testTimings(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            CacheLock.takeTimings()
+            sectionDir = os.path.join(tempDir, "objects", "ab")
+            with CacheLock.forSection(sectionDir):
+                pass
+            with CacheLock.forPath(os.path.join(tempDir, "objects", "cd")):
+                pass
+            with CacheLock.forPath(os.path.join(tempDir, "untimed"), timed=False):
+                pass
+
+            timings = CacheLock.takeTimings()
+            self.assertEqual(sorted(timings), ["objects/ab", "objects/cd"])
+            self.assertEqual(timings["objects/ab"].acquisitions, 1)
+            self.assertEqual(timings["objects/ab"].timeouts, 0)
+            self.assertEqual(CacheLock.takeTimings(), {})
+
+    def testLockStatistics(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            lockStatistics = LockStatistics(os.path.join(tempDir, "locks.txt"))
+            with lockStatistics as lockStats:
+                lockStats.registerLockTimings({
+                    "objects/ab": LockTiming(2, 0, 0.5, 1.0),
+                    "manifests/cd": LockTiming(1, 1, 2.0, 0.0),
+                })
+            with lockStatistics as lockStats:
+                lockStats.registerLockTimings({"objects/ab": LockTiming(1, 0, 0.25, 0.5)})
+
+            with lockStatistics as lockStats:
+                self.assertEqual(lockStats.lockTimings(), {
+                    "objects/ab": LockTiming(3, 0, 0.75, 1.5),
+                    "manifests/cd": LockTiming(1, 1, 2.0, 0.0),
+                })
+
+            with lockStatistics.lock, lockStatistics as lockStats:
+                lockStats.resetTimings()
+            with lockStatistics as lockStats:
+                self.assertEqual(lockStats.lockTimings()["objects/ab"], LockTiming(0, 0, 0, 0))
+
+    def testLockReport(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(tempDir)
+            with cache.lockStatistics as lockStats:
+                lockStats.registerLockTimings({
+                    "objects/ab": LockTiming(2, 0, 0.5, 1.0),
+                    "manifests/cd": LockTiming(1, 1, 2.0, 0.0),
+                })
+
+            with patch('sys.stdout', new_callable=io.StringIO) as output:
+                clcache.printLockReport(cache)
+            report = output.getvalue()
+            self.assertIn("total wait time  : 2.500 s", report)
+            self.assertLess(report.index("manifests/cd"), report.index("objects/ab"))
+
+
+@unittest.skipIf(sys.platform == 'win32', "file locks are used on POSIX systems only")
+class TestFileCacheLock(unittest.TestCase):
+    def testRecursiveAcquisition(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "section")
+            with CacheLock.forPath(path, timeoutMs=0):
+                with CacheLock.forPath(path, timeoutMs=0):
+                    pass
+                self.assertTrue(os.path.exists(path + ".lock"))
+
+    def testTimeout(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "section")
+            lock = CacheLock.forPath(path, timeoutMs=50)
+
+            # A separate open file conflicts just like another process
+            fd = os.open(path + ".lock", os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with self.assertRaises(CacheLockException):
+                    lock.acquire()
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+            with lock:
+                pass
+
+    def testExcludesOtherThreads(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            path = os.path.join(tempDir, "section")
+            errors = []
+
+            def acquire():
+                try:
+                    with CacheLock.forPath(path, timeoutMs=0):
+                        pass
+                except CacheLockException as e:
+                    errors.append(e)
+
+            with CacheLock.forPath(path):
+                thread = threading.Thread(target=acquire)
+                thread.start()
+                thread.join()
+            self.assertEqual(len(errors), 1)
+
+            acquire()
+            self.assertEqual(len(errors), 1)
+
+    def testSharedSectionLock(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            sectionDir = os.path.join(tempDir, "ab")
+            sharedLock = CacheLock.forSection(sectionDir, shared=True, timeoutMs=50)
+            exclusiveLock = CacheLock.forSection(sectionDir, timeoutMs=50)
+
+            fd = os.open(sectionDir + ".lock", os.O_RDWR | os.O_CREAT)
+            try:
+                # Other readers do not keep readers out, but writers
+                fcntl.flock(fd, fcntl.LOCK_SH)
+                with sharedLock:
+                    pass
+                with self.assertRaises(CacheLockException):
+                    exclusiveLock.acquire()
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+            # Writers waiting for the lock keep new readers out
+            fd = os.open(sectionDir + ".turnstile", os.O_RDWR | os.O_CREAT)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                with self.assertRaises(CacheLockException):
+                    sharedLock.acquire()
+                fcntl.flock(fd, fcntl.LOCK_UN)
+            finally:
+                os.close(fd)
+
+            with exclusiveLock, sharedLock:
+                pass
+            with sharedLock:
+                with self.assertRaises(clcache.LogicException):
+                    exclusiveLock.acquire()
+            with exclusiveLock:
+                pass
 
 
 class TestArgumentClasses(unittest.TestCase):
@@ -908,9 +1872,11 @@ class TestParseIncludes(unittest.TestCase):
 
 class TestManifest(unittest.TestCase):
     entry1 = ManifestEntry([r'somepath\myinclude.h'],
+                           ["fdde59862785f9f0ad6e661b9b5746b7"],
                            "fdde59862785f9f0ad6e661b9b5746b7",
                            "a649723940dc975ebd17167d29a532f8")
     entry2 = ManifestEntry([r'somepath\myinclude.h', r'moreincludes.h'],
+                           ["fdde59862785f9f0ad6e661b9b5746b7", "474e7fc26a592d84dfa7416c10f036c6"],
                            "474e7fc26a592d84dfa7416c10f036c6",
                            "8771d7ebcf6c8bd57a3d6485f63e3a89")
     entries = [entry1, entry2]
@@ -927,6 +1893,7 @@ class TestManifest(unittest.TestCase):
     def testAddEntry(self):
         manifest = Manifest(TestManifest.entries)
         newEntry = ManifestEntry([r'somepath\myotherinclude.h'],
+                                 ["474e7fc26a592d84dfa7416c10f036c6"],
                                  "474e7fc26a592d84dfa7416c10f036c6",
                                  "8771d7ebcf6c8bd57a3d6485f63e3a89")
         manifest.addEntry(newEntry)
@@ -938,6 +1905,41 @@ class TestManifest(unittest.TestCase):
         self.assertEqual(TestManifest.entry1, manifest.entries()[0])
         manifest.touchEntry(1)
         self.assertEqual(TestManifest.entry2, manifest.entries()[0])
+        self.assertEqual(manifest.usages()[0].hits, 1)
+        self.assertEqual(manifest.usages()[0].lastUsed, manifest.clock())
+        self.assertEqual(manifest.usages()[1].hits, 0)
+
+    @staticmethod
+    def _createEntry(number):
+        return ManifestEntry([r'somepath\myinclude.h'], [str(number)], str(number), str(number))
+
+    def testAddEntryEnforcesLimit(self):
+        manifest = Manifest()
+        for i in range(5):
+            manifest.addEntry(self._createEntry(i), maxEntries=3)
+        self.assertEqual(manifest.entries(), [self._createEntry(i) for i in [4, 3, 2]])
+        self.assertEqual(len(manifest.usages()), 3)
+
+    def testFrequentlyUsedEntrySurvives(self):
+        manifest = Manifest()
+        frequentEntry = self._createEntry(-1)
+        manifest.addEntry(frequentEntry, maxEntries=3)
+        for _ in range(5):
+            manifest.touchEntry(manifest.entries().index(frequentEntry))
+        for i in range(3):
+            manifest.addEntry(self._createEntry(i), maxEntries=3)
+        self.assertIn(frequentEntry, manifest.entries())
+
+    def testStaleFrequentEntryEvicted(self):
+        manifest = Manifest()
+        frequentEntry = self._createEntry(-1)
+        manifest.addEntry(frequentEntry, maxEntries=3)
+        for _ in range(5):
+            manifest.touchEntry(0)
+        for i in range(20):
+            manifest.addEntry(self._createEntry(i), maxEntries=3)
+        self.assertNotIn(frequentEntry, manifest.entries())
+        self.assertEqual(manifest.entries()[0], self._createEntry(19))
 
 
 class TestCreateManifestEntry(unittest.TestCase):
@@ -963,6 +1965,7 @@ class TestCreateManifestEntry(unittest.TestCase):
         self.assertEqual(entry.includesContentHash, TestCreateManifestEntry.expectedManifestEntry.includesContentHash)
         self.assertEqual(entry.objectHash, TestCreateManifestEntry.expectedManifestEntry.objectHash)
         self.assertEqual(entry.includeFiles, TestCreateManifestEntry.expectedManifestEntry.includeFiles)
+        self.assertEqual(entry.includeHashes, TestCreateManifestEntry.expectedManifestEntry.includeHashes)
 
     def testIsConsistentWithSameInput(self):
         entry = clcache.createManifestEntry(TestCreateManifestEntry.manifestHash, TestCreateManifestEntry.includePaths)
@@ -979,6 +1982,411 @@ class TestCreateManifestEntry(unittest.TestCase):
         self.assertManifestEntryIsCorrect(entry)
 
 
+class CountingFileHasher(object):
+    def __init__(self):
+        self.hashedFiles = []
+
+    def getFileHash(self, filePath):
+        self.hashedFiles.append(filePath)
+        return clcache.getFileHash(filePath)
+
+
+class TestVerifyManifestEntry(unittest.TestCase):
+    NUM_INCLUDES = 3 * clcache.INCLUDE_VERIFICATION_BATCH_SIZE
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        includePaths = []
+        for i in range(TestVerifyManifestEntry.NUM_INCLUDES):
+            filePath = os.path.join(self.tempDir.name, 'header{:03d}.h'.format(i))
+            with open(filePath, 'w') as f:
+                f.write('#define HEADER{}'.format(i))
+            includePaths.append(filePath)
+        self.entry = clcache.createManifestEntry('ffffffffffffffffffffffffffffffff', includePaths)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _entryWithChangedHash(self, index):
+        includeHashes = list(self.entry.includeHashes)
+        includeHashes[index] = '00000000000000000000000000000000'
+        return self.entry._replace(includeHashes=includeHashes)
+
+    def testMatch(self):
+        hasher = CountingFileHasher()
+        self.assertTrue(clcache.verifyManifestEntry(self.entry, {}, hasher))
+        self.assertEqual(sorted(hasher.hashedFiles), self.entry.includeFiles)
+
+    def testEarlyExit(self):
+        hasher = CountingFileHasher()
+        self.assertFalse(clcache.verifyManifestEntry(self._entryWithChangedHash(0), {}, hasher))
+        self.assertEqual(len(hasher.hashedFiles), clcache.INCLUDE_VERIFICATION_BATCH_SIZE)
+
+    def testHashesAreSharedBetweenEntries(self):
+        hasher = CountingFileHasher()
+        knownHashes = {}
+        self.assertFalse(clcache.verifyManifestEntry(self._entryWithChangedHash(-1), knownHashes, hasher))
+        self.assertTrue(clcache.verifyManifestEntry(self.entry, knownHashes, hasher))
+        self.assertEqual(sorted(hasher.hashedFiles), self.entry.includeFiles)
+
+    def testMissingInclude(self):
+        os.remove(self.entry.includeFiles[-1])
+        self.assertFalse(clcache.verifyManifestEntry(self.entry, {}))
+
+
+class TestManifestDecisionTree(unittest.TestCase):
+    NUM_INCLUDES = 100
+
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.includePaths = []
+        for i in range(TestManifestDecisionTree.NUM_INCLUDES):
+            filePath = os.path.join(self.tempDir.name, 'header{:03d}.h'.format(i))
+            with open(filePath, 'w') as f:
+                f.write('#define HEADER{}'.format(i))
+            self.includePaths.append(filePath)
+        self.manifestHash = 'ffffffffffffffffffffffffffffffff'
+        self.entry = clcache.createManifestEntry(self.manifestHash, self.includePaths)
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _variant(self, changedIndex):
+        includeHashes = list(self.entry.includeHashes)
+        includeHashes[changedIndex] = clcache.getStringHash(str(changedIndex))
+        return self.entry._replace(includeHashes=includeHashes, objectHash=str(changedIndex))
+
+    def testEmpty(self):
+        self.assertIsNone(clcache.ManifestDecisionTree([]).findEntry({}))
+
+    def testNoMatch(self):
+        entries = [self._variant(i) for i in range(10)]
+        self.assertIsNone(clcache.ManifestDecisionTree(entries).findEntry({}))
+
+    def testMatchAmongNearIdenticalEntries(self):
+        entries = [self._variant(i) for i in range(0, TestManifestDecisionTree.NUM_INCLUDES, 3)] + [self.entry]
+        hasher = CountingFileHasher()
+        self.assertEqual(clcache.ManifestDecisionTree(entries).findEntry({}, hasher), len(entries) - 1)
+        # Every include file is hashed at most once
+        self.assertEqual(len(hasher.hashedFiles), len(set(hasher.hashedFiles)))
+
+    def testMostRecentMatchWins(self):
+        entries = [self._variant(0), self.entry, self.entry._replace(objectHash='older')]
+        self.assertEqual(clcache.ManifestDecisionTree(entries).findEntry({}), 1)
+
+    def testDifferentIncludeSets(self):
+        smallerEntry = clcache.createManifestEntry(self.manifestHash, self.includePaths[:-1])
+        entries = [self._variant(TestManifestDecisionTree.NUM_INCLUDES - 1), smallerEntry, self.entry]
+        self.assertEqual(clcache.ManifestDecisionTree(entries).findEntry({}), 1)
+
+    def testMissingInclude(self):
+        smallerEntry = clcache.createManifestEntry(self.manifestHash, self.includePaths[:-1])
+        entries = [self.entry, self._variant(0), smallerEntry]
+        os.remove(self.includePaths[-1])
+        self.assertEqual(clcache.ManifestDecisionTree(entries).findEntry({}), 2)
+
+
+class TestFileHashIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempDir = tempfile.TemporaryDirectory()
+        self.indexDir = os.path.join(self.tempDir.name, 'hashindex')
+        self.headerFile = os.path.join(self.tempDir.name, 'header.h')
+        self._writeHeader('#define FOO 1')
+
+    def tearDown(self):
+        self.tempDir.cleanup()
+
+    def _writeHeader(self, contents, age=60):
+        with open(self.headerFile, 'w') as f:
+            f.write(contents)
+        mtime = os.stat(self.headerFile).st_mtime - age
+        os.utime(self.headerFile, (mtime, mtime))
+
+    def testMatchesGetFileHash(self):
+        index = FileHashIndex(self.indexDir)
+        self.assertEqual(index.getFileHash(self.headerFile), clcache.getFileHash(self.headerFile))
+
+    def testPersistence(self):
+        index = FileHashIndex(self.indexDir)
+        expectedHash = index.getFileHash(self.headerFile)
+        index.save()
+
+        # Change the contents without touching size, modification time and
+        # inode: the stale hash stored in the index proves it was used.
+        stat = os.stat(self.headerFile)
+        with open(self.headerFile, 'r+') as f:
+            f.write('#define BAR 1')
+        os.utime(self.headerFile, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+        self.assertEqual(FileHashIndex(self.indexDir).getFileHash(self.headerFile), expectedHash)
+
+    def testModifiedFileIsRehashed(self):
+        index = FileHashIndex(self.indexDir)
+        index.getFileHash(self.headerFile)
+        index.save()
+
+        self._writeHeader('#define FOO 2', age=30)
+        self.assertEqual(FileHashIndex(self.indexDir).getFileHash(self.headerFile),
+                         clcache.getFileHash(self.headerFile))
+
+    def testRacyFileIsNotStored(self):
+        self._writeHeader('#define FOO 1', age=0)
+
+        index = FileHashIndex(self.indexDir)
+        index.getFileHash(self.headerFile)
+        index.save()
+        self.assertFalse(os.path.exists(self.indexDir))
+
+    def testLoadsTouchedShardsOnly(self):
+        otherDir = os.path.join(self.tempDir.name, 'include')
+        os.mkdir(otherDir)
+        otherHeaderFile = os.path.join(otherDir, 'other.h')
+        with open(otherHeaderFile, 'w') as f:
+            f.write('#define BAR 1')
+        os.utime(otherHeaderFile, (0, 0))
+        index = FileHashIndex(self.indexDir)
+        index.getFileHash(self.headerFile)
+        index.getFileHash(otherHeaderFile)
+        index.save()
+        self.assertEqual(len(os.listdir(self.indexDir)), 2)
+
+        with patch('clcache.json.load', side_effect=json.load) as load:
+            index = FileHashIndex(self.indexDir)
+            index.getFileHash(self.headerFile)
+            index.getFileHash(self.headerFile)
+            self.assertEqual(load.call_count, 1)
+
+        # Unchanged shards are not written back
+        with patch('clcache.writeFileAtomically') as writeFile:
+            index.save()
+            self.assertFalse(writeFile.called)
+
+    def testMissingFile(self):
+        index = FileHashIndex(self.indexDir)
+        with self.assertRaises(FileNotFoundError):
+            index.getFileHash(os.path.join(self.tempDir.name, 'nonexisting.h'))
+
+
+class TestCompileLeases(unittest.TestCase):
+    def testAcquireRelease(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            leases = clcache.CompileLeases(os.path.join(tempDir, "leases"))
+            token = leases.acquire("key", 60)
+            self.assertIsNotNone(token)
+            self.assertIsNone(leases.acquire("key", 60))
+            self.assertIsNotNone(leases.acquire("otherkey", 60))
+
+            leases.release("key", "some other token")
+            self.assertIsNone(leases.acquire("key", 60))
+            leases.release("key", token)
+            self.assertIsNotNone(leases.acquire("key", 60))
+
+    def testExpiry(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            leases = clcache.CompileLeases(os.path.join(tempDir, "leases"))
+            token = leases.acquire("key", 60)
+            os.utime(leases.leasePath("key"), (0, 0))
+            newToken = leases.acquire("key", 60)
+            self.assertIsNotNone(newToken)
+
+            # Releasing the expired lease keeps the new one
+            leases.release("key", token)
+            self.assertIsNone(leases.acquire("key", 60))
+
+    def testRenewedWhileHeld(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            leases = clcache.CompileLeases(os.path.join(tempDir, "leases"))
+            token = leases.acquire("key", 60)
+            os.utime(leases.leasePath("key"), (0, 0))
+            with leases.held("key", token, 0.2):
+                time.sleep(0.3)
+                # Held longer than the expiry time, but renewed meanwhile
+                self.assertIsNone(leases.acquire("key", 0.2))
+            self.assertEqual(os.listdir(leases.leasesDir), [])
+
+
+class TestGetOrSetArtifacts(unittest.TestCase):
+    cachekey = "fdde59862785f9f0ad6e661b9b5746b7"
+
+    def testSectionUnlockedWhileCompiling(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            objectFile = os.path.join(tempDir, "main.obj")
+            section = cache.compilerArtifactsRepository.section(self.cachekey)
+            lockedByOthers = []
+
+            def compileSource(*_, **__):
+                def tryLock():
+                    try:
+                        with CacheLock.forSection(section.compilerArtifactsSectionDir, timeoutMs=0):
+                            lockedByOthers.append(True)
+                    except CacheLockException:
+                        pass
+                thread = threading.Thread(target=tryLock)
+                thread.start()
+                thread.join()
+                with open(objectFile, 'wb') as f:
+                    f.write(b'object')
+                return 0, "stdout", ""
+
+            with patch('clcache.invokeRealCompiler', side_effect=compileSource) as invokeRealCompiler:
+                result = clcache.getOrSetArtifacts(
+                    cache, self.cachekey, objectFile, "cl.exe", [], Statistics.registerCacheMiss)
+                self.assertEqual(result, (0, "stdout", "", False))
+                self.assertEqual(lockedByOthers, [True])
+
+                # Hit
+                result = clcache.getOrSetArtifacts(
+                    cache, self.cachekey, objectFile, "cl.exe", [], Statistics.registerCacheMiss)
+                self.assertEqual(result, (0, "stdout", "", False))
+                self.assertEqual(invokeRealCompiler.call_count, 1)
+            self.assertEqual(os.listdir(cache.compileLeases.leasesDir), [])
+
+    def testWaitForConcurrentCompile(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            objectFile = os.path.join(tempDir, "main.obj")
+            section = cache.compilerArtifactsRepository.section(self.cachekey)
+
+            # Some other clcache invocation compiles the same entry
+            token = cache.compileLeases.acquire(self.cachekey, 60)
+
+            def addEntry():
+                compiledObjectFile = os.path.join(tempDir, "other.obj")
+                with open(compiledObjectFile, 'wb') as f:
+                    f.write(b'object')
+                with section.lock:
+                    section.setEntry(self.cachekey, clcache.CompilerArtifacts(compiledObjectFile, "stdout", ""))
+                cache.compileLeases.release(self.cachekey, token)
+            timer = threading.Timer(0.1, addEntry)
+            timer.start()
+
+            with patch('clcache.invokeRealCompiler') as invokeRealCompiler:
+                result = clcache.getOrSetArtifacts(
+                    cache, self.cachekey, objectFile, "cl.exe", [], Statistics.registerCacheMiss)
+            timer.join()
+            self.assertFalse(invokeRealCompiler.called)
+            self.assertEqual(result, (0, "stdout", "", False))
+            with open(objectFile, 'rb') as f:
+                self.assertEqual(f.read(), b'object')
+
+
+class TestProcessDirect(unittest.TestCase):
+    manifestHash = "474e7fc26a592d84dfa7416c10f036c6"
+
+    def testWaitForConcurrentCompile(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            hit = (0, "stdout", "", False)
+            published = threading.Event()
+
+            # Some other clcache invocation compiles the same source file
+            leaseKey = self.manifestHash + ".manifest"
+            token = cache.compileLeases.acquire(leaseKey, 60)
+
+            def addManifestEntry():
+                published.set()
+                cache.compileLeases.release(leaseKey, token)
+            timer = threading.Timer(0.1, addManifestEntry)
+            timer.start()
+
+            def lookup(*_):
+                if published.is_set():
+                    return hit, None
+                return None, Statistics.registerSourceChangedMiss
+
+            with patch('clcache.ManifestRepository.getManifestHash', return_value=self.manifestHash), \
+                    patch('clcache.processManifestLookup', side_effect=lookup), \
+                    patch('clcache.postprocessUnusableManifestMiss') as postprocessMiss:
+                result = clcache.processDirect(cache, "main.obj", "cl.exe", [], "main.cpp")
+            timer.join()
+            self.assertFalse(postprocessMiss.called)
+            self.assertEqual(result, hit)
+            self.assertEqual(os.listdir(cache.compileLeases.leasesDir), [])
+
+
+class TestWriteBackSpool(unittest.TestCase):
+    def _compile(self, tempDir):
+        objectFile = os.path.join(tempDir, "main.obj")
+        with open(objectFile, 'wb') as f:
+            f.write(b'object')
+        return clcache.CompilerArtifacts(objectFile, "stdout", "")
+
+    def testPublishNoDirect(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            artifacts = self._compile(tempDir)
+            cachekey = "fdde59862785f9f0ad6e661b9b5746b7"
+            with patch('clcache.launchWriteBackPublisher') as launchPublisher:
+                clcache.spoolCacheEntry(cache, cachekey, artifacts, 1.5, Statistics.registerCacheMiss)
+                self.assertTrue(launchPublisher.called)
+
+            section = cache.compilerArtifactsRepository.section(cachekey)
+            self.assertFalse(section.hasEntry(cachekey))
+            self.assertEqual(len(cache.writeBackSpool.jobs()), 1)
+
+            clcache.publishWriteBackSpool(cache)
+            self.assertEqual(section.getEntry(cachekey).stdout, "stdout")
+            self.assertEqual(cache.writeBackSpool.jobs(), [])
+            self.assertEqual(os.listdir(cache.writeBackSpool.spoolDir), [])
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheMisses(), 1)
+                self.assertEqual(stats.numCacheEntries(), 1)
+
+    def testPublishDirect(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            artifacts = self._compile(tempDir)
+            manifestHash = "474e7fc26a592d84dfa7416c10f036c6"
+            entry = TestManifestRepository.entry1
+            with patch('clcache.launchWriteBackPublisher'):
+                clcache.spoolCacheEntry(cache, entry.objectHash, artifacts, 1.5, Statistics.registerHeaderChangedMiss,
+                                        manifestHash, entry)
+
+            clcache.publishWriteBackSpool(cache)
+            self.assertTrue(cache.compilerArtifactsRepository.section(entry.objectHash).hasEntry(entry.objectHash))
+            manifest = cache.manifestRepository.section(manifestHash).getManifest(manifestHash)
+            self.assertEqual(manifest.entries(), [entry])
+            with cache.statistics as stats:
+                self.assertEqual(stats.numHeaderChangedMisses(), 1)
+
+    def testChangedObjectFileIsDropped(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            artifacts = self._compile(tempDir)
+            cachekey = "fdde59862785f9f0ad6e661b9b5746b7"
+            with patch('clcache.launchWriteBackPublisher'):
+                clcache.spoolCacheEntry(cache, cachekey, artifacts, 1.5, Statistics.registerCacheMiss)
+
+            # The build overwrites the object file before it is published
+            jobId = cache.writeBackSpool.jobs()[0]
+            stagedObjectStat = os.stat(cache.writeBackSpool.stagedObjectPath(jobId))
+            with open(cache.writeBackSpool.stagedObjectPath(jobId), 'wb') as f:
+                f.write(b'other object')
+            os.utime(cache.writeBackSpool.stagedObjectPath(jobId),
+                     ns=(stagedObjectStat.st_atime_ns, stagedObjectStat.st_mtime_ns + 10**9))
+
+            clcache.publishWriteBackSpool(cache)
+            self.assertFalse(cache.compilerArtifactsRepository.section(cachekey).hasEntry(cachekey))
+            self.assertEqual(cache.writeBackSpool.jobs(), [])
+            with cache.statistics as stats:
+                self.assertEqual(stats.numCacheMisses(), 1)
+                self.assertEqual(stats.numCacheEntries(), 0)
+
+    def testUnremovableJobIsTriedOnce(self):
+        with tempfile.TemporaryDirectory() as tempDir:
+            cache = clcache.Cache(os.path.join(tempDir, "cache"))
+            artifacts = self._compile(tempDir)
+            cachekey = "fdde59862785f9f0ad6e661b9b5746b7"
+            with patch('clcache.launchWriteBackPublisher'):
+                clcache.spoolCacheEntry(cache, cachekey, artifacts, 1.5, Statistics.registerCacheMiss)
+
+            with patch.object(clcache.WriteBackSpool, 'removeJob') as removeJob:
+                clcache.publishWriteBackSpool(cache)
+            self.assertEqual(removeJob.call_count, 1)
+            self.assertEqual(len(cache.writeBackSpool.jobs()), 1)
+
+
 if __name__ == '__main__':
     unittest.TestCase.longMessage = True
     unittest.main()